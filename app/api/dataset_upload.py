@@ -12,75 +12,157 @@
 #     prior written permission of Secure Ai Labs, Inc.
 # -------------------------------------------------------------------------------
 
+import asyncio
 import base64
+import contextlib
+import io
 import json
+import logging
 import os
 import shutil
-from typing import List
-from zipfile import ZipFile
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Any, BinaryIO, Callable, Dict, Iterator, List, Optional, Tuple
+from urllib.parse import urlsplit
+from zipfile import ZIP_DEFLATED, ZipFile
 
-from azure.storage.fileshare import ShareFileClient
-from Crypto.Cipher import AES
-from fastapi import APIRouter, BackgroundTasks, Depends, File, HTTPException, Query, Response, UploadFile, status
+from fastapi import APIRouter, Depends, File, HTTPException, Query, Response, UploadFile, status
 from fastapi.security import OAuth2PasswordBearer
 from sail_client import AuthenticatedClient
-from sail_client.api.default import (
-    get_all_data_federations,
-    get_data_model_info,
-    get_data_model_version,
-    get_dataset,
-    get_dataset_key,
-    get_dataset_version,
-    get_dataset_version_connection_string,
-    update_dataset_version,
-)
-from sail_client.models import (
-    DatasetEncryptionKeyOut,
-    DatasetVersionState,
-    GetDataModelOut,
-    GetDataModelVersionOut,
-    GetDatasetOut,
-    GetDatasetVersionConnectionStringOut,
-    GetDatasetVersionOut,
-    GetMultipleDataFederationOut,
-    UpdateDatasetVersionIn,
-)
-from sail_client.types import UNSET, Unset
+from starlette.concurrency import run_in_threadpool
 
 from app.models.common import PyObjectId
+from app.models.dataset_upload import UploadDatasetVersionResult, UploadMultipleDatasetVersionsOut
+from app.utils.job_scheduler import JobSchedulerSaturated, RetryJobLater, job_scheduler
+from app.utils import checkpoints, content_encoding, crypto, csv_scan, progress, row_index, sharding
+from app.utils.checkpoints import Checkpoint, checkpoint_store
+from app.utils.in_flight import in_flight_jobs
+from app.utils.lazy_import import lazy_import
+from app.utils.memory_budget import memory_budget
+from app.utils.parallel_zip import ParallelZipWriter
+from app.utils.progress import progress_bus
+from app.utils.resilience import CircuitOpen
+from app.utils.sail_api import call_async, call_sync
+from app.utils.settings import settings
+from app.utils.tracing import Span, bind_context, tracer
+
+if TYPE_CHECKING:
+    from sail_client.models import GetDatasetVersionOut
+
+# Heavy dependencies are only imported when an upload is handled, to keep the server startup fast
+fileshare = lazy_import("azure.storage.fileshare")
+sail_models = lazy_import("sail_client.models")
+get_all_data_federations = lazy_import("sail_client.api.default.get_all_data_federations")
+get_data_model_info = lazy_import("sail_client.api.default.get_data_model_info")
+get_data_model_version = lazy_import("sail_client.api.default.get_data_model_version")
+get_dataset = lazy_import("sail_client.api.default.get_dataset")
+get_dataset_key = lazy_import("sail_client.api.default.get_dataset_key")
+get_dataset_version = lazy_import("sail_client.api.default.get_dataset_version")
+get_dataset_version_connection_string = lazy_import("sail_client.api.default.get_dataset_version_connection_string")
+update_dataset_version = lazy_import("sail_client.api.default.update_dataset_version")
+
+logger = logging.getLogger(__name__)
 
 router = APIRouter()
 
+# Members of the dataset package with the encrypted preview and row index of the data files
+PREVIEW_FILE_NAME = "data_preview.zip"
+ROW_INDEX_FILE_NAME = "data_row_index.zip"
+
+# Files are encrypted in smaller chunks, down to this size, when memory is short
+MIN_ENCRYPTION_CHUNK_SIZE = 64 * 1024
+
+# Memory reserved to package an upload in memory, per byte uploaded: the data content zip and the package
+IN_MEMORY_PACKAGING_FACTOR = 3
+
+
+def create_zip_from_files(zip_file: str, files: List[str], compress: bool = False):
+    # The data files are deflated in parallel when compression is enabled
+    if compress and settings.zip_compression_level > 0:
+        with open(zip_file, "wb") as f, open_parallel_zip(f) as zipObj:
+            for file in files:
+                zipObj.write(file, os.path.basename(file))
+        return
 
-def create_zip_from_files(zip_file: str, files: List[str]):
     with ZipFile(zip_file, "w") as zipObj:
         for file in files:
             # Add file to zip with only the filename
             zipObj.write(file, os.path.basename(file))
 
 
-def encrypt_file_in_place(file: str, key, nonce):
-    # Check the size of the key and nonce
-    if len(key) != 32:
-        raise Exception("The key must be 256 bits")
-    if len(nonce) != 12:
-        raise Exception("The nonce must be 96 bits")
+@contextlib.contextmanager
+def open_parallel_zip(zip_file: BinaryIO) -> Iterator[ParallelZipWriter]:
+    """Open a parallel zip writer with as many blocks in flight as the memory budget allows"""
+    # Every block in flight is held with its deflated copy, plus the block being read
+    block_memory = 2 * settings.zip_compression_block_size
+    max_pending_blocks = 2 * (settings.zip_compression_workers or os.cpu_count() or 1)
+    with memory_budget.reserve((max_pending_blocks + 1) * block_memory, 2 * block_memory) as reserved:
+        with ParallelZipWriter(
+            zip_file,
+            settings.zip_compression_level,
+            settings.zip_compression_block_size,
+            max_pending_blocks=reserved // block_memory - 1,
+        ) as writer:
+            yield writer
+
+
+def create_zip_in_memory(members: List[Tuple[str, BinaryIO]], compress: bool = False) -> io.BytesIO:
+    """
+    Create a zip file in memory, the counterpart of create_zip_from_files for small packages. Small
+    members are deflated on the calling thread, they would not gain anything from the parallel writer.
 
-    # Read the file into a byte array
-    with open(file, "rb") as f:
-        file_bytes = f.read()
+    :param members: the name and content of every member of the zip file
+    :type members: List[Tuple[str, BinaryIO]]
+    :param compress: deflate the members if compression is enabled
+    :type compress: bool
+    :return: the zip file, positioned at its start
+    :rtype: io.BytesIO
+    """
+    zip_buffer = io.BytesIO()
+    if compress and settings.zip_compression_level > 0:
+        zip_options: Dict[str, Any] = {"compression": ZIP_DEFLATED, "compresslevel": settings.zip_compression_level}
+    else:
+        zip_options = {}
+    with ZipFile(zip_buffer, "w", **zip_options) as zipObj:
+        for name, content in members:
+            with zipObj.open(name, "w") as member:
+                shutil.copyfileobj(content, member)
+    zip_buffer.seek(0)
+    return zip_buffer
 
-    # Convert the key and nonce to bytes
-    cipher = AES.new(key, AES.MODE_GCM, nonce=nonce)
 
-    # Encrypt the file
-    ciphertext, tag = cipher.encrypt_and_digest(file_bytes)
+def encrypt_buffer_in_place(buffer: memoryview, key, nonce) -> bytes:
+    """
+    Encrypt a writable buffer in place with AES-GCM
 
-    # Write the encrypted file back to disk
-    with open(file, "wb") as f:
-        f.write(ciphertext)
+    :param buffer: the data to encrypt, overwritten with the ciphertext
+    :type buffer: memoryview
+    :return: the authentication tag
+    :rtype: bytes
+    """
+    return crypto.get_crypto_backend().encrypt_in_place(buffer, key, nonce)
+
+
+def encrypt_file_in_place(file: str, key, nonce):
+    # Encrypt the file chunk by chunk, writing every chunk back where it was read. The scratch buffer of the
+    # backends that need one is reserved with the chunk, a job never waits for a buffer while it holds another.
+    backend = crypto.get_crypto_backend()
+    buffer_size = crypto.CHUNK_SIZE + backend.get_scratch_size(crypto.CHUNK_SIZE)
+    min_buffer_size = MIN_ENCRYPTION_CHUNK_SIZE + backend.get_scratch_size(MIN_ENCRYPTION_CHUNK_SIZE)
+    with memory_budget.buffer(buffer_size, min_buffer_size) as buffer, open(file, "r+b") as f:
+        chunk, scratch = backend.split_buffer(buffer)
+        encryptor = backend.create_encryptor(key, nonce, scratch)
+        while True:
+            position = f.tell()
+            size = f.readinto(chunk)
+            if not size:
+                break
+            encryptor.update_into(chunk[:size], chunk[:size])
+            f.seek(position)
+            f.write(chunk[:size])
 
-    return tag
+    return encryptor.finalize()
 
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login")
@@ -95,140 +177,1008 @@ def get_secret(secret_name: str) -> str:
     return os.environ[secret_name]
 
 
-def encrypt_and_upload(
-    api_client: AuthenticatedClient,
-    dataset_version: GetDatasetVersionOut,
+class DatasetPackagingInfo:
+    """Information shared by all the versions of a dataset while packaging them"""
+
+    def __init__(
+        self,
+        dataset_id: str,
+        dataset_name: str,
+        data_federation_id: str,
+        data_federation_name: str,
+        encryption_key: bytes,
+        data_model_txt: str,
+    ):
+        self.dataset_id = dataset_id
+        self.dataset_name = dataset_name
+        self.data_federation_id = data_federation_id
+        self.data_federation_name = data_federation_name
+        self.encryption_key = encryption_key
+        self.data_model_txt = data_model_txt
+
+
+def get_api_client(token: str) -> AuthenticatedClient:
+    """Create a client for the SAIL API service authenticated as the current user"""
+    return AuthenticatedClient(
+        base_url=get_secret("SAIL_API_SERVICE_URL"),
+        timeout=60,
+        raise_on_unexpected_status=True,
+        verify_ssl=True,
+        token=token,
+        follow_redirects=False,
+    )
+
+
+def get_dataset_packaging_info(api_client: AuthenticatedClient, dataset_id: str) -> DatasetPackagingInfo:
+    """
+    Fetch the dataset, data federation, encryption key and data model needed to package a dataset version
+
+    :param api_client: client for the SAIL API service
+    :type api_client: AuthenticatedClient
+    :param dataset_id: id of the dataset the versions belong to
+    :type dataset_id: str
+    :return: the packaging information for the dataset
+    :rtype: DatasetPackagingInfo
+    """
+    # Get the dataset for the dataset version
+    dataset = call_sync(get_dataset, client=api_client, dataset_id=dataset_id)
+    assert type(dataset) == sail_models.GetDatasetOut
+
+    # Get the data federation
+    data_federation_list = call_sync(get_all_data_federations, client=api_client)
+    assert type(data_federation_list) == sail_models.GetMultipleDataFederationOut
+    if not data_federation_list.data_federations:
+        raise Exception("No data federation found for the dataset.")
+    data_federation = data_federation_list.data_federations[0]  # type: ignore
+
+    # GetEncryptionKeyForDataset
+    encryption_key_response = call_sync(
+        get_dataset_key, client=api_client, data_federation_id=str(data_federation.id), dataset_id=dataset_id
+    )
+    assert type(encryption_key_response) == sail_models.DatasetEncryptionKeyOut
+    encryption_key = encryption_key_response.dataset_key
+
+    # TODO: Get data model
+    data_model_id = data_federation.data_model_id
+    if type(data_model_id) != str:
+        raise Exception("No data model found for the data federation.")
+
+    data_model = call_sync(get_data_model_info, client=api_client, data_model_id=data_model_id)
+    if type(data_model) != sail_models.GetDataModelOut:
+        raise Exception("Error parsing data model.")
+
+    # Fetch the current version of the data model
+    if type(data_model.current_version_id) is not str:
+        raise Exception("No current version found for the data model.")
+
+    data_model_full = call_sync(
+        get_data_model_version, client=api_client, data_model_version_id=data_model.current_version_id
+    )
+    if type(data_model_full) != sail_models.GetDataModelVersionOut:
+        raise Exception("Error parsing data model version.")
+
+    return DatasetPackagingInfo(
+        dataset_id=dataset_id,
+        dataset_name=dataset.name,
+        data_federation_id=data_federation.id,
+        data_federation_name=data_federation.name,
+        encryption_key=base64.b64decode(encryption_key),
+        data_model_txt=json.dumps(data_model_full.to_dict()),
+    )
+
+
+def create_encrypted_zip(
+    members: List[Tuple[str, bytes]], packaging_info: DatasetPackagingInfo
+) -> Tuple[io.BytesIO, Dict[str, str]]:
+    """
+    Zip and encrypt small members in memory with their own nonce
+
+    :param members: the name and content of every member of the zip file
+    :type members: List[Tuple[str, bytes]]
+    :param packaging_info: the dataset information and encryption key
+    :type packaging_info: DatasetPackagingInfo
+    :return: the encrypted zip file and its tag and nonce for the dataset header
+    :rtype: Tuple[io.BytesIO, Dict[str, str]]
+    """
+    zip_buffer = create_zip_in_memory([(name, io.BytesIO(content)) for name, content in members], compress=True)
+    nonce = os.urandom(12)
+    with zip_buffer.getbuffer() as buffer:
+        tag = encrypt_buffer_in_place(buffer, packaging_info.encryption_key, nonce)
+    return zip_buffer, {
+        "aes_tag": base64.b64encode(tag).decode("utf-8"),
+        "aes_nonce": base64.b64encode(nonce).decode("utf-8"),
+    }
+
+
+def create_encrypted_scan_members(
+    scans: Dict[str, csv_scan.CsvScan],
+    packaging_info: DatasetPackagingInfo,
+    dataset_header: Dict[str, Any],
+) -> List[Tuple[str, io.BytesIO]]:
+    """
+    Zip and encrypt the previews and row indexes built while the data files were scanned. Each is a member of
+    the package listed in the dataset header, so that it can be read without decrypting the data content.
+
+    :param scans: the scans the data files were read through
+    :type scans: Dict[str, csv_scan.CsvScan]
+    :param packaging_info: the dataset information and encryption key
+    :type packaging_info: DatasetPackagingInfo
+    :param dataset_header: the dataset header, completed with the preview and row index
+    :type dataset_header: Dict[str, Any]
+    :return: the name and content of the encrypted members, empty if previews and row indexes are disabled
+    :rtype: List[Tuple[str, io.BytesIO]]
+    """
+    completed_scans = [scan for scan in scans.values() if not scan.abandoned]
+    members: List[Tuple[str, io.BytesIO]] = []
+
+    samplers = [scan.sampler for scan in completed_scans if scan.sampler]
+    if samplers:
+        preview_zip, encryption = create_encrypted_zip(
+            [(sampler.name, sampler.to_csv()) for sampler in samplers], packaging_info
+        )
+        dataset_header["preview"] = {
+            "file_name": PREVIEW_FILE_NAME,
+            **encryption,
+            "seed": settings.preview_seed,
+            "members": [sampler.to_manifest() for sampler in samplers],
+        }
+        members.append((PREVIEW_FILE_NAME, preview_zip))
+
+    indexers = [scan.indexer for scan in completed_scans if scan.indexer]
+    if indexers:
+        row_index_zip, encryption = create_encrypted_zip(
+            [(row_index.get_row_index_name(indexer.name), indexer.to_bytes()) for indexer in indexers], packaging_info
+        )
+        dataset_header["row_index"] = {
+            "file_name": ROW_INDEX_FILE_NAME,
+            **encryption,
+            "stride": settings.row_index_stride,
+            "members": [indexer.to_manifest() for indexer in indexers],
+        }
+        members.append((ROW_INDEX_FILE_NAME, row_index_zip))
+
+    return members
+
+
+def write_encrypted_scan_files(
+    scans: Dict[str, csv_scan.CsvScan],
+    packaging_info: DatasetPackagingInfo,
+    dataset_header: Dict[str, Any],
+    working_dir: str,
+) -> List[str]:
+    """Write the encrypted previews and row indexes to the working directory, return the files to add to the package"""
+    scan_files: List[str] = []
+    for name, content in create_encrypted_scan_members(scans, packaging_info, dataset_header):
+        scan_files.append(f"{working_dir}/{name}")
+        with open(scan_files[-1], "wb") as f:
+            f.write(content.getbuffer())
+    return scan_files
+
+
+def package_dataset_in_memory(
+    dataset_version_id: str,
     dataset_files: List[UploadFile],
-):
-    # Create a working directory for this request
-    random_id = base64.b64encode(os.urandom(12)).decode("utf-8")
-    working_dir = os.path.join(os.getcwd(), f"./tmp/{dataset_version.id}-{random_id}")
+    packaging_info: DatasetPackagingInfo,
+    dataset_header: Dict[str, Any],
+) -> io.BytesIO:
+    """
+    Build the dataset package without touching the disk, for uploads small enough to fit in memory
 
-    try:
-        os.makedirs(working_dir, exist_ok=True)
+    :param dataset_version_id: id of the dataset version packaged
+    :type dataset_version_id: str
+    :param dataset_files: the uploaded data files
+    :type dataset_files: List[UploadFile]
+    :param packaging_info: the dataset information and encryption key
+    :type packaging_info: DatasetPackagingInfo
+    :param dataset_header: the dataset header, completed with the encryption parameters
+    :type dataset_header: Dict[str, Any]
+    :return: the dataset package, positioned at its start
+    :rtype: io.BytesIO
+    """
+    # Create a zip package with the data files, sampling the CSV files on the way
+    with run_stage(dataset_version_id, progress.PACKAGING):
+        scans = csv_scan.create_scans([dataset_file.filename for dataset_file in dataset_files])
+        data_content_zip = create_zip_in_memory(
+            [
+                (
+                    os.path.basename(dataset_file.filename),
+                    csv_scan.wrap_for_scanning(
+                        open_dataset_file(dataset_file, settings.in_memory_max_bytes), dataset_file.filename, scans
+                    ),
+                )
+                for dataset_file in dataset_files
+            ],
+            compress=True,
+        )
+        for scan in scans.values():
+            scan.finish()
+        scan_members = create_encrypted_scan_members(scans, packaging_info, dataset_header)
+
+    # Encrypt the data content zip in place, the buffer view is released before the zip is read again
+    with run_stage(dataset_version_id, progress.ENCRYPTING):
+        nonce = os.urandom(12)
+        with data_content_zip.getbuffer() as data_content_buffer:
+            tag = encrypt_buffer_in_place(data_content_buffer, packaging_info.encryption_key, nonce)
+    dataset_header["aes_tag"] = base64.b64encode(tag).decode("utf-8")
+    dataset_header["aes_nonce"] = base64.b64encode(nonce).decode("utf-8")
 
-        # Copy the files to the working directory
-        local_files: List[str] = []
+    # Create the data model zip and the package with the dataset header, data model and data content
+    data_model_zip = create_zip_in_memory([("data_model.json", io.BytesIO(packaging_info.data_model_txt.encode()))])
+    package_members: List[Tuple[str, BinaryIO]] = [
+        ("dataset_header.json", io.BytesIO(json.dumps(dataset_header).encode())),
+        ("data_model.zip", data_model_zip),
+        ("data_content.zip", data_content_zip),
+    ]
+    return create_zip_in_memory(package_members + scan_members)  # type: ignore
+
+
+def package_dataset_on_disk(
+    dataset_version_id: str,
+    dataset_files: List[UploadFile],
+    packaging_info: DatasetPackagingInfo,
+    dataset_header: Dict[str, Any],
+    checkpoint: Checkpoint,
+) -> str:
+    """
+    Build the dataset package in a working directory, for uploads too large to be packaged in memory. The
+    stages already completed in the checkpoint are skipped.
+
+    :param dataset_version_id: id of the dataset version packaged
+    :type dataset_version_id: str
+    :param dataset_files: the uploaded data files
+    :type dataset_files: List[UploadFile]
+    :param packaging_info: the dataset information and encryption key
+    :type packaging_info: DatasetPackagingInfo
+    :param dataset_header: the dataset header, completed with the encryption parameters
+    :type dataset_header: Dict[str, Any]
+    :param checkpoint: the checkpoint of the job, in the working directory the package is built in
+    :type checkpoint: Checkpoint
+    :return: the path of the dataset package
+    :rtype: str
+    """
+    working_dir = checkpoint.working_dir
+    staged = checkpoint.get(checkpoints.STAGED)
+    if staged is None:
+        staged = stage_and_scan_dataset_files(
+            dataset_version_id, dataset_files, packaging_info, dataset_header, checkpoint
+        )
+    dataset_header.update(staged["dataset_header"])
+
+    # Create a zip package with the data files and encrypt it. The zip is encrypted in place, so the two stages
+    # are checkpointed together.
+    data_content_zip_file = f"{working_dir}/data_content.zip"
+    encrypted = checkpoint.get(checkpoints.ENCRYPTED)
+    if encrypted is None:
+        with run_stage(dataset_version_id, progress.PACKAGING):
+            local_files = [checkpoint.get_path(file_name) for file_name in staged["files"]]
+            create_zip_from_files(data_content_zip_file, local_files, compress=True)
+
+        with run_stage(dataset_version_id, progress.ENCRYPTING):
+            nonce = os.urandom(12)
+            tag = encrypt_file_in_place(data_content_zip_file, packaging_info.encryption_key, nonce)
+        encrypted = checkpoint.complete(
+            checkpoints.ENCRYPTED,
+            aes_tag=base64.b64encode(tag).decode("utf-8"),
+            aes_nonce=base64.b64encode(nonce).decode("utf-8"),
+        )
+        remove_staged_files(checkpoint)
+
+    # Create a file with name dataset_header.json
+    dataset_header_file = f"{working_dir}/dataset_header.json"
+    dataset_header["aes_tag"] = encrypted["aes_tag"]
+    dataset_header["aes_nonce"] = encrypted["aes_nonce"]
+    with open(dataset_header_file, "w") as f:
+        f.write(json.dumps(dataset_header))
+
+    # Create a zip file with the dataset header, data model, data content, preview and row index
+    scan_files = [checkpoint.get_path(file_name) for file_name in staged["scan_files"]]
+    return create_dataset_package_file(
+        dataset_version_id, packaging_info, dataset_header_file, checkpoint, [data_content_zip_file] + scan_files
+    )
+
+
+def stage_and_scan_dataset_files(
+    dataset_version_id: str,
+    dataset_files: List[UploadFile],
+    packaging_info: DatasetPackagingInfo,
+    dataset_header: Dict[str, Any],
+    checkpoint: Checkpoint,
+) -> Dict[str, Any]:
+    """
+    Stage the uploaded files in the working directory with their encrypted previews and row indexes, and
+    checkpoint them with the dataset header they complete
+
+    :return: the staged stage of the checkpoint
+    :rtype: Dict[str, Any]
+    """
+    scans = csv_scan.create_scans([dataset_file.filename for dataset_file in dataset_files])
+    local_files = stage_dataset_files(dataset_version_id, dataset_files, checkpoint.working_dir, scans)
+    scan_files = write_encrypted_scan_files(scans, packaging_info, dataset_header, checkpoint.working_dir)
+    return checkpoint.complete(
+        checkpoints.STAGED,
+        files=[os.path.basename(local_file) for local_file in local_files],
+        scan_files=[os.path.basename(scan_file) for scan_file in scan_files],
+        bytes=sum(os.path.getsize(local_file) for local_file in local_files),
+        sharded=settings.shard_count > 1,
+        dataset_header={key: dataset_header[key] for key in ("preview", "row_index") if key in dataset_header},
+    )
+
+
+def stage_dataset_files(
+    dataset_version_id: str,
+    dataset_files: List[UploadFile],
+    working_dir: str,
+    scans: Dict[str, csv_scan.CsvScan],
+) -> List[str]:
+    """Copy the uploaded files to the working directory through their scans and return their paths"""
+    local_files: List[str] = []
+    bytes_staged = 0
+    with run_stage(dataset_version_id, progress.STAGING, bytes_total=get_upload_size(dataset_files)) as span:
         for dataset_file in dataset_files:
-            shutil.copyfileobj(dataset_file.file, open(f"{working_dir}/{dataset_file.filename}", "wb"))
+            with open(f"{working_dir}/{dataset_file.filename}", "wb") as local_file:
+                shutil.copyfileobj(
+                    csv_scan.wrap_for_scanning(open_dataset_file(dataset_file), dataset_file.filename, scans),
+                    local_file,
+                )
+            if dataset_file.filename in scans:
+                scans[dataset_file.filename].finish()
             local_files.append(f"{working_dir}/{dataset_file.filename}")
+            bytes_staged += os.path.getsize(local_files[-1])
+            progress_bus.publish(dataset_version_id, bytes_processed=bytes_staged)
+        if span is not None:
+            span.set_attribute("bytes", bytes_staged)
+    return local_files
+
+
+def remove_staged_files(checkpoint: Checkpoint):
+    """Delete the plaintext staged files once the content is encrypted, a resumed job only needs the ciphertext"""
+    for file_name in checkpoint.get(checkpoints.STAGED)["files"]:  # type: ignore
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(checkpoint.get_path(file_name))
+
+
+def create_dataset_package_file(
+    dataset_version_id: str,
+    packaging_info: DatasetPackagingInfo,
+    dataset_header_file: str,
+    checkpoint: Checkpoint,
+    content_files: List[str],
+) -> str:
+    """
+    Create the dataset package zip with the dataset header, the data model and the given content files,
+    unless the checkpoint has it already
+    """
+    working_dir = checkpoint.working_dir
+    packaged = checkpoint.get(checkpoints.PACKAGED)
+    if packaged is not None:
+        return checkpoint.get_path(packaged["file"])
+
+    # Create a data_model zip file, straight from memory
+    data_model_zip_file = f"{working_dir}/data_model.zip"
+    with ZipFile(data_model_zip_file, "w") as zipObj:
+        zipObj.writestr("data_model.json", packaging_info.data_model_txt)
+
+    big_zip_files = [dataset_header_file, data_model_zip_file] + content_files
+    dataset_file = f"{working_dir}/dataset_{dataset_version_id}.zip"
+    create_zip_from_files(dataset_file, big_zip_files)
+    checkpoint.complete(checkpoints.PACKAGED, file=os.path.basename(dataset_file))
+    return dataset_file
+
+
+def package_and_upload_dataset_shards(
+    dataset_version_id: str,
+    connection_string: str,
+    dataset_files: List[UploadFile],
+    packaging_info: DatasetPackagingInfo,
+    dataset_header: Dict[str, Any],
+    checkpoint: Checkpoint,
+) -> str:
+    """
+    Split the data content in independently encrypted shards and upload each of them to its own file next
+    to the dataset package, in parallel. The dataset header lists the shards with their nonce, tag and
+    members, and the package itself only holds the header and the data model. It is returned to be uploaded
+    last, so that a reader never finds a header pointing to missing shards. The stages and the shard uploads
+    already completed in the checkpoint are skipped.
+
+    :param dataset_version_id: id of the dataset version packaged
+    :type dataset_version_id: str
+    :param connection_string: the url of the dataset package in the file share, with its sas token
+    :type connection_string: str
+    :param dataset_files: the uploaded data files
+    :type dataset_files: List[UploadFile]
+    :param packaging_info: the dataset information and encryption key
+    :type packaging_info: DatasetPackagingInfo
+    :param dataset_header: the dataset header, completed with the shard manifest
+    :type dataset_header: Dict[str, Any]
+    :param checkpoint: the checkpoint of the job, in the working directory the shards are built in
+    :type checkpoint: Checkpoint
+    :return: the path of the dataset package
+    :rtype: str
+    """
+    working_dir = checkpoint.working_dir
+    staged = checkpoint.get(checkpoints.STAGED)
+    if staged is None:
+        staged = stage_and_scan_dataset_files(
+            dataset_version_id, dataset_files, packaging_info, dataset_header, checkpoint
+        )
+    dataset_header.update(staged["dataset_header"])
+
+    encrypted = checkpoint.get(checkpoints.ENCRYPTED)
+    shard_count = len(encrypted["shards"]) if encrypted else settings.shard_count
+    with ThreadPoolExecutor(max_workers=min(settings.shard_workers, shard_count), thread_name_prefix="shard") as pool:
+        if encrypted is None:
+            local_files = [checkpoint.get_path(file_name) for file_name in staged["files"]]
+            encrypted = package_and_encrypt_dataset_shards(
+                dataset_version_id, local_files, packaging_info, checkpoint, pool
+            )
+            remove_staged_files(checkpoint)
+        shard_files = [
+            f"{working_dir}/data_content{sharding.get_shard_file_suffix(index)}.zip"
+            for index in range(len(encrypted["shards"]))
+        ]
+
+        # Upload the shards not uploaded yet, the progress is the sum of the bytes uploaded by all of them
+        shard_sizes = [shard["size"] for shard in encrypted["shards"]]
+        uploaded = [
+            size if checkpoint.get(checkpoints.get_shard_uploaded_stage(index)) is not None else 0
+            for index, size in enumerate(shard_sizes)
+        ]
+        uploaded_lock = threading.Lock()
+
+        def upload_shard(index: int):
+            if checkpoint.get(checkpoints.get_shard_uploaded_stage(index)) is not None:
+                return
+
+            def progress_hook(current: int, _):
+                with uploaded_lock:
+                    uploaded[index] = current
+                    bytes_processed = sum(uploaded)
+                progress_bus.publish(dataset_version_id, bytes_processed=bytes_processed)
+
+            with open(shard_files[index], "rb") as f:
+                upload_to_file_share(
+                    sharding.get_shard_file_url(connection_string, index), f, shard_sizes[index], progress_hook
+                )
+            checkpoint.complete(checkpoints.get_shard_uploaded_stage(index))
+
+        with run_stage(dataset_version_id, progress.UPLOADING, bytes_total=sum(shard_sizes)):
+            list(pool.map(bind_context(upload_shard), range(len(shard_files))))
+
+    # Create the dataset header with the shard manifest, the preview and the row index
+    package_name = os.path.basename(urlsplit(connection_string).path)
+    dataset_header["dataset_packaging_format"] = "csvv1-sharded"
+    dataset_header["shards"] = [
+        {"file_name": f"{package_name}{sharding.get_shard_file_suffix(index)}", **shard}
+        for index, shard in enumerate(encrypted["shards"])
+    ]
+    dataset_header_file = f"{working_dir}/dataset_header.json"
+    with open(dataset_header_file, "w") as f:
+        f.write(json.dumps(dataset_header))
+
+    # Create the dataset package with the header, the data model, the preview and the row index
+    scan_files = [checkpoint.get_path(file_name) for file_name in staged["scan_files"]]
+    return create_dataset_package_file(dataset_version_id, packaging_info, dataset_header_file, checkpoint, scan_files)
+
+
+def package_and_encrypt_dataset_shards(
+    dataset_version_id: str,
+    local_files: List[str],
+    packaging_info: DatasetPackagingInfo,
+    checkpoint: Checkpoint,
+    pool: ThreadPoolExecutor,
+) -> Dict[str, Any]:
+    """
+    Split the staged files in shards, zip and encrypt every shard with its own nonce on the pool and
+    checkpoint their manifest
+
+    :return: the encrypted stage of the checkpoint
+    :rtype: Dict[str, Any]
+    """
+    shards = sharding.plan_shards(local_files, settings.shard_count, settings.shard_by)
+    shard_files = [
+        f"{checkpoint.working_dir}/data_content{sharding.get_shard_file_suffix(index)}.zip"
+        for index in range(len(shards))
+    ]
+
+    # Create a zip file with the members of every shard
+    def package_shard(index: int):
+        if settings.zip_compression_level > 0:
+            with open(shard_files[index], "wb") as f, open_parallel_zip(f) as parallel_zip:
+                for member in shards[index]:
+                    parallel_zip.write_chunks(member.name, member.iter_chunks(), member.size)
+            return
+
+        with ZipFile(shard_files[index], "w") as zipObj:
+            for member in shards[index]:
+                with zipObj.open(member.name, "w", force_zip64=True) as zip_member:
+                    member.copy_to(zip_member)
+
+    with run_stage(dataset_version_id, progress.PACKAGING):
+        list(pool.map(bind_context(package_shard), range(len(shards))))
+
+    # Encrypt every shard with its own nonce
+    nonces = [os.urandom(12) for _ in shards]
+    with run_stage(dataset_version_id, progress.ENCRYPTING):
+        tags = list(
+            pool.map(
+                bind_context(
+                    lambda index: encrypt_file_in_place(
+                        shard_files[index], packaging_info.encryption_key, nonces[index]
+                    )
+                ),
+                range(len(shards)),
+            )
+        )
+
+    return checkpoint.complete(
+        checkpoints.ENCRYPTED,
+        shards=[
+            {
+                "size": os.path.getsize(shard_files[index]),
+                "aes_tag": base64.b64encode(tags[index]).decode("utf-8"),
+                "aes_nonce": base64.b64encode(nonces[index]).decode("utf-8"),
+                "members": [member.to_manifest() for member in shards[index]],
+            }
+            for index in range(len(shards))
+        ],
+    )
+
+
+def upload_dataset_package(dataset_version_id: str, connection_string: str, package: BinaryIO, size: int):
+    """Upload a dataset package to the Azure File Share using the sas token of the dataset version"""
+    with run_stage(dataset_version_id, progress.UPLOADING, bytes_total=size):
+        upload_to_file_share(
+            connection_string,
+            package,
+            size,
+            lambda current, _: progress_bus.publish(dataset_version_id, bytes_processed=current),
+        )
+
+
+def upload_to_file_share(file_url: str, data: BinaryIO, size: int, progress_hook: Callable[[int, Any], None]):
+    """
+    Create a file in the Azure File Share and upload its content range by range, tracing every operation
+
+    :param file_url: the url of the file with its sas token
+    :type file_url: str
+    :param data: the content of the file
+    :type data: BinaryIO
+    :param size: the size of the content in bytes
+    :type size: int
+    :param progress_hook: called with the bytes uploaded so far after every range
+    :type progress_hook: Callable[[int, Any], None]
+    """
+    file_name = os.path.basename(urlsplit(file_url).path)
+    file_client = fileshare.ShareFileClient.from_file_url(file_url=file_url)
+    with tracer.start_span("storage.create_file", **{"file.name": file_name, "file.size": size}):
+        file_client.create_file(size=size, headers=tracer.get_trace_headers())
+
+    with tracer.start_span("storage.upload_file", **{"file.name": file_name, "file.size": size}) as span:
+
+        def traced_progress_hook(current: int, total: Any):
+            # Every call follows the write of one range, the gaps between the events show the slow ones
+            if span is not None:
+                span.add_event("range_written", bytes=current)
+            progress_hook(current, total)
+
+        file_client.upload_file(data, progress_hook=traced_progress_hook, headers=tracer.get_trace_headers())
+
+
+@contextlib.contextmanager
+def run_stage(dataset_version_id: str, stage: str, **progress_fields: Any) -> Iterator[Optional[Span]]:
+    """Publish the progress of a packaging stage and run it in a span"""
+    progress_bus.publish(dataset_version_id, stage=stage, **progress_fields)
+    with tracer.start_span(f"stage.{stage.lower()}", **{"dataset_version.id": dataset_version_id}) as span:
+        yield span
 
+
+def encrypt_and_upload(
+    api_client: AuthenticatedClient,
+    dataset_version: "GetDatasetVersionOut",
+    dataset_files: List[UploadFile],
+    packaging_info_cache: Optional[Dict[str, DatasetPackagingInfo]] = None,
+    resume: bool = False,
+    attempt: int = 0,
+):
+    # Small uploads are packaged in memory if the memory budget allows, others in a working directory.
+    # A resumed upload continues from the checkpoint of its working directory, without the uploaded files.
+    # attempt counts the times the job was resumed on its own after a failure.
+    upload_size = get_upload_size(dataset_files)
+    in_memory_reserved = 0
+    if upload_size < settings.in_memory_max_bytes and not resume:
+        in_memory_reserved = memory_budget.acquire(IN_MEMORY_PACKAGING_FACTOR * max(upload_size, 1), blocking=False)
+    in_memory = in_memory_reserved > 0
+    checkpoint = None
+
+    try:
         # Mark the dataset version as encrypting
-        update_dataset_version.sync(
+        call_sync(
+            update_dataset_version,
             client=api_client,
             dataset_version_id=dataset_version.id,
-            json_body=UpdateDatasetVersionIn(state=DatasetVersionState.ENCRYPTING),
+            json_body=sail_models.UpdateDatasetVersionIn(state=sail_models.DatasetVersionState.ENCRYPTING),
         )
 
         # GetConnectionStringForDatasetVersion
-        connection_string_req = get_dataset_version_connection_string.sync(
-            client=api_client, dataset_version_id=dataset_version.id
+        connection_string_req = call_sync(
+            get_dataset_version_connection_string, client=api_client, dataset_version_id=dataset_version.id
         )
-        assert type(connection_string_req) == GetDatasetVersionConnectionStringOut
+        assert type(connection_string_req) == sail_models.GetDatasetVersionConnectionStringOut
         connection_string = connection_string_req.connection_string
 
-        # Get the dataset for the dataset version
+        # Get the dataset, federation, key and data model, reusing them across versions of the same dataset
         dataset_id = dataset_version.dataset_id
-        dataset = get_dataset.sync(client=api_client, dataset_id=dataset_id)
-        assert type(dataset) == GetDatasetOut
-
-        # Get the data federation
-        data_federation_list = get_all_data_federations.sync(client=api_client)
-        assert type(data_federation_list) == GetMultipleDataFederationOut
-        if not data_federation_list.data_federations:
-            raise Exception("No data federation found for the dataset.")
-        data_federation = data_federation_list.data_federations[0]  # type: ignore
-
-        # GetEncryptionKeyForDataset
-        encryption_key_response = get_dataset_key.sync(
-            client=api_client, data_federation_id=str(data_federation.id), dataset_id=dataset_id
-        )
-        assert type(encryption_key_response) == DatasetEncryptionKeyOut
-        encryption_key = encryption_key_response.dataset_key
+        if packaging_info_cache is not None and dataset_id in packaging_info_cache:
+            packaging_info = packaging_info_cache[dataset_id]
+        else:
+            packaging_info = get_dataset_packaging_info(api_client, dataset_id)
+            if packaging_info_cache is not None:
+                packaging_info_cache[dataset_id] = packaging_info
 
         # Create a dataset header
-        dataset_header = {}
+        dataset_header: Dict[str, Any] = {}
         dataset_header["dataset_id"] = dataset_id
-        dataset_header["dataset_name"] = dataset.name
-        dataset_header["data_federation_id"] = data_federation.id
-        dataset_header["data_federation_name"] = data_federation.name
+        dataset_header["dataset_name"] = packaging_info.dataset_name
+        dataset_header["data_federation_id"] = packaging_info.data_federation_id
+        dataset_header["data_federation_name"] = packaging_info.data_federation_name
         dataset_header["dataset_packaging_format"] = "csvv1"
 
-        # Create a zip package with the data files
-        data_content_zip_file = f"{working_dir}/data_content.zip"
-        create_zip_from_files(data_content_zip_file, local_files)
-
-        # Encrypt the data content zip file
-        nonce = os.urandom(12)
-        key = base64.b64decode(encryption_key)
-        tag = encrypt_file_in_place(data_content_zip_file, key, nonce)
-
-        # Create a file with name dataset_header.json
-        dataset_header_file = f"{working_dir}/dataset_header.json"
-        dataset_header["aes_tag"] = base64.b64encode(tag).decode("utf-8")
-        dataset_header["aes_nonce"] = base64.b64encode(nonce).decode("utf-8")
-        with open(dataset_header_file, "w") as f:
-            f.write(json.dumps(dataset_header))
-
-        # TODO: Get data model
-        data_model_id = data_federation.data_model_id
-        if type(data_model_id) != str:
-            raise Exception("No data model found for the data federation.")
-
-        data_model = get_data_model_info.sync(client=api_client, data_model_id=data_model_id)
-        if type(data_model) != GetDataModelOut:
-            raise Exception("Error parsing data model.")
-
-        # Fetch the current version of the data model
-        if type(data_model.current_version_id) is not str:
-            raise Exception("No current version found for the data model.")
-
-        data_model_full = get_data_model_version.sync(
-            client=api_client, data_model_version_id=data_model.current_version_id
-        )
-        if type(data_model_full) != GetDataModelVersionOut:
-            raise Exception("Error parsing data model version.")
-
-        data_model_txt = json.dumps(data_model_full.to_dict())
-
-        # Create a data_model zip file
-        data_model_file = f"{working_dir}/data_model.json"
-        data_model_zip_file = f"{working_dir}/data_model.zip"
-        with open(data_model_file, "w") as f:
-            f.write(data_model_txt)
-        create_zip_from_files(data_model_zip_file, [f"{working_dir}/data_model.json"])
-
-        # Create a zip file with the dataset header, data model and data content
-        big_zip_files = [dataset_header_file, data_model_zip_file, data_content_zip_file]
-        dataset_file = f"{working_dir}/dataset_{dataset_version.id}.zip"
-        create_zip_from_files(dataset_file, big_zip_files)
-
-        # Upload the zip file to the Azure File Share
-        with open(dataset_file, "rb") as f:
-            # Upload the files created tar file to Azure file share using the sas token
-            file_client = ShareFileClient.from_file_url(file_url=connection_string)
-            file_client.create_file(size=f.tell())
-            file_client.upload_file(f)
+        # Package the dataset and upload it to the Azure File Share
+        if in_memory:
+            try:
+                package = package_dataset_in_memory(dataset_version.id, dataset_files, packaging_info, dataset_header)
+            except content_encoding.DecodingLimitExceeded:
+                # A compressed file decodes to more than its hint, e.g. a gzip file of several members, it is
+                # packaged on disk instead where only the decoding limits apply
+                logger.info("Dataset version %s is larger than its hint, packaging it on disk", dataset_version.id)
+                memory_budget.release(in_memory_reserved)
+                in_memory_reserved = 0
+                in_memory = False
+                for dataset_file in dataset_files:
+                    dataset_file.file.seek(0)
+        if in_memory:
+            package_size = package.seek(0, os.SEEK_END)
+            package.seek(0)
+            upload_dataset_package(dataset_version.id, connection_string, package, package_size)
+        else:
+            if resume:
+                checkpoint = checkpoint_store.take(dataset_version.id)
+                if checkpoint is None:
+                    raise Exception(
+                        "The checkpoint of the dataset version expired or another job holds it, upload its files again."
+                    )
+            else:
+                checkpoint = checkpoint_store.create(dataset_version.id)
+            try:
+                package_and_upload_on_disk(
+                    dataset_version.id, connection_string, dataset_files, packaging_info, dataset_header, checkpoint
+                )
+            except Exception as exception:
+                delay = get_stage_retry_delay(checkpoint, attempt)
+                if delay is None:
+                    raise
+                logger.warning(
+                    "Upload of dataset version %s failed, resuming in %.1f seconds: %s",
+                    dataset_version.id,
+                    delay,
+                    exception,
+                )
+                progress_bus.publish(dataset_version.id, stage=progress.QUEUED)
+                raise RetryJobLater(
+                    delay, api_client, dataset_version, [], packaging_info_cache, resume=True, attempt=attempt + 1
+                )
 
         # Mark the dataset version as ready
-        update_dataset_version.sync(
+        call_sync(
+            update_dataset_version,
             client=api_client,
             dataset_version_id=dataset_version.id,
-            json_body=UpdateDatasetVersionIn(state=DatasetVersionState.ACTIVE),
+            json_body=sail_models.UpdateDatasetVersionIn(state=sail_models.DatasetVersionState.ACTIVE),
         )
+        progress_bus.publish(dataset_version.id, stage=progress.ACTIVE)
 
         # Delete the working directory
-        shutil.rmtree(working_dir)
+        if checkpoint is not None:
+            checkpoint_store.discard(checkpoint)
+    except RetryJobLater:
+        raise
     except Exception as e:
         # Mark the dataset version as failed
-        update_dataset_version.sync(
+        progress_bus.publish(dataset_version.id, stage=progress.ERROR)
+        call_sync(
+            update_dataset_version,
             client=api_client,
             dataset_version_id=dataset_version.id,
-            json_body=UpdateDatasetVersionIn(state=DatasetVersionState.ERROR),
+            json_body=sail_models.UpdateDatasetVersionIn(state=sail_models.DatasetVersionState.ERROR),
         )
-        # Delete the working directory
-        shutil.rmtree(working_dir)
         raise e
+    finally:
+        # The working directory of a failed job is kept to resume it once it only holds encrypted content, the
+        # plaintext of a job that failed before is never left on disk
+        if checkpoint is not None and checkpoint.get(checkpoints.ENCRYPTED) is None:
+            checkpoint_store.discard(checkpoint)
+        elif checkpoint is not None:
+            checkpoint.release()
+        for dataset_file in dataset_files:
+            dataset_file.file.close()
+        memory_budget.release(in_memory_reserved)
+
+
+def package_and_upload_on_disk(
+    dataset_version_id: str,
+    connection_string: str,
+    dataset_files: List[UploadFile],
+    packaging_info: DatasetPackagingInfo,
+    dataset_header: Dict[str, Any],
+    checkpoint: Checkpoint,
+):
+    """Package the dataset in the working directory of the checkpoint and upload it, after the last completed stage"""
+    # Every attempt starts over from the header built before packaging, in the format the job was staged for
+    dataset_header = dict(dataset_header)
+    staged = checkpoint.get(checkpoints.STAGED)
+    if staged["sharded"] if staged is not None else settings.shard_count > 1:
+        dataset_file = package_and_upload_dataset_shards(
+            dataset_version_id, connection_string, dataset_files, packaging_info, dataset_header, checkpoint
+        )
+    else:
+        dataset_file = package_dataset_on_disk(
+            dataset_version_id, dataset_files, packaging_info, dataset_header, checkpoint
+        )
+
+    if checkpoint.get(checkpoints.UPLOADED) is None:
+        with open(dataset_file, "rb") as f:
+            upload_dataset_package(dataset_version_id, connection_string, f, os.path.getsize(dataset_file))
+        checkpoint.complete(checkpoints.UPLOADED)
+
+
+def get_stage_retry_delay(checkpoint: Checkpoint, attempt: int) -> Optional[float]:
+    """
+    Get the delay before a failed job packaged on disk is resumed from its last completed stage, None if it must
+    fail instead. Only a job whose content is encrypted is resumed, the stages before only read local files and
+    their failures are not transient.
+
+    :param checkpoint: the checkpoint of the job
+    :type checkpoint: Checkpoint
+    :param attempt: the times the job was resumed so far
+    :type attempt: int
+    :return: the delay in seconds, doubled on every retry
+    :rtype: Optional[float]
+    """
+    if (
+        attempt >= settings.stage_retries
+        or checkpoint.get(checkpoints.ENCRYPTED) is None
+        or job_scheduler.is_shutdown()
+    ):
+        return None
+    return settings.stage_retry_delay * 2**attempt
+
+
+def encrypt_and_upload_multiple(
+    api_client: AuthenticatedClient,
+    dataset_uploads: List[Tuple["GetDatasetVersionOut", List[UploadFile]]],
+    resume: bool = False,
+    attempt: int = 0,
+):
+    """
+    Encrypt and upload several dataset versions in one job, sharing the dataset lookups between them. The
+    versions to resume after a delay are run again together, in a job of their own.
+
+    :param api_client: client for the SAIL API service
+    :type api_client: AuthenticatedClient
+    :param dataset_uploads: dataset versions with the files to upload for each of them
+    :type dataset_uploads: List[Tuple[GetDatasetVersionOut, List[UploadFile]]]
+    :param resume: resume the versions from their checkpoint
+    :type resume: bool
+    :param attempt: the times the versions were resumed so far
+    :type attempt: int
+    """
+    packaging_info_cache: Dict[str, DatasetPackagingInfo] = {}
+    failed_dataset_version_ids: List[str] = []
+    retried_dataset_uploads: List[Tuple["GetDatasetVersionOut", List[UploadFile]]] = []
+    retry_delay = 0.0
+    for dataset_version, dataset_files in dataset_uploads:
+        # A failed version is already marked as ERROR, carry on with the rest of the batch
+        try:
+            encrypt_and_upload(api_client, dataset_version, dataset_files, packaging_info_cache, resume, attempt)
+        except RetryJobLater as retry:
+            retried_dataset_uploads.append((dataset_version, []))
+            retry_delay = max(retry_delay, retry.delay)
+        except Exception:
+            failed_dataset_version_ids.append(dataset_version.id)
+
+    if retried_dataset_uploads:
+        if failed_dataset_version_ids:
+            logger.error("Failed to upload dataset versions: %s", ", ".join(failed_dataset_version_ids))
+        raise RetryJobLater(retry_delay, api_client, retried_dataset_uploads, resume=True, attempt=attempt + 1)
+    if failed_dataset_version_ids:
+        raise Exception(f"Failed to upload dataset versions: {', '.join(failed_dataset_version_ids)}")
+
+
+def detach_upload_files(dataset_files: List[UploadFile]) -> List[UploadFile]:
+    """
+    Take over the uploaded files so that they stay open for the scheduled job, the request form closes
+    its files as soon as the response is sent. The job is responsible for closing the returned files, they are
+    closed here if one of them can not be taken over.
+
+    :param dataset_files: the files of the request
+    :type dataset_files: List[UploadFile]
+    :return: the same files, no longer owned by the request
+    :rtype: List[UploadFile]
+    """
+    detached_files: List[UploadFile] = []
+    try:
+        for dataset_file in dataset_files:
+            keep_spooled_file_in_memory(dataset_file.file)
+            detached_files.append(
+                UploadFile(file=dataset_file.file, filename=dataset_file.filename, headers=dataset_file.headers)
+            )
+            dataset_file.file = io.BytesIO()
+    except Exception:
+        for detached_file in detached_files:
+            detached_file.file.close()
+        raise
+    return detached_files
+
+
+def keep_spooled_file_in_memory(file: BinaryIO):
+    """
+    Account the memory of a small uploaded file kept in memory until its job runs, or move it to disk if the
+    memory budget is short. The memory is given back when the file is garbage collected.
+    """
+    if getattr(file, "_rolled", True):
+        return
+    size = file.seek(0, os.SEEK_END)
+    file.seek(0)
+    if not size:
+        return
+    if memory_budget.acquire(size, blocking=False):
+        weakref.finalize(file, memory_budget.release, size)
+    else:
+        file.rollover()  # type: ignore
+
+
+def get_upload_size(dataset_files: List[UploadFile]) -> int:
+    """Get the total size in bytes of the uploaded files, once decoded for the compressed ones"""
+    size = 0
+    for dataset_file in dataset_files:
+        encoding = content_encoding.get_content_encoding(
+            dataset_file.file, dataset_file.headers.get("content-encoding")
+        )
+        if encoding:
+            size += content_encoding.get_decoded_size_hint(dataset_file.file, encoding)
+        else:
+            dataset_file.file.seek(0, os.SEEK_END)
+            size += dataset_file.file.tell()
+            dataset_file.file.seek(0)
+    return size
+
+
+def check_content_encodings(dataset_files: List[UploadFile]):
+    """
+    Check that every uploaded file is either plain or compressed with a supported Content-Encoding
+
+    :param dataset_files: the files of the request
+    :type dataset_files: List[UploadFile]
+    :raises HTTPException: 415 if an encoding is not supported, 400 if a file does not match its encoding
+    """
+    supported_encodings = content_encoding.get_supported_encodings()
+    for dataset_file in dataset_files:
+        encoding = dataset_file.headers.get("content-encoding", content_encoding.IDENTITY).strip().lower()
+        if encoding not in supported_encodings:
+            raise HTTPException(
+                status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+                detail=f"Unsupported Content-Encoding {encoding} for {dataset_file.filename}.",
+                headers={"Accept-Encoding": ", ".join(supported_encodings)},
+            )
+        try:
+            content_encoding.get_content_encoding(dataset_file.file, encoding)
+        except Exception as exception:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST, detail=f"{exception}: {dataset_file.filename}."
+            )
+
+
+def open_dataset_file(dataset_file: UploadFile, max_decoded_bytes: Optional[int] = None) -> BinaryIO:
+    """
+    Get a reader of the content of an uploaded file, decoding it on the fly if it was sent compressed
+
+    :param dataset_file: the uploaded file
+    :type dataset_file: UploadFile
+    :param max_decoded_bytes: the most bytes a compressed file may decode to, on top of the decoding limits
+    :type max_decoded_bytes: Optional[int]
+    :return: the file or its decoding reader
+    :rtype: BinaryIO
+    """
+    encoding = content_encoding.get_content_encoding(dataset_file.file, dataset_file.headers.get("content-encoding"))
+    if encoding:
+        return content_encoding.DecodingReader(dataset_file.file, encoding, max_decoded_bytes)  # type: ignore
+    return dataset_file.file
+
+
+def cancel_upload_job(dataset_version_ids: List[str], dataset_files: List[UploadFile]):
+    """Release the claimed dataset versions and close the detached files of an upload job that was not queued"""
+    for dataset_version_id in dataset_version_ids:
+        in_flight_jobs.release(dataset_version_id)
+    for dataset_file in dataset_files:
+        dataset_file.file.close()
+
+
+def schedule_upload_job(
+    api_client: AuthenticatedClient,
+    dataset_version_ids: List[str],
+    tenant: str,
+    size: int,
+    dataset_files: List[UploadFile],
+    function: Callable[..., Any],
+    *args,
+):
+    """
+    Queue an upload job on the job scheduler, fairly shared between the data owners. The dataset versions
+    must be claimed in in_flight_jobs, they are released when the job is over or could not be queued. If the
+    server shuts down without the job, its dataset versions are marked as ERROR so that they can be uploaded again.
+
+    :param api_client: client for the SAIL API service
+    :type api_client: AuthenticatedClient
+    :param dataset_version_ids: the dataset versions uploaded by the job
+    :type dataset_version_ids: List[str]
+    :param tenant: the owner the job is charged to
+    :type tenant: str
+    :param size: the size of the uploaded files in bytes
+    :type size: int
+    :param dataset_files: the detached files the job takes over, closed here if the job could not be queued
+    :type dataset_files: List[UploadFile]
+    :param function: the job to run
+    :type function: Callable[..., Any]
+    :raises HTTPException: 503 or 429 with a Retry-After header if the scheduler is saturated
+    """
+
+    def release_dataset_versions():
+        for dataset_version_id in dataset_version_ids:
+            in_flight_jobs.release(dataset_version_id)
+
+    def run_job(*args, **kwargs):
+        retried = False
+        try:
+            # Runs in the context of the request, so the job span continues the trace of the request
+            with tracer.start_span("upload_job", **{"dataset_version.ids": dataset_version_ids, "upload.size": size}):
+                function(*args, **kwargs)
+        except RetryJobLater:
+            # The scheduler runs the job again later, the dataset versions stay claimed until then
+            retried = True
+            raise
+        finally:
+            if not retried:
+                release_dataset_versions()
+
+    def abandon_job():
+        for dataset_version_id in dataset_version_ids:
+            progress_bus.publish(dataset_version_id, stage=progress.ERROR)
+            try:
+                call_sync(
+                    update_dataset_version,
+                    client=api_client,
+                    dataset_version_id=dataset_version_id,
+                    json_body=sail_models.UpdateDatasetVersionIn(state=sail_models.DatasetVersionState.ERROR),
+                )
+            except Exception:
+                logger.exception("Failed to mark the abandoned upload of dataset version %s", dataset_version_id)
+        release_dataset_versions()
+
+    # Published before submitting, so that it never overwrites the progress of a job that started right away
+    for dataset_version_id in dataset_version_ids:
+        progress_bus.publish(dataset_version_id, stage=progress.QUEUED)
+
+    try:
+        job_scheduler.submit(tenant, size, run_job, *args, on_abandoned=abandon_job)
+    except JobSchedulerSaturated as exception:
+        for dataset_version_id in dataset_version_ids:
+            progress_bus.discard(dataset_version_id)
+        cancel_upload_job(dataset_version_ids, dataset_files)
+        raise HTTPException(
+            status_code=exception.status_code,
+            detail=str(exception),
+            headers={"Retry-After": str(exception.retry_after)},
+        )
 
 
 @router.post(
@@ -240,28 +1190,228 @@ def encrypt_and_upload(
     operation_id="upload_dataset",
 )
 async def upload_dataset(
-    background_tasks: BackgroundTasks,
     dataset_files: List[UploadFile] = File(description="application/json"),
     dataset_version_id: PyObjectId = Query(description="Dataset Version Id"),
     current_user_token=Depends(get_current_user),
 ):
-    api_client = AuthenticatedClient(
-        base_url=get_secret("SAIL_API_SERVICE_URL"),
-        timeout=60,
-        raise_on_unexpected_status=True,
-        verify_ssl=True,
-        token=current_user_token,
-        follow_redirects=False,
-    )
+    check_content_encodings(dataset_files)
+    api_client = get_api_client(current_user_token)
 
-    # Get the dataset version
-    dataset_version = get_dataset_version.sync(client=api_client, dataset_version_id=str(dataset_version_id))
-    if type(dataset_version) != GetDatasetVersionOut:
+    # Get the dataset version without blocking the event loop
+    dataset_version = await call_async(
+        get_dataset_version, client=api_client, dataset_version_id=str(dataset_version_id)
+    )
+    if type(dataset_version) != sail_models.GetDatasetVersionOut:
         raise HTTPException(status_code=500, detail="Error parsing dataset version.")
 
     # Upload only if the dataset version is in the NOT_UPLOAD state
-    if dataset_version.state != DatasetVersionState.NOT_UPLOADED:
+    if dataset_version.state != sail_models.DatasetVersionState.NOT_UPLOADED:
         raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Dataset version is not in NOT_UPLOAD state.")
 
-    background_tasks.add_task(encrypt_and_upload, api_client, dataset_version, dataset_files)
+    # A retry or a double click while the first job is queued or running follows that job instead
+    if not in_flight_jobs.claim(dataset_version.id):
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="An upload of the dataset version is already in progress.",
+            headers={"Location": f"/upload-progress/{dataset_version.id}"},
+        )
+
+    # Nothing may fail between the claim and the job without releasing it, the version would be stuck
+    detached_files: List[UploadFile] = []
+    try:
+        detached_files = detach_upload_files(dataset_files)
+        upload_size = get_upload_size(detached_files)
+    except Exception:
+        cancel_upload_job([dataset_version.id], detached_files)
+        raise
+
+    schedule_upload_job(
+        api_client,
+        [dataset_version.id],
+        dataset_version.organization.id,
+        upload_size,
+        detached_files,
+        encrypt_and_upload,
+        api_client,
+        dataset_version,
+        detached_files,
+    )
     return Response(status_code=status.HTTP_202_ACCEPTED)
+
+
+@router.post(
+    path="/retry-upload",
+    description="Resume the failed upload of a dataset version from its last completed stage",
+    response_description="Dataset Id",
+    response_model_by_alias=False,
+    status_code=status.HTTP_202_ACCEPTED,
+    operation_id="retry_upload",
+)
+async def retry_upload(
+    dataset_version_id: PyObjectId = Query(description="Dataset Version Id"),
+    current_user_token=Depends(get_current_user),
+):
+    api_client = get_api_client(current_user_token)
+
+    # Get the dataset version without blocking the event loop
+    dataset_version = await call_async(
+        get_dataset_version, client=api_client, dataset_version_id=str(dataset_version_id)
+    )
+    if type(dataset_version) != sail_models.GetDatasetVersionOut:
+        raise HTTPException(status_code=500, detail="Error parsing dataset version.")
+
+    # Only a failed upload can be resumed
+    if dataset_version.state != sail_models.DatasetVersionState.ERROR:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Dataset version is not in ERROR state.")
+
+    # The checkpoint is kept on the disk of the instance that ran the failed job, until it expires
+    checkpoint = await run_in_threadpool(checkpoint_store.get, dataset_version.id)
+    staged = checkpoint.get(checkpoints.STAGED) if checkpoint is not None else None
+    if checkpoint is None or staged is None or checkpoint.get(checkpoints.ENCRYPTED) is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="No checkpoint of the dataset version to resume from, upload its files again.",
+        )
+
+    if not in_flight_jobs.claim(dataset_version.id):
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="An upload of the dataset version is already in progress.",
+            headers={"Location": f"/upload-progress/{dataset_version.id}"},
+        )
+
+    schedule_upload_job(
+        api_client,
+        [dataset_version.id],
+        dataset_version.organization.id,
+        staged["bytes"],
+        [],
+        encrypt_and_upload,
+        api_client,
+        dataset_version,
+        [],
+        None,
+        True,
+    )
+    return Response(status_code=status.HTTP_202_ACCEPTED)
+
+
+@router.post(
+    path="/upload-datasets",
+    description="Upload new data for multiple dataset versions to File Share",
+    response_description="Upload result for each dataset version",
+    response_model=UploadMultipleDatasetVersionsOut,
+    response_model_by_alias=False,
+    status_code=status.HTTP_202_ACCEPTED,
+    operation_id="upload_multiple_datasets",
+)
+async def upload_multiple_datasets(
+    dataset_files: List[UploadFile] = File(description="Files of all the dataset versions in the order of the ids"),
+    dataset_version_ids: List[PyObjectId] = Query(description="Dataset Version Ids"),
+    files_per_version: List[int] = Query(description="Number of files belonging to each dataset version"),
+    current_user_token=Depends(get_current_user),
+) -> UploadMultipleDatasetVersionsOut:
+    if len(files_per_version) != len(dataset_version_ids):
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail="files_per_version must have one entry for each dataset version.",
+        )
+    if any(count < 1 for count in files_per_version) or sum(files_per_version) != len(dataset_files):
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail="files_per_version does not match the number of dataset files.",
+        )
+    check_content_encodings(dataset_files)
+
+    api_client = get_api_client(current_user_token)
+
+    # Get all the dataset versions in one batch
+    unique_dataset_version_ids = list(
+        dict.fromkeys(str(dataset_version_id) for dataset_version_id in dataset_version_ids)
+    )
+    dataset_version_list = await asyncio.gather(
+        *[
+            call_async(get_dataset_version, client=api_client, dataset_version_id=dataset_version_id)
+            for dataset_version_id in unique_dataset_version_ids
+        ],
+        return_exceptions=True,
+    )
+    # Fail the whole request fast while the SAIL API service is down, rather than every version on its own
+    for dataset_version in dataset_version_list:
+        if isinstance(dataset_version, CircuitOpen):
+            raise dataset_version
+    dataset_versions = dict(zip(unique_dataset_version_ids, dataset_version_list))
+
+    results: List[UploadDatasetVersionResult] = []
+    dataset_uploads: List[Tuple[GetDatasetVersionOut, List[UploadFile]]] = []
+    scheduled_dataset_version_ids = set()
+    uploads_per_owner: Dict[str, List[Tuple[GetDatasetVersionOut, List[UploadFile]]]] = {}
+    upload_size_per_owner: Dict[str, int] = {}
+    file_index = 0
+    # Nothing may fail between the claims and the jobs without releasing them, the versions would be stuck
+    try:
+        for dataset_version_id, file_count in zip(dataset_version_ids, files_per_version):
+            version_files = dataset_files[file_index : file_index + file_count]
+            file_index += file_count
+
+            dataset_version = dataset_versions[str(dataset_version_id)]
+            if str(dataset_version_id) in scheduled_dataset_version_ids:
+                detail = "Dataset version is repeated in the request."
+            elif type(dataset_version) != sail_models.GetDatasetVersionOut:
+                detail = "Error parsing dataset version."
+            elif dataset_version.state != sail_models.DatasetVersionState.NOT_UPLOADED:
+                detail = "Dataset version is not in NOT_UPLOAD state."
+            elif not in_flight_jobs.claim(dataset_version.id):
+                detail = "An upload of the dataset version is already in progress."
+            else:
+                detail = None
+                scheduled_dataset_version_ids.add(str(dataset_version_id))
+                try:
+                    dataset_uploads.append((dataset_version, detach_upload_files(version_files)))
+                except Exception:
+                    in_flight_jobs.release(dataset_version.id)
+                    raise
+
+            results.append(
+                UploadDatasetVersionResult(
+                    dataset_version_id=dataset_version_id, accepted=detail is None, detail=detail
+                )
+            )
+
+        # Schedule one packaging job per data owner, so that each job is charged to the tenant it uploads for
+        for dataset_version, version_files in dataset_uploads:
+            owner_id = dataset_version.organization.id
+            uploads_per_owner.setdefault(owner_id, []).append((dataset_version, version_files))
+            upload_size_per_owner[owner_id] = upload_size_per_owner.get(owner_id, 0) + get_upload_size(version_files)
+    except Exception:
+        for dataset_version, version_files in dataset_uploads:
+            cancel_upload_job([dataset_version.id], version_files)
+        raise
+
+    rejection: Optional[HTTPException] = None
+    for organization_id, owner_uploads in uploads_per_owner.items():
+        try:
+            schedule_upload_job(
+                api_client,
+                [dataset_version.id for dataset_version, _ in owner_uploads],
+                organization_id,
+                upload_size_per_owner[organization_id],
+                [dataset_file for _, version_files in owner_uploads for dataset_file in version_files],
+                encrypt_and_upload_multiple,
+                api_client,
+                owner_uploads,
+            )
+        except HTTPException as exception:
+            # The jobs of the other owners may be queued already, only the versions of this one are rejected
+            rejection = exception
+            rejected_ids = {str(dataset_version.id) for dataset_version, _ in owner_uploads}
+            for result in results:
+                if result.accepted and str(result.dataset_version_id) in rejected_ids:
+                    result.accepted = False
+                    result.detail = str(exception.detail)
+
+    # With no job queued at all, the caller gets the Retry-After of the scheduler
+    if rejection is not None and not any(result.accepted for result in results):
+        raise rejection
+
+    return UploadMultipleDatasetVersionsOut(results=results)
@@ -0,0 +1,43 @@
+# -------------------------------------------------------------------------------
+# Engineering
+# metrics.py
+# -------------------------------------------------------------------------------
+"""APIs to expose the runtime metrics of the upload service"""
+# -------------------------------------------------------------------------------
+# Copyright (C) 2022 Secure Ai Labs, Inc. All Rights Reserved.
+# Private and Confidential. Internal Use Only.
+#     This software contains proprietary information which shall not
+#     be reproduced or transferred to other documents and shall not
+#     be disclosed to others for any purpose without
+#     prior written permission of Secure Ai Labs, Inc.
+# -------------------------------------------------------------------------------
+
+from fastapi import APIRouter, status
+
+from app.models.metrics import GetMetricsOut
+from app.utils import sail_api
+from app.utils.event_loop_monitor import event_loop_monitor
+from app.utils.job_scheduler import job_scheduler
+from app.utils.memory_budget import memory_budget
+from app.utils.tracing import tracer
+
+router = APIRouter()
+
+
+@router.get(
+    path="/metrics",
+    description="Get the queue depths, wait times and other runtime metrics of the upload jobs",
+    response_description="Runtime metrics of the service",
+    response_model=GetMetricsOut,
+    response_model_by_alias=False,
+    status_code=status.HTTP_200_OK,
+    operation_id="get_metrics",
+)
+async def get_metrics() -> GetMetricsOut:
+    return GetMetricsOut(
+        job_scheduler=job_scheduler.get_metrics(),
+        event_loop=event_loop_monitor.get_metrics(),
+        tracing=tracer.get_metrics(),
+        memory=memory_budget.get_metrics(),
+        sail_api=sail_api.get_metrics(),
+    )
@@ -0,0 +1,71 @@
+# -------------------------------------------------------------------------------
+# Engineering
+# upload_progress.py
+# -------------------------------------------------------------------------------
+"""APIs to follow the progress of the dataset upload jobs"""
+# -------------------------------------------------------------------------------
+# Copyright (C) 2022 Secure Ai Labs, Inc. All Rights Reserved.
+# Private and Confidential. Internal Use Only.
+#     This software contains proprietary information which shall not
+#     be reproduced or transferred to other documents and shall not
+#     be disclosed to others for any purpose without
+#     prior written permission of Secure Ai Labs, Inc.
+# -------------------------------------------------------------------------------
+
+import json
+from typing import Any, AsyncIterator, Dict
+
+from fastapi import APIRouter, Depends, HTTPException, Path, status
+from fastapi.responses import StreamingResponse
+
+from app.api.dataset_upload import get_api_client, get_current_user, get_dataset_version, sail_models
+from app.models.common import PyObjectId
+from app.utils.progress import progress_bus
+from app.utils.sail_api import call_async
+from app.utils.settings import settings
+
+router = APIRouter()
+
+
+def format_progress_event(progress: Dict[str, Any]) -> str:
+    """Format the progress of a job as a Server-Sent Event"""
+    return f"event: progress\ndata: {json.dumps(progress)}\n\n"
+
+
+@router.get(
+    path="/upload-progress/{dataset_version_id}",
+    description="Stream the stage and bytes processed of a dataset version upload as Server-Sent Events",
+    response_description="text/event-stream of progress events, closed once the upload is ACTIVE or ERROR",
+    response_class=StreamingResponse,
+    status_code=status.HTTP_200_OK,
+    operation_id="stream_upload_progress",
+)
+async def stream_upload_progress(
+    dataset_version_id: PyObjectId = Path(description="Dataset Version Id"),
+    current_user_token=Depends(get_current_user),
+):
+    # Check the user can see the dataset version, once per stream instead of on every poll
+    api_client = get_api_client(current_user_token)
+    dataset_version = await call_async(
+        get_dataset_version, client=api_client, dataset_version_id=str(dataset_version_id)
+    )
+    if type(dataset_version) != sail_models.GetDatasetVersionOut:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Dataset version not found.")
+
+    async def progress_events() -> AsyncIterator[str]:
+        if progress_bus.get(dataset_version.id) is None:
+            # No job for this version on this instance, report the state known to the API service
+            yield format_progress_event({"stage": dataset_version.state.value, "bytes_processed": 0, "bytes_total": 0})
+            return
+
+        async for progress in progress_bus.subscribe(dataset_version.id, settings.progress_keepalive_interval):
+            if progress is None:
+                yield ": keepalive\n\n"
+            else:
+                yield format_progress_event(progress)
+
+    return StreamingResponse(
+        progress_events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
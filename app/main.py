@@ -12,6 +12,7 @@
 #     prior written permission of Secure Ai Labs, Inc.
 # -------------------------------------------------------------------------------
 
+import os
 import traceback
 
 import fastapi.openapi.utils as utils
@@ -22,14 +23,25 @@ from fastapi.middleware.cors import CORSMiddleware
 from fastapi.openapi.docs import get_swagger_ui_html
 from fastapi.requests import Request
 from fastapi.responses import JSONResponse
-from fastapi.staticfiles import StaticFiles
+from starlette.concurrency import run_in_threadpool
 
 # from fastapi_responses import custom_openapi
 from pydantic import BaseModel, Field, StrictStr
 
-from app.api import dataset_upload
+from app.api import dataset_upload, metrics, upload_progress
 from app.models.common import PyObjectId
+from app.utils.background_couroutines import add_async_task
+from app.utils.checkpoints import checkpoint_store
+from app.utils.crypto import get_crypto_backend
+from app.utils.event_loop_monitor import event_loop_monitor
+from app.utils.job_scheduler import job_scheduler
+from app.utils.lazy_import import warm_up_lazy_imports
+from app.utils.resilience import CircuitOpen
+from app.utils.sail_api import close_async_http_client
 from app.utils.secrets import get_secret
+from app.utils.settings import settings
+from app.utils.static_files import PrecompressedStaticFiles
+from app.utils.tracing import TracingMiddleware, tracer
 
 server = FastAPI(
     title="sail-dataset-upload",
@@ -46,6 +58,12 @@ origins = [
 
 # Add all the API services here exposed to the public
 server.include_router(dataset_upload.router)
+server.include_router(metrics.router)
+server.include_router(upload_progress.router)
+
+# Static files for the documentation, precompressed at build time
+static_files = PrecompressedStaticFiles(directory=os.path.join(os.path.dirname(__file__), "static"))
+server.mount("/static", static_files, name="static")
 
 server.add_middleware(
     CORSMiddleware,
@@ -55,6 +73,38 @@ server.add_middleware(
     allow_headers=["*"],
 )
 
+# Outermost, so that the request span covers the whole request
+server.add_middleware(TracingMiddleware)
+
+
+@server.on_event("startup")
+async def start_event_loop_monitor():
+    add_async_task(event_loop_monitor.run())
+
+
+@server.on_event("startup")
+async def warm_up():
+    # The imports and the choice of the crypto backend run on a worker thread so they never delay the server
+    # from accepting requests
+    if settings.warm_up_on_startup:
+        add_async_task(run_in_threadpool(warm_up_lazy_imports))
+        add_async_task(run_in_threadpool(get_crypto_backend))
+
+
+@server.on_event("startup")
+async def remove_expired_checkpoints():
+    # The working directories of the jobs that failed before a restart are kept until their checkpoint expires
+    add_async_task(run_in_threadpool(checkpoint_store.remove_expired))
+
+
+@server.on_event("shutdown")
+async def shutdown_job_scheduler():
+    # Like the background tasks uvicorn waits for, the accepted jobs finish before the server exits
+    await run_in_threadpool(job_scheduler.shutdown, settings.job_shutdown_timeout)
+    event_loop_monitor.stop()
+    await close_async_http_client()
+    tracer.flush()
+
 
 # Override the default validation error handler as it throws away a lot of information
 # about the schema of the request body.
@@ -71,6 +121,16 @@ async def validation_exception_handler(request, exc):
     return JSONResponse(status_code=422, content=jsonable_encoder(error))
 
 
+@server.exception_handler(CircuitOpen)
+async def circuit_open_exception_handler(request: Request, exc: CircuitOpen):
+    # The SAIL API service is down, the client is told when to try again instead of retrying right away
+    return JSONResponse(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        content={"detail": str(exc)},
+        headers={"Retry-After": str(exc.retry_after)},
+    )
+
+
 @server.exception_handler(Exception)
 async def server_error_exception_handler(request: Request, exc: Exception):
     """
@@ -106,11 +166,10 @@ async def custom_swagger_ui_html():
     if server.openapi_url is None:
         raise RequestValidationError("openapi_url must be provided to serve Swagger UI")
 
-    server.mount("/static", StaticFiles(directory="./app/static"), name="static")
     return get_swagger_ui_html(
         openapi_url=server.openapi_url,
         title=server.title + " - Swagger UI",
         oauth2_redirect_url=server.swagger_ui_oauth2_redirect_url,
-        swagger_js_url="/static/swagger-ui-bundle.js",
-        swagger_css_url="/static/swagger-ui.css",
+        swagger_js_url=static_files.url_for("/static", "swagger-ui-bundle.js"),
+        swagger_css_url=static_files.url_for("/static", "swagger-ui.css"),
     )
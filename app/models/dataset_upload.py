@@ -0,0 +1,29 @@
+# -------------------------------------------------------------------------------
+# Engineering
+# dataset_upload.py
+# -------------------------------------------------------------------------------
+"""Models used by the dataset upload APIs"""
+# -------------------------------------------------------------------------------
+# Copyright (C) 2022 Secure Ai Labs, Inc. All Rights Reserved.
+# Private and Confidential. Internal Use Only.
+#     This software contains proprietary information which shall not
+#     be reproduced or transferred to other documents and shall not
+#     be disclosed to others for any purpose without
+#     prior written permission of Secure Ai Labs, Inc.
+# -------------------------------------------------------------------------------
+
+from typing import List, Optional
+
+from pydantic import Field, StrictBool, StrictStr
+
+from app.models.common import PyObjectId, SailBaseModel
+
+
+class UploadDatasetVersionResult(SailBaseModel):
+    dataset_version_id: PyObjectId = Field(...)
+    accepted: StrictBool = Field(...)
+    detail: Optional[StrictStr] = Field(default=None)
+
+
+class UploadMultipleDatasetVersionsOut(SailBaseModel):
+    results: List[UploadDatasetVersionResult] = Field(...)
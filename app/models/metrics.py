@@ -0,0 +1,94 @@
+# -------------------------------------------------------------------------------
+# Engineering
+# metrics.py
+# -------------------------------------------------------------------------------
+"""Models for the runtime metrics of the dataset upload service"""
+# -------------------------------------------------------------------------------
+# Copyright (C) 2022 Secure Ai Labs, Inc. All Rights Reserved.
+# Private and Confidential. Internal Use Only.
+#     This software contains proprietary information which shall not
+#     be reproduced or transferred to other documents and shall not
+#     be disclosed to others for any purpose without
+#     prior written permission of Secure Ai Labs, Inc.
+# -------------------------------------------------------------------------------
+
+from typing import Dict
+
+from pydantic import BaseModel, Field, StrictFloat, StrictInt, StrictStr
+
+
+class TenantJobMetrics(BaseModel):
+    queued: StrictInt = Field(...)
+    running: StrictInt = Field(...)
+    at_running_cap: StrictInt = Field(...)
+
+
+class WaitTimeMetrics(BaseModel):
+    count: StrictInt = Field(...)
+    mean: StrictFloat = Field(...)
+    p50: StrictFloat = Field(...)
+    p95: StrictFloat = Field(...)
+    max: StrictFloat = Field(...)
+
+
+class JobSchedulerMetrics(BaseModel):
+    workers: StrictInt = Field(...)
+    paused_seconds: StrictFloat = Field(...)
+    running: StrictInt = Field(...)
+    queued: StrictInt = Field(...)
+    delayed: StrictInt = Field(...)
+    queued_per_lane: Dict[str, StrictInt] = Field(...)
+    tenants: TenantJobMetrics = Field(...)
+    completed_jobs: StrictInt = Field(...)
+    failed_jobs: StrictInt = Field(...)
+    retried_jobs: StrictInt = Field(...)
+    rejected_jobs: Dict[str, StrictInt] = Field(...)
+    wait_time_seconds: WaitTimeMetrics = Field(...)
+
+
+class EventLoopMetrics(BaseModel):
+    lag_seconds: StrictFloat = Field(...)
+    lag_p99_seconds: StrictFloat = Field(...)
+    max_lag_seconds: StrictFloat = Field(...)
+    blocked_count: StrictInt = Field(...)
+    threshold_seconds: float = Field(...)
+
+
+class TracingMetrics(BaseModel):
+    exported_spans: StrictInt = Field(...)
+    dropped_spans: StrictInt = Field(...)
+    queued_spans: StrictInt = Field(...)
+
+
+class MemoryBudgetMetrics(BaseModel):
+    limit_bytes: StrictInt = Field(...)
+    in_use_bytes: StrictInt = Field(...)
+    pooled_bytes: StrictInt = Field(...)
+    peak_bytes: StrictInt = Field(...)
+    waits: StrictInt = Field(...)
+    shrinks: StrictInt = Field(...)
+    rejections: StrictInt = Field(...)
+    pool_hits: StrictInt = Field(...)
+
+
+class CircuitBreakerMetrics(BaseModel):
+    state: StrictStr = Field(...)
+    consecutive_failures: StrictInt = Field(...)
+    open_count: StrictInt = Field(...)
+    rejected_calls: StrictInt = Field(...)
+    retry_after: StrictInt = Field(...)
+
+
+class SailApiMetrics(BaseModel):
+    circuit_breaker: CircuitBreakerMetrics = Field(...)
+    calls: StrictInt = Field(...)
+    retries: StrictInt = Field(...)
+    retries_exhausted: StrictInt = Field(...)
+
+
+class GetMetricsOut(BaseModel):
+    job_scheduler: JobSchedulerMetrics = Field(...)
+    event_loop: EventLoopMetrics = Field(...)
+    tracing: TracingMetrics = Field(...)
+    memory: MemoryBudgetMetrics = Field(...)
+    sail_api: SailApiMetrics = Field(...)
@@ -0,0 +1,232 @@
+# -------------------------------------------------------------------------------
+# Engineering
+# checkpoints.py
+# -------------------------------------------------------------------------------
+"""Checkpoints of the upload jobs packaged on disk, to resume them from their last completed stage"""
+# -------------------------------------------------------------------------------
+# Copyright (C) 2022 Secure Ai Labs, Inc. All Rights Reserved.
+# Private and Confidential. Internal Use Only.
+#     This software contains proprietary information which shall not
+#     be reproduced or transferred to other documents and shall not
+#     be disclosed to others for any purpose without
+#     prior written permission of Secure Ai Labs, Inc.
+# -------------------------------------------------------------------------------
+
+import fcntl
+import json
+import os
+import shutil
+import threading
+import time
+from typing import Any, Dict, Optional
+
+from app.utils.settings import settings
+
+# Stages a job checkpoints, in order. The shards of a sharded package are checkpointed one by one once uploaded.
+STAGED = "staged"
+ENCRYPTED = "encrypted"
+PACKAGED = "packaged"
+UPLOADED = "uploaded"
+
+CHECKPOINT_FILE_NAME = "checkpoint.json"
+
+
+def get_shard_uploaded_stage(shard_index: int) -> str:
+    return f"{UPLOADED}:{shard_index}"
+
+
+class Checkpoint:
+    """
+    The stages of a job completed in its working directory, with what the next stages need from them: the
+    staged files, the nonce and tag of the encrypted content, the package. It is saved in the working
+    directory after every stage, so that it outlives the job and the process.
+
+    The encryption key is never saved, a resumed job fetches it again. File names are relative to the
+    working directory. The job using the working directory holds a lock on it, so that no other job, in this
+    process or another one, uses or deletes it meanwhile.
+    """
+
+    def __init__(self, dataset_version_id: str, working_dir: str, stages: Optional[Dict[str, Dict[str, Any]]] = None):
+        self.dataset_version_id = dataset_version_id
+        self.working_dir = working_dir
+        self.stages: Dict[str, Dict[str, Any]] = stages or {}
+        self._lock = threading.Lock()
+        self._working_dir_fd: Optional[int] = None
+
+    def acquire(self) -> bool:
+        """
+        Lock the working directory for a job
+
+        :return: False if another job holds the lock or the directory was deleted
+        :rtype: bool
+        """
+        try:
+            working_dir_fd = os.open(self.working_dir, os.O_RDONLY)
+        except OSError:
+            return False
+        try:
+            fcntl.flock(working_dir_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(working_dir_fd)
+            return False
+        self._working_dir_fd = working_dir_fd
+        return True
+
+    def release(self):
+        """Unlock the working directory once the job is over"""
+        if self._working_dir_fd is not None:
+            os.close(self._working_dir_fd)
+            self._working_dir_fd = None
+
+    def get(self, stage: str) -> Optional[Dict[str, Any]]:
+        """Get what a stage recorded when it completed, None if it has not completed"""
+        with self._lock:
+            return self.stages.get(stage)
+
+    def complete(self, stage: str, **fields: Any) -> Dict[str, Any]:
+        """
+        Record a completed stage and save the checkpoint
+
+        :param stage: the stage completed
+        :type stage: str
+        :param fields: what the next stages need from it, JSON serializable
+        :type fields: Any
+        :return: the fields
+        :rtype: Dict[str, Any]
+        """
+        with self._lock:
+            self.stages[stage] = fields
+            self._save()
+        return fields
+
+    def save(self):
+        with self._lock:
+            self._save()
+
+    def get_path(self, file_name: str) -> str:
+        return os.path.join(self.working_dir, file_name)
+
+    def _save(self):
+        # Written aside and renamed, so that a crash never leaves a truncated checkpoint
+        checkpoint_file = self.get_path(CHECKPOINT_FILE_NAME)
+        with open(f"{checkpoint_file}.tmp", "w") as f:
+            json.dump({"dataset_version_id": self.dataset_version_id, "stages": self.stages}, f)
+        os.replace(f"{checkpoint_file}.tmp", checkpoint_file)
+
+    @classmethod
+    def load(cls, working_dir: str) -> Optional["Checkpoint"]:
+        """Load the checkpoint saved in a working directory, None if there is none"""
+        try:
+            with open(os.path.join(working_dir, CHECKPOINT_FILE_NAME)) as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return cls(saved["dataset_version_id"], working_dir, saved["stages"])
+
+
+class CheckpointStore:
+    """
+    Working directories of the jobs packaged on disk, one per job, named after the dataset version with a
+    random suffix so that the instances sharing the root never collide. The directory of a successful job is
+    deleted right away, the one of a failed job is kept with its checkpoint until it has not been updated for
+    the retention in seconds. The directory of a running job is locked and never expires.
+    """
+
+    def __init__(self, root: str, retention: float):
+        self.root = root
+        self.retention = retention
+        self._lock = threading.Lock()
+
+    def create(self, dataset_version_id: str) -> Checkpoint:
+        """
+        Create an empty working directory and checkpoint for a new job, locked until the job releases it
+
+        :param dataset_version_id: id of the dataset version packaged
+        :type dataset_version_id: str
+        :return: the checkpoint, with no completed stage
+        :rtype: Checkpoint
+        """
+        self.remove_expired()
+        working_dir = os.path.join(self.root, f"{os.path.basename(dataset_version_id)}-{os.urandom(8).hex()}")
+        os.makedirs(working_dir)
+        checkpoint = Checkpoint(dataset_version_id, working_dir)
+        checkpoint.acquire()
+        checkpoint.save()
+        return checkpoint
+
+    def get(self, dataset_version_id: str) -> Optional[Checkpoint]:
+        """Get the latest checkpoint kept for a dataset version, to read only, None if there is none or it expired"""
+        self.remove_expired()
+        working_dir = self._find_working_dir(dataset_version_id)
+        return Checkpoint.load(working_dir) if working_dir is not None else None
+
+    def take(self, dataset_version_id: str) -> Optional[Checkpoint]:
+        """
+        Lock the latest checkpoint kept for a dataset version, for a job to resume from it
+
+        :param dataset_version_id: id of the dataset version packaged
+        :type dataset_version_id: str
+        :return: the checkpoint, None if there is none, it expired or another job holds it
+        :rtype: Optional[Checkpoint]
+        """
+        self.remove_expired()
+        working_dir = self._find_working_dir(dataset_version_id)
+        if working_dir is None:
+            return None
+        checkpoint = Checkpoint(dataset_version_id, working_dir)
+        if not checkpoint.acquire():
+            return None
+        # Loaded once locked, the directory may have been updated or deleted in between
+        saved = Checkpoint.load(working_dir)
+        if saved is None:
+            checkpoint.release()
+            return None
+        checkpoint.stages = saved.stages
+        return checkpoint
+
+    def discard(self, checkpoint: Checkpoint):
+        """Delete the working directory of a checkpoint and release it"""
+        shutil.rmtree(checkpoint.working_dir, ignore_errors=True)
+        checkpoint.release()
+
+    def remove_expired(self):
+        """Delete the working directories whose checkpoint has not been updated for the retention, unless locked"""
+        expired_before = time.time() - self.retention
+        with self._lock:
+            try:
+                entries = list(os.scandir(self.root))
+            except FileNotFoundError:
+                return
+            for entry in entries:
+                try:
+                    updated_at = os.path.getmtime(os.path.join(entry.path, CHECKPOINT_FILE_NAME))
+                except OSError:
+                    continue
+                if updated_at < expired_before:
+                    # A job still running in the directory holds its lock, however long its stage takes
+                    checkpoint = Checkpoint(entry.name, entry.path)
+                    if checkpoint.acquire():
+                        self.discard(checkpoint)
+
+    def _find_working_dir(self, dataset_version_id: str) -> Optional[str]:
+        prefix = f"{os.path.basename(dataset_version_id)}-"
+        latest_working_dir = None
+        latest_updated_at = 0.0
+        try:
+            entries = list(os.scandir(self.root))
+        except FileNotFoundError:
+            return None
+        for entry in entries:
+            if not entry.name.startswith(prefix):
+                continue
+            try:
+                updated_at = os.path.getmtime(os.path.join(entry.path, CHECKPOINT_FILE_NAME))
+            except OSError:
+                continue
+            if latest_working_dir is None or updated_at > latest_updated_at:
+                latest_working_dir = entry.path
+                latest_updated_at = updated_at
+        return latest_working_dir
+
+
+checkpoint_store = CheckpointStore(root=os.path.join(os.getcwd(), "tmp"), retention=settings.checkpoint_retention)
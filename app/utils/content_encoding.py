@@ -0,0 +1,220 @@
+# -------------------------------------------------------------------------------
+# Engineering
+# content_encoding.py
+# -------------------------------------------------------------------------------
+"""Decode the compressed parts of the upload requests"""
+# -------------------------------------------------------------------------------
+# Copyright (C) 2022 Secure Ai Labs, Inc. All Rights Reserved.
+# Private and Confidential. Internal Use Only.
+#     This software contains proprietary information which shall not
+#     be reproduced or transferred to other documents and shall not
+#     be disclosed to others for any purpose without
+#     prior written permission of Secure Ai Labs, Inc.
+# -------------------------------------------------------------------------------
+
+import functools
+import importlib.util
+import os
+import struct
+import zlib
+from typing import BinaryIO, List, Optional
+
+from app.utils.lazy_import import lazy_import
+from app.utils.settings import settings
+
+zstandard = lazy_import("zstandard")
+
+IDENTITY = "identity"
+GZIP = "gzip"
+ZSTD = "zstd"
+
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+# The ratio limit only applies past this many decoded bytes, small parts may legitimately compress a lot
+RATIO_LIMIT_MIN_BYTES = 64 * 1024 * 1024
+
+READ_CHUNK_SIZE = 256 * 1024
+
+
+class DecodingLimitExceeded(Exception):
+    """Raised when a compressed part decodes to more than the configured limits, like a decompression bomb"""
+
+
+def get_supported_encodings() -> List[str]:
+    encodings = [IDENTITY, GZIP]
+    if is_zstandard_installed():
+        encodings.append(ZSTD)
+    return encodings
+
+
+@functools.lru_cache(maxsize=None)
+def is_zstandard_installed() -> bool:
+    """Tell if zstandard can be imported, without importing it. Uploads compressed with zstd are refused otherwise."""
+    return importlib.util.find_spec("zstandard") is not None
+
+
+def get_content_encoding(file: BinaryIO, content_encoding: Optional[str]) -> Optional[str]:
+    """
+    Check the Content-Encoding of an uploaded part against its first bytes
+
+    :param file: the uploaded part, positioned at its start
+    :type file: BinaryIO
+    :param content_encoding: the Content-Encoding header of the part
+    :type content_encoding: Optional[str]
+    :raises Exception: if the encoding is not supported or does not match the content
+    :return: the encoding of the part, None if it is not encoded
+    :rtype: Optional[str]
+    """
+    encoding = (content_encoding or IDENTITY).strip().lower()
+    if encoding == IDENTITY:
+        return None
+    if encoding not in get_supported_encodings():
+        raise Exception(f"Unsupported Content-Encoding {encoding}, use one of {', '.join(get_supported_encodings())}")
+
+    magic = file.read(4)
+    file.seek(0)
+    if not magic.startswith(GZIP_MAGIC if encoding == GZIP else ZSTD_MAGIC):
+        raise Exception(f"The part is not {encoding} encoded")
+    if encoding == ZSTD and get_zstd_content_size(file) is None:
+        raise Exception(f"The part has an invalid {encoding} frame header")
+    return encoding
+
+
+def get_zstd_content_size(file: BinaryIO) -> Optional[int]:
+    """
+    Read the content size in the header of the first zstd frame of a part
+
+    :param file: the uploaded part
+    :type file: BinaryIO
+    :return: the content size, -1 if the frame does not tell it, None if the frame header is invalid
+    :rtype: Optional[int]
+    """
+    file.seek(0)
+    try:
+        content_size = zstandard.get_frame_parameters(file.read(18)).content_size
+    except zstandard.ZstdError:
+        return None
+    finally:
+        file.seek(0)
+    return -1 if content_size == zstandard.CONTENTSIZE_UNKNOWN else content_size
+
+
+def get_decoded_size_hint(file: BinaryIO, encoding: str) -> int:
+    """
+    Estimate the decoded size of a part without decoding it, from the gzip trailer or the zstd frame header.
+    A part with no usable size is assumed as large as the limits let it be. The hint comes from the
+    client, so it is only trusted as far as the limits go, and a part of several gzip members or zstd
+    frames decodes to more: the trailer only has the size of the last member, the header the one of the
+    first frame.
+
+    :param file: the uploaded part
+    :type file: BinaryIO
+    :param encoding: the encoding of the part
+    :type encoding: str
+    :return: the estimated decoded size in bytes
+    :rtype: int
+    """
+    encoded_size = file.seek(0, os.SEEK_END)
+    hint = -1
+    if encoding == GZIP and encoded_size >= 18:
+        # The trailer has the size modulo 4 GiB of the last member only
+        file.seek(-4, os.SEEK_END)
+        hint = struct.unpack("<L", file.read(4))[0]
+        if hint < encoded_size // 2:
+            hint = -1
+    elif encoding == ZSTD:
+        content_size = get_zstd_content_size(file)
+        hint = content_size if content_size is not None else -1
+    file.seek(0)
+
+    if hint < 0:
+        hint = max(RATIO_LIMIT_MIN_BYTES, int(encoded_size * settings.upload_max_decoding_ratio))
+    return min(hint, settings.upload_max_decoded_bytes)
+
+
+class DecodingReader:
+    """
+    Read-only file object decoding a compressed part as it is read. Every read decodes at most the
+    requested size, so a decompression bomb is stopped by the limits before it is expanded in memory.
+    """
+
+    def __init__(self, file: BinaryIO, encoding: str, max_decoded_bytes: Optional[int] = None):
+        self.file = file
+        self.encoding = encoding
+        self.max_decoded_bytes = min(
+            max_decoded_bytes or settings.upload_max_decoded_bytes, settings.upload_max_decoded_bytes
+        )
+        self.encoded_bytes = 0
+        self.decoded_bytes = 0
+        self._pending = b""
+        self._eof = False
+        self._decoder = zlib.decompressobj(wbits=zlib.MAX_WBITS | 16)
+        self._zstd_reader = None
+        if encoding == ZSTD:
+            # The stream reader never decodes more than requested either
+            self._zstd_reader = zstandard.ZstdDecompressor().stream_reader(
+                _CountingReader(self), read_across_frames=True
+            )
+
+    def read(self, size: int = -1) -> bytes:
+        chunks: List[bytes] = []
+        remaining = size if size >= 0 else float("inf")
+        while remaining > 0 and not self._eof:
+            chunk = self._decode(int(min(remaining, READ_CHUNK_SIZE)))
+            chunks.append(chunk)
+            remaining -= len(chunk)
+            self.decoded_bytes += len(chunk)
+            self._check_limits()
+        return b"".join(chunks)
+
+    def _decode(self, max_length: int) -> bytes:
+        """Decode up to max_length bytes, reading more of the part as needed"""
+        if self._zstd_reader is not None:
+            data = self._zstd_reader.read(max_length)
+            self._eof = not data
+            return data
+
+        while True:
+            if self._decoder.eof:
+                # A gzip stream may have several members one after the other
+                self._pending = self._decoder.unused_data
+                self._decoder = zlib.decompressobj(wbits=zlib.MAX_WBITS | 16)
+                if not self._pending and not self._read_part():
+                    self._eof = True
+                    return b""
+            elif not self._decoder.unconsumed_tail and not self._pending and not self._read_part():
+                raise Exception(f"The {self.encoding} encoded part is truncated")
+
+            data = self._decoder.decompress(self._decoder.unconsumed_tail or self._pending, max_length)
+            self._pending = b""
+            if data:
+                return data
+
+    def _read_part(self, size: int = READ_CHUNK_SIZE) -> bool:
+        self._pending = self.file.read(size)
+        self.encoded_bytes += len(self._pending)
+        return bool(self._pending)
+
+    def _check_limits(self):
+        if self.decoded_bytes > self.max_decoded_bytes:
+            raise DecodingLimitExceeded(f"A part decodes to more than {self.max_decoded_bytes} bytes")
+        if (
+            self.decoded_bytes > RATIO_LIMIT_MIN_BYTES
+            and self.decoded_bytes > self.encoded_bytes * settings.upload_max_decoding_ratio
+        ):
+            raise DecodingLimitExceeded(
+                f"A part decodes to more than {settings.upload_max_decoding_ratio} times its encoded size"
+            )
+
+
+class _CountingReader:
+    """Read the encoded part for the zstd stream reader, counting the bytes for the ratio limit"""
+
+    def __init__(self, reader: DecodingReader):
+        self.reader = reader
+
+    def read(self, size: int) -> bytes:
+        data = self.reader.file.read(size)
+        self.reader.encoded_bytes += len(data)
+        return data
@@ -0,0 +1,304 @@
+# -------------------------------------------------------------------------------
+# Engineering
+# crypto.py
+# -------------------------------------------------------------------------------
+"""AES-GCM encryption of the dataset packages on interchangeable crypto libraries"""
+# -------------------------------------------------------------------------------
+# Copyright (C) 2022 Secure Ai Labs, Inc. All Rights Reserved.
+# Private and Confidential. Internal Use Only.
+#     This software contains proprietary information which shall not
+#     be reproduced or transferred to other documents and shall not
+#     be disclosed to others for any purpose without
+#     prior written permission of Secure Ai Labs, Inc.
+# -------------------------------------------------------------------------------
+
+import logging
+import os
+import threading
+import time
+from typing import Dict, List, Optional, Set, Tuple
+
+from app.utils.lazy_import import lazy_import
+from app.utils.settings import settings
+
+logger = logging.getLogger(__name__)
+
+# Heavy dependencies are only imported when a package is encrypted, to keep the server startup fast
+AES = lazy_import("Crypto.Cipher.AES")
+aead = lazy_import("cryptography.hazmat.primitives.ciphers.aead")
+ciphers = lazy_import("cryptography.hazmat.primitives.ciphers")
+
+KEY_SIZE = 32
+NONCE_SIZE = 12
+TAG_SIZE = 16
+BLOCK_SIZE = 16
+
+# Size of the pieces a buffer or file is encrypted in by the incremental encryptors
+CHUNK_SIZE = 1024 * 1024
+
+# Size of the buffer encrypted by every backend to pick the fastest one
+BENCHMARK_SIZE = 8 * 1024 * 1024
+BENCHMARK_ROUNDS = 3
+
+# Sizes around the chunk size and the AES block size, where an incremental encryptor is most likely to slip
+EDGE_SIZES = [0, 1, 15, 16, 17, 4095, CHUNK_SIZE - 1, CHUNK_SIZE, CHUNK_SIZE + 17]
+
+
+def check_key_and_nonce(key: bytes, nonce: bytes):
+    if len(key) != KEY_SIZE:
+        raise Exception("The key must be 256 bits")
+    if len(nonce) != NONCE_SIZE:
+        raise Exception("The nonce must be 96 bits")
+
+
+class AesGcmEncryptor:
+    """Incremental AES-GCM encryption, the data is given in pieces of any size"""
+
+    def update_into(self, data: memoryview, output: memoryview):
+        """Encrypt the next piece of the data into an output buffer of the same size, which may be the data"""
+        raise NotImplementedError
+
+    def finalize(self) -> bytes:
+        """Get the authentication tag once all the data is encrypted"""
+        raise NotImplementedError
+
+
+class AesGcmBackend:
+    """An AES-GCM implementation. All the backends give byte for byte the same ciphertext and tag."""
+
+    name = ""
+
+    def create_encryptor(self, key: bytes, nonce: bytes, scratch: Optional[memoryview] = None) -> AesGcmEncryptor:
+        """
+        Create an incremental encryptor
+
+        :param key: the 256 bits key
+        :type key: bytes
+        :param nonce: the 96 bits nonce
+        :type nonce: bytes
+        :param scratch: the scratch buffer of get_scratch_size bytes the encryptor needs, if any. One of a chunk is
+            allocated otherwise.
+        :type scratch: Optional[memoryview]
+        :return: the encryptor
+        :rtype: AesGcmEncryptor
+        """
+        raise NotImplementedError
+
+    def get_scratch_size(self, chunk_size: int) -> int:
+        """Get the size of the scratch buffer an encryptor needs for pieces of up to chunk_size bytes, 0 if none"""
+        return 0
+
+    def split_buffer(self, buffer: memoryview) -> Tuple[memoryview, Optional[memoryview]]:
+        """
+        Split a buffer reserved for a chunk and its scratch buffer, get_scratch_size bytes more than the chunk
+
+        :param buffer: the buffer to split
+        :type buffer: memoryview
+        :return: the chunk and the scratch buffer, None if the encryptor needs none
+        :rtype: Tuple[memoryview, Optional[memoryview]]
+        """
+        return buffer, None
+
+    def encrypt(self, key: bytes, nonce: bytes, data: bytes) -> Tuple[bytes, bytes]:
+        """
+        Encrypt data in one call
+
+        :param key: the 256 bits key
+        :type key: bytes
+        :param nonce: the 96 bits nonce
+        :type nonce: bytes
+        :param data: the data to encrypt
+        :type data: bytes
+        :return: the ciphertext and the authentication tag
+        :rtype: Tuple[bytes, bytes]
+        """
+        raise NotImplementedError
+
+    def encrypt_in_place(self, buffer: memoryview, key: bytes, nonce: bytes) -> bytes:
+        """
+        Encrypt a writable buffer in place
+
+        :param buffer: the data to encrypt, overwritten with the ciphertext
+        :type buffer: memoryview
+        :param key: the 256 bits key
+        :type key: bytes
+        :param nonce: the 96 bits nonce
+        :type nonce: bytes
+        :return: the authentication tag
+        :rtype: bytes
+        """
+        # The scratch buffer is at most a chunk, part of the memory the caller reserved for the buffer
+        scratch_size = self.get_scratch_size(max(1, min(len(buffer), CHUNK_SIZE)))
+        encryptor = self.create_encryptor(key, nonce, memoryview(bytearray(scratch_size)) if scratch_size else None)
+        for start in range(0, len(buffer), CHUNK_SIZE):
+            piece = buffer[start : start + CHUNK_SIZE]
+            encryptor.update_into(piece, piece)
+        return encryptor.finalize()
+
+
+class _PyCryptodomeEncryptor(AesGcmEncryptor):
+    def __init__(self, key: bytes, nonce: bytes):
+        self.cipher = AES.new(key, AES.MODE_GCM, nonce=nonce)
+
+    def update_into(self, data: memoryview, output: memoryview):
+        self.cipher.encrypt(data, output=output)
+
+    def finalize(self) -> bytes:
+        return self.cipher.digest()
+
+
+class PyCryptodomeBackend(AesGcmBackend):
+    """PyCryptodome, which encrypts in place natively"""
+
+    name = "pycryptodome"
+
+    def create_encryptor(self, key: bytes, nonce: bytes, scratch: Optional[memoryview] = None) -> AesGcmEncryptor:
+        check_key_and_nonce(key, nonce)
+        return _PyCryptodomeEncryptor(key, nonce)
+
+    def encrypt(self, key: bytes, nonce: bytes, data: bytes) -> Tuple[bytes, bytes]:
+        check_key_and_nonce(key, nonce)
+        return AES.new(key, AES.MODE_GCM, nonce=nonce).encrypt_and_digest(data)
+
+    def encrypt_in_place(self, buffer: memoryview, key: bytes, nonce: bytes) -> bytes:
+        encryptor = self.create_encryptor(key, nonce)
+        encryptor.update_into(buffer, buffer)
+        return encryptor.finalize()
+
+
+class _CryptographyEncryptor(AesGcmEncryptor):
+    def __init__(self, key: bytes, nonce: bytes, scratch: memoryview):
+        self.context = ciphers.Cipher(ciphers.algorithms.AES(key), ciphers.modes.GCM(nonce)).encryptor()
+        self.scratch = scratch
+
+    def update_into(self, data: memoryview, output: memoryview):
+        # The ciphertext goes through the scratch buffer, update_into needs room for a block more than the data
+        piece_size = len(self.scratch) - BLOCK_SIZE
+        for start in range(0, len(data), piece_size):
+            piece = data[start : start + piece_size]
+            written = self.context.update_into(piece, self.scratch)
+            output[start : start + written] = self.scratch[:written]
+
+    def finalize(self) -> bytes:
+        self.context.finalize()
+        return self.context.tag
+
+
+class CryptographyBackend(AesGcmBackend):
+    """The cryptography package on OpenSSL, with the AES-NI and carry-less multiplication instructions if any"""
+
+    name = "cryptography"
+
+    def create_encryptor(self, key: bytes, nonce: bytes, scratch: Optional[memoryview] = None) -> AesGcmEncryptor:
+        check_key_and_nonce(key, nonce)
+        if scratch is None:
+            scratch = memoryview(bytearray(self.get_scratch_size(CHUNK_SIZE)))
+        if len(scratch) <= BLOCK_SIZE:
+            raise Exception("The scratch buffer must be larger than a block")
+        return _CryptographyEncryptor(key, nonce, scratch)
+
+    def get_scratch_size(self, chunk_size: int) -> int:
+        return chunk_size + BLOCK_SIZE
+
+    def split_buffer(self, buffer: memoryview) -> Tuple[memoryview, Optional[memoryview]]:
+        chunk_size = (len(buffer) - BLOCK_SIZE) // 2
+        return buffer[:chunk_size], buffer[chunk_size:]
+
+    def encrypt(self, key: bytes, nonce: bytes, data: bytes) -> Tuple[bytes, bytes]:
+        check_key_and_nonce(key, nonce)
+        ciphertext = aead.AESGCM(key).encrypt(nonce, data, None)
+        return ciphertext[:-TAG_SIZE], ciphertext[-TAG_SIZE:]
+
+
+backends: Dict[str, AesGcmBackend] = {
+    backend.name: backend for backend in (PyCryptodomeBackend(), CryptographyBackend())  # type: ignore
+}
+
+_selected_backend: Optional[AesGcmBackend] = None
+_selected_backend_lock = threading.Lock()
+_checked_backends: Set[str] = set()
+
+
+def measure_throughput(backend: AesGcmBackend, size: int = BENCHMARK_SIZE, rounds: int = BENCHMARK_ROUNDS) -> float:
+    """
+    Measure how fast a backend encrypts a buffer in place
+
+    :param backend: the backend to measure
+    :type backend: AesGcmBackend
+    :param size: the size of the buffer in bytes
+    :type size: int
+    :param rounds: the number of times the buffer is encrypted, the fastest one counts
+    :type rounds: int
+    :return: the throughput in bytes per second
+    :rtype: float
+    """
+    buffer = memoryview(bytearray(size))
+    key, nonce = os.urandom(KEY_SIZE), os.urandom(NONCE_SIZE)
+    best = float("inf")
+    for _ in range(rounds):
+        started_at = time.perf_counter()
+        backend.encrypt_in_place(buffer, key, nonce)
+        best = min(best, time.perf_counter() - started_at)
+    return size / max(best, 1e-9)
+
+
+def get_available_backends() -> List[AesGcmBackend]:
+    """Get the backends whose library is installed"""
+    available: List[AesGcmBackend] = []
+    for backend in backends.values():
+        try:
+            backend.encrypt(bytes(KEY_SIZE), bytes(NONCE_SIZE), b"")
+            available.append(backend)
+        except ImportError:
+            pass
+    return available
+
+
+def check_backend(backend: AesGcmBackend):
+    """
+    Check that a backend encrypts in place to the ciphertext and tag every available backend gives in one
+    call, for the sizes where an incremental encryptor is most likely to slip
+
+    :param backend: the backend to check
+    :type backend: AesGcmBackend
+    :raises Exception: if the backend disagrees with any other way to encrypt
+    """
+    for size in EDGE_SIZES:
+        key, nonce, data = os.urandom(KEY_SIZE), os.urandom(NONCE_SIZE), os.urandom(size)
+        buffer = bytearray(data)
+        tag = backend.encrypt_in_place(memoryview(buffer), key, nonce)
+        for reference in get_available_backends():
+            if reference.encrypt(key, nonce, data) != (bytes(buffer), tag):
+                raise Exception(f"The {backend.name} crypto backend differs from {reference.name} for {size} bytes")
+
+
+def get_crypto_backend() -> AesGcmBackend:
+    """
+    Get the backend set in the settings. With auto, the fastest backend on this host is measured once
+    and used from then on. A backend is checked against the others before it is first used.
+
+    :raises Exception: if the backend does not give the same ciphertext as the others
+    :return: the backend to encrypt with
+    :rtype: AesGcmBackend
+    """
+    global _selected_backend
+    with _selected_backend_lock:
+        if settings.crypto_backend != "auto":
+            backend = backends[settings.crypto_backend]
+        else:
+            if _selected_backend is None:
+                throughputs = {backend: measure_throughput(backend) for backend in get_available_backends()}
+                _selected_backend = max(throughputs, key=throughputs.__getitem__)
+                logger.info(
+                    "Selected the %s crypto backend: %s",
+                    _selected_backend.name,
+                    ", ".join(
+                        f"{backend.name} {throughput / 1e9:.2f} GB/s" for backend, throughput in throughputs.items()
+                    ),
+                )
+            backend = _selected_backend
+
+        if backend.name not in _checked_backends:
+            check_backend(backend)
+            _checked_backends.add(backend.name)
+        return backend
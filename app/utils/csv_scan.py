@@ -0,0 +1,144 @@
+# -------------------------------------------------------------------------------
+# Engineering
+# csv_scan.py
+# -------------------------------------------------------------------------------
+"""Split CSV files in rows while they stream through packaging"""
+# -------------------------------------------------------------------------------
+# Copyright (C) 2022 Secure Ai Labs, Inc. All Rights Reserved.
+# Private and Confidential. Internal Use Only.
+#     This software contains proprietary information which shall not
+#     be reproduced or transferred to other documents and shall not
+#     be disclosed to others for any purpose without
+#     prior written permission of Secure Ai Labs, Inc.
+# -------------------------------------------------------------------------------
+
+import os
+from typing import BinaryIO, Dict, List, Optional
+
+from app.utils.preview import CsvReservoirSampler
+from app.utils.row_index import CsvRowIndexer
+from app.utils.settings import settings
+
+# A scan gives up on a file with a row longer than this, it is most likely not a CSV file
+MAX_ROW_SIZE = 16 * 1024 * 1024
+
+
+class CsvRowSplitter:
+    """
+    Split CSV data fed in chunks of any size in rows, without their new line. Chunks are split in lines
+    in native code, and lines are only joined back one by one when the data has quoted fields, which may
+    span several lines: a row ends when its quotes are balanced.
+    """
+
+    def __init__(self):
+        self.abandoned = False
+        self._partial = b""
+
+    def update(self, chunk: bytes) -> List[bytes]:
+        """Add the next chunk of the file and get the rows it completes"""
+        if self.abandoned or not chunk:
+            return []
+
+        data = self._partial + chunk
+        lines = data.split(b"\n")
+        self._partial = lines.pop()
+        if b'"' in data:
+            lines = self._join_quoted_lines(lines)
+        if len(self._partial) > MAX_ROW_SIZE:
+            self.abandoned = True
+            return []
+        return lines
+
+    def finish(self) -> List[bytes]:
+        """Get the last row if the file does not end with a new line"""
+        rows = [self._partial] if self._partial and not self.abandoned else []
+        self._partial = b""
+        return rows
+
+    def _join_quoted_lines(self, lines: List[bytes]) -> List[bytes]:
+        rows: List[bytes] = []
+        row: Optional[bytes] = None
+        for line in lines:
+            row = line if row is None else row + b"\n" + line
+            if row.count(b'"') % 2 == 0:
+                rows.append(row)
+                row = None
+        if row is not None:
+            self._partial = row + b"\n" + self._partial
+        return rows
+
+
+class CsvScan:
+    """A single pass over a CSV file feeding its rows to the preview sampler and the row indexer"""
+
+    def __init__(self, name: str, sampler: Optional[CsvReservoirSampler], indexer: Optional[CsvRowIndexer]):
+        self.name = name
+        self.sampler = sampler
+        self.indexer = indexer
+        self._splitter = CsvRowSplitter()
+
+    @property
+    def abandoned(self) -> bool:
+        return self._splitter.abandoned
+
+    def update(self, chunk: bytes):
+        if self.indexer:
+            self.indexer.add_bytes(len(chunk))
+        self._add_rows(self._splitter.update(chunk))
+
+    def finish(self):
+        self._add_rows(self._splitter.finish())
+
+    def _add_rows(self, rows: List[bytes]):
+        if not rows:
+            return
+        if self.sampler:
+            self.sampler.add_rows(rows)
+        if self.indexer:
+            self.indexer.add_rows(rows)
+
+
+class ScanningReader:
+    """File object wrapper feeding everything read through it to a scan"""
+
+    def __init__(self, file: BinaryIO, scan: CsvScan):
+        self.file = file
+        self.scan = scan
+
+    def read(self, size: int = -1) -> bytes:
+        data = self.file.read(size)
+        self.scan.update(data)
+        return data
+
+
+def create_scans(file_names: List[str]) -> Dict[str, CsvScan]:
+    """
+    Create a scan for every CSV file if previews or row indexes are enabled
+
+    :param file_names: the names of the uploaded files
+    :type file_names: List[str]
+    :return: the scans by file name, empty if previews and row indexes are disabled
+    :rtype: Dict[str, CsvScan]
+    """
+    if settings.preview_rows <= 0 and settings.row_index_stride <= 0:
+        return {}
+
+    scans: Dict[str, CsvScan] = {}
+    for file_name in file_names:
+        if not file_name.lower().endswith(".csv"):
+            continue
+        name = os.path.basename(file_name)
+        sampler = (
+            CsvReservoirSampler(name, settings.preview_rows, settings.preview_seed)
+            if settings.preview_rows > 0
+            else None
+        )
+        indexer = CsvRowIndexer(name, settings.row_index_stride) if settings.row_index_stride > 0 else None
+        scans[file_name] = CsvScan(name, sampler, indexer)
+    return scans
+
+
+def wrap_for_scanning(file: BinaryIO, file_name: str, scans: Dict[str, CsvScan]) -> BinaryIO:
+    """Get a reader of the file that feeds its scan, or the file itself if it is not scanned"""
+    scan = scans.get(file_name)
+    return ScanningReader(file, scan) if scan else file  # type: ignore
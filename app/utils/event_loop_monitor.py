@@ -0,0 +1,88 @@
+# -------------------------------------------------------------------------------
+# Engineering
+# event_loop_monitor.py
+# -------------------------------------------------------------------------------
+"""Measure and report how long the event loop is blocked"""
+# -------------------------------------------------------------------------------
+# Copyright (C) 2022 Secure Ai Labs, Inc. All Rights Reserved.
+# Private and Confidential. Internal Use Only.
+#     This software contains proprietary information which shall not
+#     be reproduced or transferred to other documents and shall not
+#     be disclosed to others for any purpose without
+#     prior written permission of Secure Ai Labs, Inc.
+# -------------------------------------------------------------------------------
+
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Any, Deque, Dict
+
+from app.utils.settings import settings
+
+logger = logging.getLogger(__name__)
+
+# Number of recent lag measurements kept to compute the percentiles
+LAG_SAMPLES = 1024
+
+
+class EventLoopMonitor:
+    """
+    Sleep for a fixed interval on the event loop and record how late every wake up is. Any lag
+    above the threshold means a callback blocked the loop and is logged. In debug mode asyncio
+    also logs the name of every callback that ran longer than the threshold.
+    """
+
+    def __init__(self, interval: float, threshold: float, debug: bool):
+        self.interval = interval
+        self.threshold = threshold
+        self.debug = debug
+        self._lags: Deque[float] = deque(maxlen=LAG_SAMPLES)
+        self._max_lag = 0.0
+        self._blocked_count = 0
+        self._running = False
+
+    async def run(self):
+        """Measure the lag until stop is called"""
+        loop = asyncio.get_running_loop()
+        if self.debug:
+            loop.set_debug(True)
+            loop.slow_callback_duration = self.threshold
+
+        self._running = True
+        while self._running:
+            started_at = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, time.perf_counter() - started_at - self.interval)
+
+            self._lags.append(lag)
+            self._max_lag = max(self._max_lag, lag)
+            if lag > self.threshold:
+                self._blocked_count += 1
+                logger.warning("Event loop was blocked for %.3f seconds", lag)
+
+    def stop(self):
+        self._running = False
+
+    def get_metrics(self) -> Dict[str, Any]:
+        """
+        Get a snapshot of the event loop lag
+
+        :return: the lag metrics in seconds
+        :rtype: Dict[str, Any]
+        """
+        lags = sorted(self._lags)
+        return {
+            "lag_seconds": self._lags[-1] if self._lags else 0.0,
+            "lag_p99_seconds": lags[min(len(lags) - 1, int(0.99 * len(lags)))] if lags else 0.0,
+            "max_lag_seconds": self._max_lag,
+            "blocked_count": self._blocked_count,
+            "threshold_seconds": self.threshold,
+        }
+
+
+event_loop_monitor = EventLoopMonitor(
+    interval=settings.event_loop_monitor_interval,
+    threshold=settings.event_loop_lag_threshold,
+    debug=settings.event_loop_debug,
+)
@@ -0,0 +1,58 @@
+# -------------------------------------------------------------------------------
+# Engineering
+# in_flight.py
+# -------------------------------------------------------------------------------
+"""Keep track of the dataset versions with an upload job in flight"""
+# -------------------------------------------------------------------------------
+# Copyright (C) 2022 Secure Ai Labs, Inc. All Rights Reserved.
+# Private and Confidential. Internal Use Only.
+#     This software contains proprietary information which shall not
+#     be reproduced or transferred to other documents and shall not
+#     be disclosed to others for any purpose without
+#     prior written permission of Secure Ai Labs, Inc.
+# -------------------------------------------------------------------------------
+
+import threading
+from typing import Set
+
+
+class InFlightJobs:
+    """
+    Dataset versions with an upload job queued or running in this process.
+
+    The dataset version only leaves the NOT_UPLOADED state once its job starts, so the state check
+    alone lets a retried or double clicked upload schedule a second job. A request must claim the
+    dataset version before scheduling its job, and the job releases it once it is over.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._job_ids: Set[str] = set()
+
+    def claim(self, job_id: str) -> bool:
+        """
+        Claim a dataset version for a new upload job
+
+        :param job_id: the dataset version id of the job
+        :type job_id: str
+        :return: False if the dataset version already has a job in flight
+        :rtype: bool
+        """
+        with self._lock:
+            if job_id in self._job_ids:
+                return False
+            self._job_ids.add(job_id)
+            return True
+
+    def release(self, job_id: str):
+        """
+        Release a dataset version once its job is over or could not be scheduled
+
+        :param job_id: the dataset version id of the job
+        :type job_id: str
+        """
+        with self._lock:
+            self._job_ids.discard(job_id)
+
+
+in_flight_jobs = InFlightJobs()
@@ -0,0 +1,445 @@
+# -------------------------------------------------------------------------------
+# Engineering
+# job_scheduler.py
+# -------------------------------------------------------------------------------
+"""Weighted fair scheduling of the upload jobs across tenants"""
+# -------------------------------------------------------------------------------
+# Copyright (C) 2022 Secure Ai Labs, Inc. All Rights Reserved.
+# Private and Confidential. Internal Use Only.
+#     This software contains proprietary information which shall not
+#     be reproduced or transferred to other documents and shall not
+#     be disclosed to others for any purpose without
+#     prior written permission of Secure Ai Labs, Inc.
+# -------------------------------------------------------------------------------
+
+import contextvars
+import heapq
+import itertools
+import logging
+import math
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Deque, Dict, List, Optional, Set, Tuple
+
+from fastapi import status
+
+from app.utils.settings import settings
+
+logger = logging.getLogger(__name__)
+
+SHORT_LANE = "short"
+REGULAR_LANE = "regular"
+
+# Every job costs at least this many bytes, so that a flood of tiny jobs is still charged to its tenant
+MINIMUM_JOB_COST = 1024 * 1024
+
+# Number of recent wait times kept to compute the percentiles
+WAIT_TIME_SAMPLES = 1024
+
+
+class JobSchedulerSaturated(Exception):
+    """Raised when a job can not be queued because the scheduler is at capacity"""
+
+    def __init__(self, status_code: int, retry_after: int, message: str):
+        self.status_code = status_code
+        self.retry_after = retry_after
+        super().__init__(message)
+
+
+class RetryJobLater(Exception):
+    """
+    Raised by a job to be run again with the given arguments once a delay is over, e.g. to resume it after a
+    transient failure. The job waits without holding a worker and is queued again regardless of the queue
+    limits, it was accepted already.
+    """
+
+    def __init__(self, delay: float, *args: Any, **kwargs: Any):
+        self.delay = delay
+        self.job_args = args
+        self.job_kwargs = kwargs
+        super().__init__(f"Retry the job in {delay:.1f} seconds")
+
+
+class _Job:
+    def __init__(
+        self,
+        tenant: str,
+        lane: str,
+        cost: float,
+        function: Callable[..., Any],
+        args: Tuple,
+        kwargs: Dict[str, Any],
+        on_abandoned: Optional[Callable[[], Any]],
+    ):
+        self.tenant = tenant
+        self.lane = lane
+        self.cost = cost
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        self.on_abandoned = on_abandoned
+        self.abandoned = False
+        self.enqueued_at = time.monotonic()
+        # The job runs in the context it was submitted from, so that its spans belong to the trace of the request
+        self.context = contextvars.copy_context()
+
+
+class _TenantQueue:
+    def __init__(self):
+        self.jobs: Deque[_Job] = deque()
+        self.virtual_time = 0.0
+
+
+class JobScheduler:
+    """
+    Run jobs on a fixed pool of worker threads, dequeuing them fairly between tenants.
+
+    Each lane keeps one queue per tenant and uses start-time fair queuing: a tenant's virtual
+    time grows by the size of every job it runs divided by its weight, and the tenant with the
+    smallest virtual time goes next. Small jobs are queued in a separate short lane which has
+    its own workers and is also served by the regular workers when they are idle.
+    """
+
+    def __init__(
+        self,
+        workers: int,
+        short_lane_workers: int,
+        short_job_max_bytes: int,
+        max_queued_jobs: int,
+        max_queued_jobs_per_tenant: int,
+        max_running_jobs_per_tenant: int,
+        tenant_weights: Optional[Dict[str, float]] = None,
+    ):
+        self.workers = workers
+        self.short_lane_workers = short_lane_workers
+        self.short_job_max_bytes = short_job_max_bytes
+        self.max_queued_jobs = max_queued_jobs
+        self.max_queued_jobs_per_tenant = max_queued_jobs_per_tenant
+        self.max_running_jobs_per_tenant = max_running_jobs_per_tenant
+        self.tenant_weights: Dict[str, float] = dict(tenant_weights or {})
+
+        self._condition = threading.Condition()
+        self._lanes: Dict[str, Dict[str, _TenantQueue]] = {SHORT_LANE: {}, REGULAR_LANE: {}}
+        self._lane_virtual_time: Dict[str, float] = {SHORT_LANE: 0.0, REGULAR_LANE: 0.0}
+        self._queued_per_tenant: Dict[str, int] = {}
+        self._running_per_tenant: Dict[str, int] = {}
+        self._queued = 0
+        self._running = 0
+        self._delayed: List[Tuple[float, int, _Job]] = []
+        self._delayed_sequence = itertools.count()
+        self._running_jobs: Set[_Job] = set()
+        self._threads: List[threading.Thread] = []
+        self._is_shutdown = False
+        self._paused_until = 0.0
+
+        # Metrics
+        self._completed_jobs = 0
+        self._failed_jobs = 0
+        self._retried_jobs = 0
+        self._rejected_jobs = {"global": 0, "tenant": 0}
+        self._wait_times: Deque[float] = deque(maxlen=WAIT_TIME_SAMPLES)
+        self._wait_time_total = 0.0
+        self._wait_time_count = 0
+        self._wait_time_max = 0.0
+        self._run_time_total = 0.0
+
+    def set_tenant_weight(self, tenant: str, weight: float):
+        """
+        Set the share of the workers a tenant gets relative to other tenants
+
+        :param tenant: the tenant identifier
+        :type tenant: str
+        :param weight: the weight of the tenant, the default weight is 1
+        :type weight: float
+        """
+        if weight <= 0:
+            raise Exception("The tenant weight must be positive")
+        with self._condition:
+            self.tenant_weights[tenant] = weight
+
+    def submit(
+        self,
+        tenant: str,
+        size: int,
+        function: Callable[..., Any],
+        *args,
+        on_abandoned: Optional[Callable[[], Any]] = None,
+        **kwargs,
+    ):
+        """
+        Queue a job to be run on the worker pool
+
+        :param tenant: the tenant the job is charged to
+        :type tenant: str
+        :param size: the size of the job in bytes, used for fairness and to pick the lane
+        :type size: int
+        :param function: the function to run
+        :type function: Callable[..., Any]
+        :param on_abandoned: called instead of the job, or while it runs, if the scheduler shuts down without it
+        :type on_abandoned: Optional[Callable[[], Any]]
+        :raises JobSchedulerSaturated: if the global or the tenant queue is full
+        """
+        with self._condition:
+            if self._is_shutdown:
+                raise JobSchedulerSaturated(status.HTTP_503_SERVICE_UNAVAILABLE, 30, "Job scheduler is shutting down.")
+            if self._queued >= self.max_queued_jobs:
+                self._rejected_jobs["global"] += 1
+                raise JobSchedulerSaturated(
+                    status.HTTP_503_SERVICE_UNAVAILABLE,
+                    self._estimate_retry_after(self._queued),
+                    "Too many upload jobs queued, try again later.",
+                )
+            tenant_queued = self._queued_per_tenant.get(tenant, 0)
+            if tenant_queued >= self.max_queued_jobs_per_tenant:
+                self._rejected_jobs["tenant"] += 1
+                raise JobSchedulerSaturated(
+                    status.HTTP_429_TOO_MANY_REQUESTS,
+                    self._estimate_retry_after(tenant_queued),
+                    "Too many upload jobs queued for this tenant, try again later.",
+                )
+
+            lane = SHORT_LANE if size <= self.short_job_max_bytes else REGULAR_LANE
+            self._enqueue(_Job(tenant, lane, max(size, MINIMUM_JOB_COST), function, args, kwargs, on_abandoned))
+            self._start_workers()
+            self._condition.notify_all()
+
+    def pause(self, seconds: float):
+        """
+        Start no job for a while, e.g. while a service the jobs depend on is down. The running jobs carry on
+        and jobs can still be queued.
+
+        :param seconds: how long to pause for, from now
+        :type seconds: float
+        """
+        with self._condition:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def is_shutdown(self) -> bool:
+        with self._condition:
+            return self._is_shutdown
+
+    def shutdown(self, timeout: float):
+        """
+        Stop accepting jobs and wait for the workers to run the queued jobs. The jobs that are delayed, or still
+        queued or running after the timeout, are abandoned: the process exits without them, so their
+        on_abandoned callback is called instead.
+
+        :param timeout: how long to wait for the queued and running jobs, in seconds
+        :type timeout: float
+        """
+        with self._condition:
+            self._is_shutdown = True
+            abandoned_jobs = [job for _, _, job in self._delayed]
+            self._delayed.clear()
+            threads = list(self._threads)
+            self._condition.notify_all()
+
+        deadline = time.monotonic() + timeout
+        for thread in threads:
+            thread.join(max(0.0, deadline - time.monotonic()))
+
+        with self._condition:
+            # The workers start no other job, those that are done with theirs exit
+            for tenant_queues in self._lanes.values():
+                for tenant_queue in tenant_queues.values():
+                    abandoned_jobs.extend(tenant_queue.jobs)
+                tenant_queues.clear()
+            self._queued = 0
+            self._queued_per_tenant.clear()
+            abandoned_jobs.extend(self._running_jobs)
+            for job in abandoned_jobs:
+                job.abandoned = True
+            self._condition.notify_all()
+
+        for job in abandoned_jobs:
+            self._abandon(job)
+
+    def get_metrics(self) -> Dict[str, Any]:
+        """
+        Get a snapshot of the queue depths, running jobs and wait times
+
+        :return: the scheduler metrics
+        :rtype: Dict[str, Any]
+        """
+        with self._condition:
+            wait_times = sorted(self._wait_times)
+            # Only counts of tenants, the metrics are public and must not tell which organizations are uploading
+            return {
+                "workers": self.workers + self.short_lane_workers,
+                "paused_seconds": max(0.0, self._paused_until - time.monotonic()),
+                "running": self._running,
+                "queued": self._queued,
+                "delayed": len(self._delayed),
+                "queued_per_lane": {
+                    lane: sum(len(tenant_queue.jobs) for tenant_queue in tenant_queues.values())
+                    for lane, tenant_queues in self._lanes.items()
+                },
+                "tenants": {
+                    "queued": len(self._queued_per_tenant),
+                    "running": len(self._running_per_tenant),
+                    "at_running_cap": sum(
+                        running >= self.max_running_jobs_per_tenant for running in self._running_per_tenant.values()
+                    ),
+                },
+                "completed_jobs": self._completed_jobs,
+                "failed_jobs": self._failed_jobs,
+                "retried_jobs": self._retried_jobs,
+                "rejected_jobs": dict(self._rejected_jobs),
+                "wait_time_seconds": {
+                    "count": self._wait_time_count,
+                    "mean": self._wait_time_total / self._wait_time_count if self._wait_time_count else 0.0,
+                    "p50": self._percentile(wait_times, 0.50),
+                    "p95": self._percentile(wait_times, 0.95),
+                    "max": self._wait_time_max,
+                },
+            }
+
+    @staticmethod
+    def _percentile(sorted_values: List[float], fraction: float) -> float:
+        if not sorted_values:
+            return 0.0
+        return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+    def _estimate_retry_after(self, jobs_ahead: int) -> int:
+        finished_jobs = self._completed_jobs + self._failed_jobs
+        mean_run_time = self._run_time_total / finished_jobs if finished_jobs else 30.0
+        return max(1, min(300, math.ceil(mean_run_time * jobs_ahead / max(1, self.workers))))
+
+    def _start_workers(self):
+        if self._threads:
+            return
+        lanes_per_worker = [(REGULAR_LANE, SHORT_LANE)] * self.workers + [(SHORT_LANE,)] * self.short_lane_workers
+        for index, lanes in enumerate(lanes_per_worker):
+            thread = threading.Thread(
+                target=self._worker, args=(lanes,), name=f"upload-job-worker-{index}", daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+
+    def _enqueue(self, job: _Job):
+        tenant_queue = self._lanes[job.lane].setdefault(job.tenant, _TenantQueue())
+        if not tenant_queue.jobs:
+            # An idle tenant does not bank credit for the time it was not queuing jobs
+            tenant_queue.virtual_time = max(tenant_queue.virtual_time, self._lane_virtual_time[job.lane])
+        job.enqueued_at = time.monotonic()
+        tenant_queue.jobs.append(job)
+        self._queued += 1
+        self._queued_per_tenant[job.tenant] = self._queued_per_tenant.get(job.tenant, 0) + 1
+
+    def _enqueue_due_jobs(self) -> Optional[float]:
+        """Queue the delayed jobs that are due and get the wait for the next one"""
+        now = time.monotonic()
+        while self._delayed and self._delayed[0][0] <= now:
+            self._enqueue(heapq.heappop(self._delayed)[2])
+        return self._delayed[0][0] - now if self._delayed else None
+
+    def _dequeue(self, lane: str) -> Optional[_Job]:
+        selected: Optional[_TenantQueue] = None
+        for tenant, tenant_queue in self._lanes[lane].items():
+            if not tenant_queue.jobs:
+                continue
+            if self._running_per_tenant.get(tenant, 0) >= self.max_running_jobs_per_tenant:
+                continue
+            if selected is None or tenant_queue.virtual_time < selected.virtual_time:
+                selected = tenant_queue
+        if selected is None:
+            return None
+
+        job = selected.jobs.popleft()
+        self._lane_virtual_time[lane] = selected.virtual_time
+        selected.virtual_time += job.cost / self.tenant_weights.get(job.tenant, 1.0)
+        if not selected.jobs:
+            del self._lanes[lane][job.tenant]
+        return job
+
+    def _worker(self, lanes: Tuple[str, ...]):
+        while True:
+            with self._condition:
+                job = None
+                while job is None:
+                    next_due_in = self._enqueue_due_jobs()
+                    paused_for = self._paused_until - time.monotonic()
+                    if paused_for > 0:
+                        self._condition.wait(paused_for)
+                        continue
+                    for lane in lanes:
+                        job = self._dequeue(lane)
+                        if job is not None:
+                            break
+                    if job is None:
+                        if self._is_shutdown and self._queued == 0:
+                            return
+                        self._condition.wait(next_due_in)
+
+                self._queued -= 1
+                self._queued_per_tenant[job.tenant] -= 1
+                if not self._queued_per_tenant[job.tenant]:
+                    del self._queued_per_tenant[job.tenant]
+                self._running += 1
+                self._running_jobs.add(job)
+                self._running_per_tenant[job.tenant] = self._running_per_tenant.get(job.tenant, 0) + 1
+
+                wait_time = time.monotonic() - job.enqueued_at
+                self._wait_times.append(wait_time)
+                self._wait_time_total += wait_time
+                self._wait_time_count += 1
+                self._wait_time_max = max(self._wait_time_max, wait_time)
+
+            started_at = time.monotonic()
+            failed = False
+            retry: Optional[RetryJobLater] = None
+            try:
+                job.context.run(job.function, *job.args, **job.kwargs)
+            except RetryJobLater as exception:
+                retry = exception
+            except Exception:
+                failed = True
+                logger.exception("Upload job failed")
+
+            abandoned = False
+            with self._condition:
+                self._running -= 1
+                self._running_jobs.discard(job)
+                self._running_per_tenant[job.tenant] -= 1
+                if not self._running_per_tenant[job.tenant]:
+                    del self._running_per_tenant[job.tenant]
+                self._run_time_total += time.monotonic() - started_at
+                if retry is not None and not self._is_shutdown:
+                    # Waits in the delayed jobs, without a worker or a running slot of its tenant
+                    self._retried_jobs += 1
+                    job.args, job.kwargs = retry.job_args, retry.job_kwargs
+                    heapq.heappush(self._delayed, (time.monotonic() + retry.delay, next(self._delayed_sequence), job))
+                elif failed or retry is not None:
+                    self._failed_jobs += 1
+                    # A job to retry once shutting down will not run again, unless shutdown abandoned it already
+                    abandoned = retry is not None and not job.abandoned
+                    job.abandoned = job.abandoned or abandoned
+                else:
+                    self._completed_jobs += 1
+                # A tenant below its running cap may unblock a job another worker skipped
+                self._condition.notify_all()
+
+            if abandoned:
+                self._abandon(job)
+
+    @staticmethod
+    def _abandon(job: _Job):
+        if job.on_abandoned is None:
+            return
+        try:
+            # A copy, the context is still entered on the worker of a running job
+            job.context.copy().run(job.on_abandoned)
+        except Exception:
+            logger.exception("Failed to abandon upload job")
+
+
+job_scheduler = JobScheduler(
+    workers=settings.job_workers,
+    short_lane_workers=settings.job_short_lane_workers,
+    short_job_max_bytes=settings.job_short_max_bytes,
+    max_queued_jobs=settings.job_max_queued,
+    max_queued_jobs_per_tenant=settings.job_max_queued_per_tenant,
+    max_running_jobs_per_tenant=settings.job_max_running_per_tenant,
+    tenant_weights=settings.job_tenant_weights,
+)
@@ -0,0 +1,66 @@
+# -------------------------------------------------------------------------------
+# Engineering
+# lazy_import.py
+# -------------------------------------------------------------------------------
+"""Defer importing heavy dependencies until they are first used"""
+# -------------------------------------------------------------------------------
+# Copyright (C) 2022 Secure Ai Labs, Inc. All Rights Reserved.
+# Private and Confidential. Internal Use Only.
+#     This software contains proprietary information which shall not
+#     be reproduced or transferred to other documents and shall not
+#     be disclosed to others for any purpose without
+#     prior written permission of Secure Ai Labs, Inc.
+# -------------------------------------------------------------------------------
+
+import importlib
+import types
+from typing import List, Optional
+
+lazy_modules: List["LazyModule"] = []
+
+
+class LazyModule(types.ModuleType):
+    """Stand-in for a module that imports the real module on the first attribute access"""
+
+    def __init__(self, name: str):
+        super().__init__(name)
+        self._module: Optional[types.ModuleType] = None
+
+    def __getattr__(self, attribute: str):
+        return getattr(self.load(), attribute)
+
+    def load(self) -> types.ModuleType:
+        """
+        Import the real module if it is not imported yet
+
+        :return: the imported module
+        :rtype: types.ModuleType
+        """
+        if self._module is None:
+            # The import system serializes concurrent imports of the same module
+            self._module = importlib.import_module(self.__name__)
+        return self._module
+
+
+def lazy_import(name: str) -> LazyModule:
+    """
+    Get a module that is only imported when one of its attributes is used
+
+    :param name: the fully qualified name of the module
+    :type name: str
+    :return: the lazily imported module
+    :rtype: LazyModule
+    """
+    module = LazyModule(name)
+    lazy_modules.append(module)
+    return module
+
+
+def warm_up_lazy_imports():
+    """Import all the lazily imported modules, meant to be run once the server is already serving requests"""
+    for module in lazy_modules:
+        try:
+            module.load()
+        except ImportError:
+            # An optional dependency that is not installed, its users fail or fall back on first use instead
+            pass
@@ -0,0 +1,198 @@
+# -------------------------------------------------------------------------------
+# Engineering
+# memory_budget.py
+# -------------------------------------------------------------------------------
+"""Process wide budget of the memory the upload jobs buffer data in"""
+# -------------------------------------------------------------------------------
+# Copyright (C) 2022 Secure Ai Labs, Inc. All Rights Reserved.
+# Private and Confidential. Internal Use Only.
+#     This software contains proprietary information which shall not
+#     be reproduced or transferred to other documents and shall not
+#     be disclosed to others for any purpose without
+#     prior written permission of Secure Ai Labs, Inc.
+# -------------------------------------------------------------------------------
+
+import contextlib
+import threading
+import time
+from typing import Any, Dict, Iterator, List, Optional
+
+from app.utils.settings import settings
+
+
+class MemoryBudgetExceeded(Exception):
+    """Raised when memory could not be reserved within the budget in time"""
+
+
+class MemoryBudget:
+    """
+    Account the bytes of the large buffers of the upload jobs against a fixed budget, like a semaphore
+    counting bytes. A reservation waits until enough of the budget is free, or takes less when the
+    caller can do with less, like a smaller chunk size. It fails once the wait times out.
+
+    Released buffers are kept in a pool for the next reservation of the same size. Pooled buffers count
+    against the budget and are dropped when a reservation needs their room.
+    """
+
+    def __init__(self, limit: int, wait_timeout: float, max_pooled_bytes: int):
+        self.limit = limit
+        self.wait_timeout = wait_timeout
+        self.max_pooled_bytes = max_pooled_bytes
+        self._condition = threading.Condition()
+        self._pool: Dict[int, List[bytearray]] = {}
+        self._in_use = 0
+        self._pooled = 0
+        self._peak = 0
+
+        # Metrics
+        self._waits = 0
+        self._shrinks = 0
+        self._rejections = 0
+        self._pool_hits = 0
+
+    def acquire(
+        self, size: int, min_size: Optional[int] = None, blocking: bool = True, timeout: Optional[float] = None
+    ) -> int:
+        """
+        Reserve bytes of the budget
+
+        :param size: the bytes wanted
+        :type size: int
+        :param min_size: the least bytes the caller can do with, size if None
+        :type min_size: Optional[int]
+        :param blocking: wait for the bytes to be released, otherwise return 0 right away instead of waiting or failing
+        :type blocking: bool
+        :param timeout: the longest wait in seconds, wait_timeout if None
+        :type timeout: Optional[float]
+        :raises MemoryBudgetExceeded: if the bytes are not available in time, or never can be
+        :return: the bytes reserved, between min_size and size, to be given back to release
+        :rtype: int
+        """
+        min_size = size if min_size is None else min(min_size, size)
+        deadline = time.monotonic() + (self.wait_timeout if timeout is None else timeout)
+        with self._condition:
+            if self.limit > 0 and min_size > self.limit:
+                if not blocking:
+                    return 0
+                self._rejections += 1
+                raise MemoryBudgetExceeded(f"{min_size} bytes is more than the memory budget of {self.limit} bytes")
+
+            waited = False
+            while True:
+                granted = self._get_grant(size, min_size)
+                if granted:
+                    break
+                remaining = deadline - time.monotonic()
+                if not blocking or remaining <= 0:
+                    if blocking:
+                        self._rejections += 1
+                        raise MemoryBudgetExceeded(f"{min_size} bytes of memory were not available in time")
+                    return 0
+                if not waited:
+                    self._waits += 1
+                    waited = True
+                self._condition.wait(remaining)
+
+            self._reserve(granted)
+            return granted
+
+    def release(self, size: int):
+        """Give back bytes returned by acquire"""
+        with self._condition:
+            self._in_use -= size
+            self._condition.notify_all()
+
+    @contextlib.contextmanager
+    def reserve(self, size: int, min_size: Optional[int] = None) -> Iterator[int]:
+        """Reserve bytes for the duration of the block, see acquire"""
+        granted = self.acquire(size, min_size)
+        try:
+            yield granted
+        finally:
+            self.release(granted)
+
+    @contextlib.contextmanager
+    def buffer(self, size: int, min_size: Optional[int] = None) -> Iterator[memoryview]:
+        """
+        Get a buffer from the pool for the duration of the block, see acquire
+
+        :param size: the size of the buffer wanted
+        :type size: int
+        :param min_size: the smallest buffer the caller can do with, size if None
+        :type min_size: Optional[int]
+        :return: the buffer, of the size reserved
+        :rtype: Iterator[memoryview]
+        """
+        with self._condition:
+            buffers = self._pool.get(size)
+            if buffers:
+                pooled_buffer = buffers.pop()
+                self._pooled -= size
+                self._pool_hits += 1
+                self._reserve(size)
+            else:
+                pooled_buffer = None
+
+        if pooled_buffer is None:
+            pooled_buffer = bytearray(self.acquire(size, min_size))
+
+        try:
+            yield memoryview(pooled_buffer)
+        finally:
+            with self._condition:
+                self._in_use -= len(pooled_buffer)
+                if self._pooled + len(pooled_buffer) <= self.max_pooled_bytes:
+                    self._pool.setdefault(len(pooled_buffer), []).append(pooled_buffer)
+                    self._pooled += len(pooled_buffer)
+                self._condition.notify_all()
+
+    def get_metrics(self) -> Dict[str, Any]:
+        """
+        Get a snapshot of the accounted memory
+
+        :return: the memory metrics in bytes and the counts of waiting, shrunk and rejected reservations
+        :rtype: Dict[str, Any]
+        """
+        with self._condition:
+            return {
+                "limit_bytes": self.limit,
+                "in_use_bytes": self._in_use,
+                "pooled_bytes": self._pooled,
+                "peak_bytes": self._peak,
+                "waits": self._waits,
+                "shrinks": self._shrinks,
+                "rejections": self._rejections,
+                "pool_hits": self._pool_hits,
+            }
+
+    def _get_grant(self, size: int, min_size: int) -> int:
+        """Get the bytes that can be reserved now, dropping pooled buffers to make room, 0 if not enough"""
+        if self.limit <= 0:
+            return size
+
+        while self.limit - self._in_use - self._pooled < size and self._pooled:
+            pool_size, buffers = next(iter(self._pool.items()))
+            buffers.pop()
+            self._pooled -= pool_size
+            if not buffers:
+                del self._pool[pool_size]
+
+        available = self.limit - self._in_use - self._pooled
+        if available >= size:
+            return size
+        if available >= min_size:
+            # Shrink to a power of two, so that the shrunk buffers can be pooled and reused
+            self._shrinks += 1
+            return max(min_size, 1 << (available.bit_length() - 1))
+        return 0
+
+    def _reserve(self, size: int):
+        self._in_use += size
+        self._peak = max(self._peak, self._in_use + self._pooled)
+
+
+memory_budget = MemoryBudget(
+    limit=settings.memory_budget_bytes,
+    wait_timeout=settings.memory_budget_wait_timeout,
+    max_pooled_bytes=settings.memory_pool_max_bytes,
+)
@@ -0,0 +1,322 @@
+# -------------------------------------------------------------------------------
+# Engineering
+# parallel_zip.py
+# -------------------------------------------------------------------------------
+"""Write zip files with the members deflated in parallel on a thread pool"""
+# -------------------------------------------------------------------------------
+# Copyright (C) 2022 Secure Ai Labs, Inc. All Rights Reserved.
+# Private and Confidential. Internal Use Only.
+#     This software contains proprietary information which shall not
+#     be reproduced or transferred to other documents and shall not
+#     be disclosed to others for any purpose without
+#     prior written permission of Secure Ai Labs, Inc.
+# -------------------------------------------------------------------------------
+
+import os
+import stat
+import struct
+import threading
+import time
+import zlib
+from collections import deque
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+from typing import BinaryIO, Deque, Iterable, Iterator, List, Optional, Tuple
+
+from app.utils.settings import settings
+
+# Size of the deflate window, every block is primed with this much of the previous block like pigz does
+DEFLATE_WINDOW_SIZE = 32 * 1024
+
+ZIP64_LIMIT = (1 << 31) - 1
+ZIP_DEFLATED = 8
+UTF8_FLAG = 0x800
+UNIX_SYSTEM = 3
+DEFLATE_VERSION = 20
+ZIP64_VERSION = 45
+
+LOCAL_FILE_HEADER = struct.Struct("<4s2B4HL2L2H")
+CENTRAL_DIRECTORY_HEADER = struct.Struct("<4s4B4HL2L5H2L")
+END_OF_CENTRAL_DIRECTORY = struct.Struct("<4s4H2LH")
+ZIP64_END_OF_CENTRAL_DIRECTORY = struct.Struct("<4sQ2H2L4Q")
+ZIP64_END_OF_CENTRAL_DIRECTORY_LOCATOR = struct.Struct("<4sLQL")
+
+_compression_pool: Optional[ThreadPoolExecutor] = None
+_compression_pool_lock = threading.Lock()
+
+
+def get_compression_pool() -> ThreadPoolExecutor:
+    """Get the thread pool shared by all the archive writers, zlib releases the GIL while it deflates"""
+    global _compression_pool
+    with _compression_pool_lock:
+        if _compression_pool is None:
+            _compression_pool = ThreadPoolExecutor(
+                max_workers=settings.zip_compression_workers or os.cpu_count() or 1, thread_name_prefix="deflate"
+            )
+        return _compression_pool
+
+
+def deflate_block(block: bytes, dictionary: bytes, level: int, last: bool) -> bytes:
+    """
+    Deflate one block of a member as a piece of a single raw deflate stream. A block that is not the last
+    ends on a byte boundary with a sync flush, so the compressed blocks can simply be concatenated.
+    """
+    if dictionary:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15, zdict=dictionary)
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    return compressor.compress(block) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+def iter_file_chunks(path: str, chunk_size: int) -> Iterator[bytes]:
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+
+def get_dos_date_time(timestamp: float) -> Tuple[int, int]:
+    date_time = time.localtime(max(timestamp, 315532800))  # zip dates start in 1980
+    dos_time = (date_time.tm_hour << 11) | (date_time.tm_min << 5) | (date_time.tm_sec // 2)
+    dos_date = ((date_time.tm_year - 1980) << 9) | (date_time.tm_mon << 5) | date_time.tm_mday
+    return dos_time, dos_date
+
+
+class _Member:
+    def __init__(self, arcname: str, size: int, mtime: float, mode: int):
+        self.name = arcname.encode("utf-8")
+        self.flags = 0 if arcname.isascii() else UTF8_FLAG
+        self.zip64 = size * 1.05 > ZIP64_LIMIT
+        self.dos_time, self.dos_date = get_dos_date_time(mtime)
+        self.external_attr = (mode & 0xFFFF) << 16
+        self.header_offset = -1
+        self.crc = 0
+        self.file_size = 0
+        self.compress_size = 0
+        self.pending_blocks = 0
+        self.read_done = False
+
+
+class ParallelZipWriter:
+    """
+    Write a zip file with deflated members, pigz style: every member is cut in blocks that are deflated
+    on a thread pool while the next blocks are read, and the compressed blocks are written in order.
+    Blocks of the next member start compressing while the previous member is still being written. The
+    CRC is computed while reading and the local headers are patched once a member is written, so the
+    output file must be seekable. The result is a standard zip file, with zip64 records when needed.
+    """
+
+    def __init__(
+        self,
+        file: BinaryIO,
+        level: int,
+        block_size: int,
+        pool: Optional[Executor] = None,
+        max_pending_blocks: Optional[int] = None,
+    ):
+        self.file = file
+        self.level = level
+        self.block_size = block_size
+        self.pool = pool or get_compression_pool()
+        self.max_pending_blocks = max_pending_blocks or 2 * (getattr(self.pool, "_max_workers", 1) or 1)
+        self._members: List[_Member] = []
+        self._pending: Deque[Tuple[_Member, "Future[bytes]"]] = deque()
+        self._start = file.tell()
+
+    def __enter__(self) -> "ParallelZipWriter":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            for _, future in self._pending:
+                future.cancel()
+
+    def write(self, path: str, arcname: Optional[str] = None):
+        """Add a file to the zip, like ZipFile.write"""
+        file_stat = os.stat(path)
+        self.write_chunks(
+            arcname or os.path.basename(path),
+            iter_file_chunks(path, self.block_size),
+            file_stat.st_size,
+            file_stat.st_mtime,
+            file_stat.st_mode,
+        )
+
+    def write_chunks(
+        self,
+        arcname: str,
+        chunks: Iterable[bytes],
+        size: int,
+        mtime: Optional[float] = None,
+        mode: int = stat.S_IFREG | 0o600,
+    ):
+        """
+        Add a member with the given content
+
+        :param arcname: the name of the member
+        :type arcname: str
+        :param chunks: the content of the member, in chunks of any size
+        :type chunks: Iterable[bytes]
+        :param size: the expected size of the content, to decide if the member needs zip64 records
+        :type size: int
+        :param mtime: the modification time of the member, now if None
+        :type mtime: Optional[float]
+        :param mode: the unix mode of the member
+        :type mode: int
+        """
+        member = _Member(arcname, size, time.time() if mtime is None else mtime, mode)
+        self._members.append(member)
+
+        previous_block = b""
+        block = bytearray()
+        for chunk in chunks:
+            block += chunk
+            while len(block) > self.block_size:
+                self._submit_block(member, bytes(block[: self.block_size]), previous_block, last=False)
+                previous_block = block[max(0, self.block_size - DEFLATE_WINDOW_SIZE) : self.block_size]
+                del block[: self.block_size]
+        self._submit_block(member, bytes(block), previous_block, last=True)
+
+    def close(self):
+        """Write the remaining blocks and the central directory"""
+        self._write_ready_blocks(0)
+        self._write_central_directory()
+
+    def _submit_block(self, member: _Member, block: bytes, previous_block: bytes, last: bool):
+        member.crc = zlib.crc32(block, member.crc)
+        member.file_size += len(block)
+        member.pending_blocks += 1
+        member.read_done = last
+        self._pending.append(
+            (
+                member,
+                self.pool.submit(deflate_block, block, bytes(previous_block[-DEFLATE_WINDOW_SIZE:]), self.level, last),
+            )
+        )
+        self._write_ready_blocks(self.max_pending_blocks)
+
+    def _write_ready_blocks(self, max_pending_blocks: int):
+        """Write blocks in order until at most max_pending_blocks are left"""
+        while len(self._pending) > max_pending_blocks:
+            member, future = self._pending.popleft()
+            if member.header_offset < 0:
+                member.header_offset = self.file.tell() - self._start
+                self.file.write(self._get_local_header(member))
+
+            compressed = future.result()
+            self.file.write(compressed)
+            member.compress_size += len(compressed)
+            member.pending_blocks -= 1
+            if member.read_done and member.pending_blocks == 0:
+                self._patch_local_header(member)
+
+    def _get_local_header(self, member: _Member) -> bytes:
+        if member.zip64:
+            extra = struct.pack("<HHQQ", 1, 16, member.file_size, member.compress_size)
+            sizes = (0xFFFFFFFF, 0xFFFFFFFF)
+        else:
+            extra = b""
+            sizes = (member.compress_size, member.file_size)
+        return (
+            LOCAL_FILE_HEADER.pack(
+                b"PK\003\004",
+                ZIP64_VERSION if member.zip64 else DEFLATE_VERSION,
+                0,
+                member.flags,
+                ZIP_DEFLATED,
+                member.dos_time,
+                member.dos_date,
+                member.crc,
+                sizes[0],
+                sizes[1],
+                len(member.name),
+                len(extra),
+            )
+            + member.name
+            + extra
+        )
+
+    def _patch_local_header(self, member: _Member):
+        if not member.zip64 and max(member.file_size, member.compress_size) > ZIP64_LIMIT:
+            raise Exception(f"The member {member.name.decode()} is larger than its expected size")
+        end = self.file.tell()
+        self.file.seek(self._start + member.header_offset)
+        self.file.write(self._get_local_header(member))
+        self.file.seek(end)
+
+    def _write_central_directory(self):
+        central_directory_offset = self.file.tell() - self._start
+        for member in self._members:
+            zip64_fields = []
+            file_size, compress_size, header_offset = member.file_size, member.compress_size, member.header_offset
+            if file_size > ZIP64_LIMIT:
+                zip64_fields.append(file_size)
+                file_size = 0xFFFFFFFF
+            if compress_size > ZIP64_LIMIT:
+                zip64_fields.append(compress_size)
+                compress_size = 0xFFFFFFFF
+            if header_offset > ZIP64_LIMIT:
+                zip64_fields.append(header_offset)
+                header_offset = 0xFFFFFFFF
+            extra = (
+                struct.pack(f"<HH{len(zip64_fields)}Q", 1, 8 * len(zip64_fields), *zip64_fields)
+                if zip64_fields
+                else b""
+            )
+            version = ZIP64_VERSION if zip64_fields or member.zip64 else DEFLATE_VERSION
+            self.file.write(
+                CENTRAL_DIRECTORY_HEADER.pack(
+                    b"PK\001\002",
+                    version,
+                    UNIX_SYSTEM,
+                    version,
+                    0,
+                    member.flags,
+                    ZIP_DEFLATED,
+                    member.dos_time,
+                    member.dos_date,
+                    member.crc,
+                    compress_size,
+                    file_size,
+                    len(member.name),
+                    len(extra),
+                    0,
+                    0,
+                    0,
+                    member.external_attr,
+                    header_offset,
+                )
+                + member.name
+                + extra
+            )
+
+        central_directory_end = self.file.tell() - self._start
+        central_directory_size = central_directory_end - central_directory_offset
+        count = len(self._members)
+        if count >= 0xFFFF or central_directory_offset > ZIP64_LIMIT or central_directory_size > ZIP64_LIMIT:
+            self.file.write(
+                ZIP64_END_OF_CENTRAL_DIRECTORY.pack(
+                    b"PK\006\006",
+                    ZIP64_END_OF_CENTRAL_DIRECTORY.size - 12,
+                    ZIP64_VERSION,
+                    ZIP64_VERSION,
+                    0,
+                    0,
+                    count,
+                    count,
+                    central_directory_size,
+                    central_directory_offset,
+                )
+            )
+            self.file.write(ZIP64_END_OF_CENTRAL_DIRECTORY_LOCATOR.pack(b"PK\006\007", 0, central_directory_end, 1))
+            count = min(count, 0xFFFF)
+            central_directory_size = min(central_directory_size, 0xFFFFFFFF)
+            central_directory_offset = min(central_directory_offset, 0xFFFFFFFF)
+        self.file.write(
+            END_OF_CENTRAL_DIRECTORY.pack(
+                b"PK\005\006", 0, 0, count, count, central_directory_size, central_directory_offset, 0
+            )
+        )
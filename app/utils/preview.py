@@ -0,0 +1,90 @@
+# -------------------------------------------------------------------------------
+# Engineering
+# preview.py
+# -------------------------------------------------------------------------------
+"""Sample a few representative rows of every CSV file while it is packaged"""
+# -------------------------------------------------------------------------------
+# Copyright (C) 2022 Secure Ai Labs, Inc. All Rights Reserved.
+# Private and Confidential. Internal Use Only.
+#     This software contains proprietary information which shall not
+#     be reproduced or transferred to other documents and shall not
+#     be disclosed to others for any purpose without
+#     prior written permission of Secure Ai Labs, Inc.
+# -------------------------------------------------------------------------------
+
+import math
+import random
+from typing import Any, Dict, List, Optional, Tuple
+
+
+class CsvReservoirSampler:
+    """
+    Keep a uniform sample of the rows of a CSV file, in a single pass.
+
+    Uses reservoir sampling with Li's algorithm L, which draws how many rows to skip before the next
+    replacement instead of a random number per row. The same seed and content always give the same
+    sample.
+    """
+
+    def __init__(self, name: str, sample_size: int, seed: int):
+        self.name = name
+        self.sample_size = sample_size
+        self.seed = seed
+        self.header: Optional[bytes] = None
+        self.row_count = 0
+        self._random = random.Random(seed)
+        self._reservoir: List[Tuple[int, bytes]] = []
+        self._weight = 0.0
+        self._next_index = 0
+
+    def add_rows(self, rows: List[bytes]):
+        """Add the next rows of the file, the first one is the header"""
+        index = 0
+        if self.header is None and rows:
+            self.header = rows[0]
+            index = 1
+
+        # Fill the reservoir with the first rows
+        while len(self._reservoir) < self.sample_size and index < len(rows):
+            self._reservoir.append((self.row_count, rows[index]))
+            self.row_count += 1
+            index += 1
+            if len(self._reservoir) == self.sample_size:
+                self._weight = math.exp(math.log(self._uniform()) / self.sample_size)
+                self._next_index = self.row_count - 1
+                self._skip()
+
+        if len(self._reservoir) < self.sample_size:
+            return
+
+        # Jump straight to the rows replacing a random row of the reservoir
+        while True:
+            skipped = self._next_index - self.row_count
+            if index + skipped >= len(rows):
+                self.row_count += len(rows) - index
+                return
+            index += skipped
+            self.row_count += skipped
+            self._reservoir[self._random.randrange(self.sample_size)] = (self.row_count, rows[index])
+            index += 1
+            self.row_count += 1
+            self._skip()
+
+    def to_csv(self) -> bytes:
+        """Get the header and the sampled rows, in the order of the file"""
+        rows = [self.header or b""] + [row for _, row in sorted(self._reservoir)]
+        return b"\n".join(rows) + b"\n"
+
+    def to_manifest(self) -> Dict[str, Any]:
+        return {"name": self.name, "sampled_rows": len(self._reservoir), "total_rows": self.row_count}
+
+    def _uniform(self) -> float:
+        """A random number in (0, 1), so that its logarithm is defined"""
+        while True:
+            value = self._random.random()
+            if value > 0.0:
+                return value
+
+    def _skip(self):
+        self._next_index += int(math.floor(math.log(self._uniform()) / math.log(1 - self._weight))) + 1
+        self._weight *= math.exp(math.log(self._uniform()) / self.sample_size)
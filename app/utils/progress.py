@@ -0,0 +1,193 @@
+# -------------------------------------------------------------------------------
+# Engineering
+# progress.py
+# -------------------------------------------------------------------------------
+"""In-process bus to publish and follow the progress of the upload jobs"""
+# -------------------------------------------------------------------------------
+# Copyright (C) 2022 Secure Ai Labs, Inc. All Rights Reserved.
+# Private and Confidential. Internal Use Only.
+#     This software contains proprietary information which shall not
+#     be reproduced or transferred to other documents and shall not
+#     be disclosed to others for any purpose without
+#     prior written permission of Secure Ai Labs, Inc.
+# -------------------------------------------------------------------------------
+
+import asyncio
+import threading
+import time
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+from app.utils.settings import settings
+
+# Stages a job goes through, the last two are final
+QUEUED = "QUEUED"
+STAGING = "STAGING"
+PACKAGING = "PACKAGING"
+ENCRYPTING = "ENCRYPTING"
+UPLOADING = "UPLOADING"
+ACTIVE = "ACTIVE"
+ERROR = "ERROR"
+FINAL_STAGES = (ACTIVE, ERROR)
+
+
+class JobProgress:
+    def __init__(self, stage: str):
+        self.stage = stage
+        self.bytes_processed = 0
+        self.bytes_total = 0
+        self.updated_at = time.time()
+        self.version = 0
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "stage": self.stage,
+            "bytes_processed": self.bytes_processed,
+            "bytes_total": self.bytes_total,
+            "updated_at": self.updated_at,
+        }
+
+
+class ProgressBus:
+    """
+    Latest progress of every job, keyed by dataset version id.
+
+    Publishing only updates the latest state under a lock, so it is cheap enough to call from the
+    packaging pipeline on every chunk. Subscribers wake up on stage changes and otherwise look at the
+    state at most once every min_interval seconds, so any number of byte count updates in between
+    are coalesced into a single event.
+    """
+
+    def __init__(self, min_interval: float, retention: float):
+        self.min_interval = min_interval
+        self.retention = retention
+        self._lock = threading.Lock()
+        self._progress: Dict[str, JobProgress] = {}
+        self._subscribers: Dict[str, List[Tuple[asyncio.AbstractEventLoop, asyncio.Event]]] = {}
+
+    def publish(
+        self,
+        job_id: str,
+        stage: Optional[str] = None,
+        bytes_processed: Optional[int] = None,
+        bytes_total: Optional[int] = None,
+    ):
+        """
+        Update the progress of a job
+
+        :param job_id: the dataset version id of the job
+        :type job_id: str
+        :param stage: the stage the job is in, unchanged if None
+        :type stage: Optional[str]
+        :param bytes_processed: bytes processed in the current stage, unchanged if None
+        :type bytes_processed: Optional[int]
+        :param bytes_total: total bytes of the current stage, unchanged if None
+        :type bytes_total: Optional[int]
+        """
+        with self._lock:
+            progress = self._progress.get(job_id)
+            if progress is None:
+                progress = self._progress[job_id] = JobProgress(stage or QUEUED)
+            stage_changed = stage is not None and stage != progress.stage
+            if stage_changed:
+                progress.stage = stage  # type: ignore
+                progress.bytes_processed = 0
+                progress.bytes_total = 0
+            if bytes_processed is not None:
+                progress.bytes_processed = bytes_processed
+            if bytes_total is not None:
+                progress.bytes_total = bytes_total
+            progress.updated_at = time.time()
+            progress.version += 1
+
+            if stage_changed and progress.stage in FINAL_STAGES:
+                self._remove_expired()
+            subscribers = list(self._subscribers.get(job_id, [])) if stage_changed else []
+
+        for loop, event in subscribers:
+            loop.call_soon_threadsafe(event.set)
+
+    def discard(self, job_id: str):
+        """
+        Forget a job that was never started
+
+        :param job_id: the dataset version id of the job
+        :type job_id: str
+        """
+        with self._lock:
+            self._progress.pop(job_id, None)
+            subscribers = list(self._subscribers.get(job_id, []))
+
+        for loop, event in subscribers:
+            loop.call_soon_threadsafe(event.set)
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """
+        Get the latest progress of a job
+
+        :param job_id: the dataset version id of the job
+        :type job_id: str
+        :return: the progress or None if the job is unknown
+        :rtype: Optional[Dict[str, Any]]
+        """
+        with self._lock:
+            progress = self._progress.get(job_id)
+            return progress.to_dict() if progress else None
+
+    async def subscribe(self, job_id: str, keepalive_interval: float) -> AsyncIterator[Optional[Dict[str, Any]]]:
+        """
+        Follow the progress of a job until it reaches a final stage
+
+        :param job_id: the dataset version id of the job
+        :type job_id: str
+        :param keepalive_interval: yield None if nothing changed for this many seconds
+        :type keepalive_interval: float
+        :return: the progress every time it changes, or None as a keepalive
+        :rtype: AsyncIterator[Optional[Dict[str, Any]]]
+        """
+        event = asyncio.Event()
+        subscriber = (asyncio.get_running_loop(), event)
+        with self._lock:
+            self._subscribers.setdefault(job_id, []).append(subscriber)
+
+        try:
+            last_version = -1
+            last_sent_at = time.monotonic()
+            while True:
+                with self._lock:
+                    progress = self._progress.get(job_id)
+                    if progress is None:
+                        return
+                    snapshot, version = progress.to_dict(), progress.version
+
+                if version != last_version:
+                    last_version = version
+                    last_sent_at = time.monotonic()
+                    yield snapshot
+                    if snapshot["stage"] in FINAL_STAGES:
+                        return
+                elif time.monotonic() - last_sent_at >= keepalive_interval:
+                    last_sent_at = time.monotonic()
+                    yield None
+
+                event.clear()
+                try:
+                    await asyncio.wait_for(event.wait(), timeout=self.min_interval)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            with self._lock:
+                self._subscribers[job_id].remove(subscriber)
+                if not self._subscribers[job_id]:
+                    del self._subscribers[job_id]
+
+    def _remove_expired(self):
+        expired_before = time.time() - self.retention
+        for job_id in [
+            job_id
+            for job_id, progress in self._progress.items()
+            if progress.stage in FINAL_STAGES and progress.updated_at < expired_before
+        ]:
+            del self._progress[job_id]
+
+
+progress_bus = ProgressBus(min_interval=settings.progress_min_interval, retention=settings.progress_retention)
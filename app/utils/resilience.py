@@ -0,0 +1,214 @@
+# -------------------------------------------------------------------------------
+# Engineering
+# resilience.py
+# -------------------------------------------------------------------------------
+"""Retry budget and circuit breaker shared by the calls to a remote service"""
+# -------------------------------------------------------------------------------
+# Copyright (C) 2022 Secure Ai Labs, Inc. All Rights Reserved.
+# Private and Confidential. Internal Use Only.
+#     This software contains proprietary information which shall not
+#     be reproduced or transferred to other documents and shall not
+#     be disclosed to others for any purpose without
+#     prior written permission of Secure Ai Labs, Inc.
+# -------------------------------------------------------------------------------
+
+import math
+import random
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Deque, Dict, Optional
+
+# Calls and retries older than this many seconds no longer count against the retry budget
+RETRY_BUDGET_WINDOW = 10.0
+
+# States of the circuit breaker
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpen(Exception):
+    """Raised instead of calling a service the circuit breaker found unhealthy"""
+
+    def __init__(self, retry_after: int, message: str):
+        self.retry_after = retry_after
+        super().__init__(message)
+
+
+def get_backoff_delay(attempt: int, base_delay: float, max_delay: float) -> float:
+    """
+    Get the delay before a retry, exponential in the attempt with full jitter so that the callers that failed
+    together do not retry together
+
+    :param attempt: the number of the retry, from 0
+    :type attempt: int
+    :param base_delay: the upper bound of the first delay in seconds
+    :type base_delay: float
+    :param max_delay: the upper bound of every delay in seconds
+    :type max_delay: float
+    :return: the delay in seconds
+    :rtype: float
+    """
+    return random.uniform(0, min(max_delay, base_delay * 2**attempt))
+
+
+class RetryBudget:
+    """
+    Share of the calls that may be retried across the process. Over the last window, the retries may not
+    exceed ratio of the calls plus min_per_second, so that retries add a bounded share to the load of a
+    failing service instead of multiplying it.
+    """
+
+    def __init__(self, ratio: float, min_per_second: float):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self._lock = threading.Lock()
+        self._calls: Deque[float] = deque()
+        self._retries: Deque[float] = deque()
+
+        # Metrics
+        self._call_count = 0
+        self._retry_count = 0
+        self._exhausted_count = 0
+
+    def record_call(self):
+        """Record a call, which adds ratio of a retry to the budget"""
+        with self._lock:
+            self._calls.append(time.monotonic())
+            self._call_count += 1
+
+    def try_retry(self) -> bool:
+        """
+        Take a retry from the budget
+
+        :return: False if the budget is exhausted and the call must not be retried
+        :rtype: bool
+        """
+        now = time.monotonic()
+        with self._lock:
+            for timestamps in (self._calls, self._retries):
+                while timestamps and timestamps[0] < now - RETRY_BUDGET_WINDOW:
+                    timestamps.popleft()
+            if len(self._retries) >= self.ratio * len(self._calls) + self.min_per_second * RETRY_BUDGET_WINDOW:
+                self._exhausted_count += 1
+                return False
+            self._retries.append(now)
+            self._retry_count += 1
+            return True
+
+    def get_metrics(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"calls": self._call_count, "retries": self._retry_count, "retries_exhausted": self._exhausted_count}
+
+
+class CircuitBreaker:
+    """
+    Fail the calls to a service fast once it looks down. The breaker opens after failure_threshold failures in
+    a row and rejects every call for open_seconds. It is then half open: up to half_open_calls trial calls go
+    through, the first one to succeed closes it and the first one to fail opens it again.
+
+    Only failures that tell the service is unhealthy, like timeouts or a 503, must be recorded as failures.
+    Any other response, an error included, shows the service is up and is recorded as a success. A call that
+    failed without a response for another reason, like an invalid request, is not recorded.
+    """
+
+    def __init__(
+        self,
+        failure_threshold: int,
+        open_seconds: float,
+        half_open_calls: int,
+        on_open: Optional[Callable[[float], None]] = None,
+    ):
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.half_open_calls = half_open_calls
+        self.on_open = on_open
+        self._condition = threading.Condition()
+        self._state = CLOSED
+        self._opened_at = 0.0
+        self._consecutive_failures = 0
+        self._trial_calls = 0
+        self._trials_started_at = 0.0
+
+        # Metrics
+        self._open_count = 0
+        self._rejected_calls = 0
+
+    def before_call(self, wait: bool = False):
+        """
+        Check that a call may go through, to be followed by record_success or record_failure once it is over
+
+        :param wait: wait for the breaker to half open and for the outcome of its trial calls rather than fail, for
+            callers on a worker thread
+        :type wait: bool
+        :raises CircuitOpen: if the breaker is open, or half open without room for another trial call, and wait is
+            not set
+        """
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                if self._state == OPEN and now - self._opened_at >= self.open_seconds:
+                    self._state = HALF_OPEN
+                    self._trial_calls = 0
+                    self._trials_started_at = now
+                if self._state == HALF_OPEN and now - self._trials_started_at >= self.open_seconds:
+                    # The outcome of trial calls cancelled on the way is never recorded, let new ones through
+                    self._trial_calls = 0
+                    self._trials_started_at = now
+                if self._state == CLOSED:
+                    return
+                if self._state == HALF_OPEN and self._trial_calls < self.half_open_calls:
+                    self._trial_calls += 1
+                    return
+                if self._state == OPEN and wait:
+                    self._condition.wait(self.open_seconds - (now - self._opened_at))
+                    continue
+                if self._state == HALF_OPEN and wait:
+                    self._condition.wait(self.open_seconds - (now - self._trials_started_at))
+                    continue
+                self._rejected_calls += 1
+                raise CircuitOpen(self._get_retry_after(), "The service is unavailable, try again later.")
+
+    def record_success(self):
+        """Record a call the service responded to"""
+        with self._condition:
+            self._consecutive_failures = 0
+            # The calls admitted before the breaker opened do not close it, only the trial calls do
+            if self._state == HALF_OPEN:
+                self._state = CLOSED
+                self._condition.notify_all()
+
+    def record_failure(self):
+        """Record a call that failed because the service is unhealthy"""
+        opened = False
+        with self._condition:
+            self._consecutive_failures += 1
+            if self._state == HALF_OPEN or (
+                self._state == CLOSED and self._consecutive_failures >= self.failure_threshold
+            ):
+                self._state = OPEN
+                self._opened_at = time.monotonic()
+                self._open_count += 1
+                self._condition.notify_all()
+                opened = True
+        if opened and self.on_open is not None:
+            self.on_open(self.open_seconds)
+
+    def get_metrics(self) -> Dict[str, Any]:
+        with self._condition:
+            return {
+                "state": self._state,
+                "consecutive_failures": self._consecutive_failures,
+                "open_count": self._open_count,
+                "rejected_calls": self._rejected_calls,
+                "retry_after": self._get_retry_after(),
+            }
+
+    def _get_retry_after(self) -> int:
+        # Half open, the outcome of the trial calls is known within a call timeout
+        if self._state == CLOSED:
+            return 0
+        if self._state == HALF_OPEN:
+            return 1
+        return max(1, math.ceil(self.open_seconds - (time.monotonic() - self._opened_at)))
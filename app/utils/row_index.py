@@ -0,0 +1,109 @@
+# -------------------------------------------------------------------------------
+# Engineering
+# row_index.py
+# -------------------------------------------------------------------------------
+"""Index the byte offset of every Nth row of the CSV files of a package"""
+# -------------------------------------------------------------------------------
+# Copyright (C) 2022 Secure Ai Labs, Inc. All Rights Reserved.
+# Private and Confidential. Internal Use Only.
+#     This software contains proprietary information which shall not
+#     be reproduced or transferred to other documents and shall not
+#     be disclosed to others for any purpose without
+#     prior written permission of Secure Ai Labs, Inc.
+# -------------------------------------------------------------------------------
+#
+# Binary format of an index, all the integers are little endian:
+#     magic        4 bytes  b"SRIX"
+#     version      uint16   1
+#     reserved     uint16   0
+#     stride       uint32   number of rows between two entries
+#     row_count    uint64   number of rows after the header row
+#     file_size    uint64   size of the CSV file in bytes
+#     entry_count  uint64   number of entries
+#     entries      uint64[entry_count], entry k is the byte offset where row k * stride starts
+#
+# Row 0 is the first row after the header, so entry 0 is the size of the header row. Readers split a
+# file in chunks at any entries, or seek to the entry before a row and skip at most stride - 1 rows.
+
+import struct
+import sys
+from array import array
+from typing import Any, Dict, List, Tuple
+
+ROW_INDEX_MAGIC = b"SRIX"
+ROW_INDEX_VERSION = 1
+ROW_INDEX_HEADER = struct.Struct("<4sHHLQQQ")
+
+
+class CsvRowIndexer:
+    """Record the offset of every stride-th row of a CSV file from its rows, as they are split"""
+
+    def __init__(self, name: str, stride: int):
+        self.name = name
+        self.stride = stride
+        self.row_count = 0
+        self.file_size = 0
+        self._offsets = array("Q")
+        self._offset = 0
+        self._header_seen = False
+
+    def add_bytes(self, size: int):
+        """Account for the next chunk of the file"""
+        self.file_size += size
+
+    def add_rows(self, rows: List[bytes]):
+        """Add the next rows of the file, the first one is the header. Only the indexed rows cost a python step."""
+        index = 0
+        if not self._header_seen:
+            self._header_seen = True
+            self._offset += len(rows[0]) + 1
+            index = 1
+
+        while index < len(rows):
+            # Rows up to the next indexed one are skipped in bulk
+            skipped = min(-self.row_count % self.stride, len(rows) - index)
+            if skipped:
+                self._offset += sum(map(len, rows[index : index + skipped])) + skipped
+                self.row_count += skipped
+                index += skipped
+                continue
+            self._offsets.append(self._offset)
+            self._offset += len(rows[index]) + 1
+            self.row_count += 1
+            index += 1
+
+    def to_bytes(self) -> bytes:
+        """Serialize the index in its binary format"""
+        offsets = array("Q", self._offsets)
+        if sys.byteorder != "little":
+            offsets.byteswap()
+        header = ROW_INDEX_HEADER.pack(
+            ROW_INDEX_MAGIC, ROW_INDEX_VERSION, 0, self.stride, self.row_count, self.file_size, len(offsets)
+        )
+        return header + offsets.tobytes()
+
+    def to_manifest(self) -> Dict[str, Any]:
+        return {"name": self.name, "index_name": get_row_index_name(self.name), "row_count": self.row_count}
+
+
+def get_row_index_name(name: str) -> str:
+    return f"{name}.rowidx"
+
+
+def read_row_index(data: bytes) -> Tuple[int, int, int, array]:
+    """
+    Parse an index in its binary format
+
+    :param data: the serialized index
+    :type data: bytes
+    :return: the stride, row count, file size and offsets
+    :rtype: Tuple[int, int, int, array]
+    """
+    magic, version, _, stride, row_count, file_size, entry_count = ROW_INDEX_HEADER.unpack_from(data)
+    if magic != ROW_INDEX_MAGIC or version != ROW_INDEX_VERSION:
+        raise Exception("Not a row index or an unsupported version")
+    offsets = array("Q")
+    offsets.frombytes(data[ROW_INDEX_HEADER.size : ROW_INDEX_HEADER.size + 8 * entry_count])
+    if sys.byteorder != "little":
+        offsets.byteswap()
+    return stride, row_count, file_size, offsets
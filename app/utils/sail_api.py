@@ -0,0 +1,213 @@
+# -------------------------------------------------------------------------------
+# Engineering
+# sail_api.py
+# -------------------------------------------------------------------------------
+"""Call the SAIL API service over a shared asyncio http client"""
+# -------------------------------------------------------------------------------
+# Copyright (C) 2022 Secure Ai Labs, Inc. All Rights Reserved.
+# Private and Confidential. Internal Use Only.
+#     This software contains proprietary information which shall not
+#     be reproduced or transferred to other documents and shall not
+#     be disclosed to others for any purpose without
+#     prior written permission of Secure Ai Labs, Inc.
+# -------------------------------------------------------------------------------
+
+import asyncio
+import time
+from typing import Any, Dict, Optional
+
+from app.utils.job_scheduler import job_scheduler
+from app.utils.lazy_import import lazy_import
+from app.utils.resilience import CircuitBreaker, RetryBudget, get_backoff_delay
+from app.utils.settings import settings
+from app.utils.tracing import Span, tracer
+
+httpx = lazy_import("httpx")
+errors = lazy_import("sail_client.errors")
+
+# Statuses of a SAIL API service that is overloaded or unreachable behind its gateway
+TRANSIENT_STATUS_CODES = (429, 502, 503, 504)
+
+IDEMPOTENT_METHODS = ("get", "head", "put", "delete", "options")
+
+retry_budget = RetryBudget(
+    ratio=settings.sail_api_retry_budget_ratio, min_per_second=settings.sail_api_retry_budget_min_per_second
+)
+
+# No upload job is started while the breaker is open, they would fail on their first call
+circuit_breaker = CircuitBreaker(
+    failure_threshold=settings.sail_api_breaker_failure_threshold,
+    open_seconds=settings.sail_api_breaker_open_seconds,
+    half_open_calls=settings.sail_api_breaker_half_open_calls,
+    on_open=job_scheduler.pause,
+)
+
+_async_http_client: Optional["httpx.AsyncClient"] = None
+_async_http_client_loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+def get_async_http_client() -> "httpx.AsyncClient":
+    """
+    Get the http client shared by all the requests handled on the running event loop, so that
+    connections and the TLS context are reused instead of being created for every call
+
+    :return: the shared client
+    :rtype: httpx.AsyncClient
+    """
+    global _async_http_client, _async_http_client_loop
+    loop = asyncio.get_running_loop()
+    if _async_http_client is None or _async_http_client_loop is not loop:
+        _async_http_client = httpx.AsyncClient(verify=True, limits=httpx.Limits(max_connections=100))
+        _async_http_client_loop = loop
+    return _async_http_client
+
+
+async def close_async_http_client():
+    """Close the shared http client, called when the server shuts down"""
+    global _async_http_client, _async_http_client_loop
+    if _async_http_client is not None:
+        await _async_http_client.aclose()
+    _async_http_client = None
+    _async_http_client_loop = None
+
+
+async def call_async(endpoint: Any, **kwargs) -> Any:
+    """
+    Call a sail_client endpoint like its asyncio variant does, but on the shared http client. Transient failures
+    of idempotent endpoints are retried, and the call fails fast while the circuit breaker is open.
+
+    :param endpoint: the sail_client.api.default module of the endpoint, e.g. get_dataset_version
+    :type endpoint: Any
+    :param kwargs: the arguments of the endpoint, including the authenticated client
+    :raises CircuitOpen: if the SAIL API service is unavailable
+    :return: the parsed response of the endpoint
+    :rtype: Any
+    """
+    with tracer.start_span(f"sail_api.{get_endpoint_name(endpoint)}") as span:
+        request_kwargs = endpoint._get_kwargs(**kwargs)
+        if not request_kwargs.get("cookies"):
+            request_kwargs.pop("cookies", None)
+        request_kwargs["headers"].update(tracer.get_trace_headers())
+
+        retry_budget.record_call()
+        attempt = 0
+        while True:
+            circuit_breaker.before_call()
+            response = None
+            try:
+                response = await get_async_http_client().request(**request_kwargs)
+                if span is not None:
+                    span.set_attribute("http.status_code", response.status_code)
+                parsed = endpoint._build_response(client=kwargs["client"], response=response).parsed
+            except Exception as exception:
+                delay = get_retry_delay(exception, response, request_kwargs["method"], attempt, span)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+
+            circuit_breaker.record_success()
+            return parsed
+
+
+def call_sync(endpoint: Any, **kwargs) -> Any:
+    """
+    Call a sail_client endpoint like its sync variant does, from the upload jobs. Transient failures of
+    idempotent endpoints are retried, and the call waits while the circuit breaker is open.
+
+    :param endpoint: the sail_client.api.default module of the endpoint, e.g. get_dataset_version
+    :type endpoint: Any
+    :param kwargs: the arguments of the endpoint, including the authenticated client
+    :return: the parsed response of the endpoint
+    :rtype: Any
+    """
+    with tracer.start_span(f"sail_api.{get_endpoint_name(endpoint)}") as span:
+        kwargs["client"] = kwargs["client"].with_headers(tracer.get_trace_headers())
+        method = endpoint._get_kwargs(**kwargs)["method"]
+
+        retry_budget.record_call()
+        attempt = 0
+        while True:
+            # A job waits for an open breaker to let calls through again rather than fail, or a dataset version
+            # marked as ENCRYPTING would never be marked as ACTIVE or ERROR
+            circuit_breaker.before_call(wait=True)
+            try:
+                response = endpoint.sync_detailed(**kwargs)
+            except Exception as exception:
+                delay = get_retry_delay(exception, None, method, attempt, span)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                attempt += 1
+                continue
+
+            circuit_breaker.record_success()
+            if span is not None:
+                span.set_attribute("http.status_code", int(response.status_code))
+            return response.parsed
+
+
+def get_retry_delay(
+    exception: Exception, response: Optional["httpx.Response"], method: str, attempt: int, span: Optional[Span]
+) -> Optional[float]:
+    """
+    Record a failed call in the circuit breaker and get the delay before retrying it
+
+    :param exception: the exception the call raised
+    :type exception: Exception
+    :param response: the response the exception was raised on, if known to the caller
+    :type response: Optional[httpx.Response]
+    :param method: the http method of the endpoint, only idempotent methods are retried
+    :type method: str
+    :param attempt: the number of retries of the call so far
+    :type attempt: int
+    :param span: the span of the call
+    :type span: Optional[Span]
+    :return: the delay in seconds, None if the call must not be retried
+    :rtype: Optional[float]
+    """
+    if isinstance(exception, errors.UnexpectedStatus) and span is not None:
+        span.set_attribute("http.status_code", exception.status_code)
+    if not is_transient_failure(exception):
+        # The failure is for the caller to handle. Only a response tells the service is up, an error raised
+        # before the request was sent or a response was received tells nothing about it.
+        if response is not None or isinstance(exception, errors.UnexpectedStatus):
+            circuit_breaker.record_success()
+        return None
+
+    circuit_breaker.record_failure()
+    if (
+        method.lower() not in IDEMPOTENT_METHODS
+        or attempt >= settings.sail_api_max_retries
+        or not retry_budget.try_retry()
+    ):
+        return None
+    delay = get_backoff_delay(attempt, settings.sail_api_retry_base_delay, settings.sail_api_retry_max_delay)
+    if span is not None:
+        span.add_event("retry", attempt=attempt + 1, delay=delay, error=type(exception).__name__)
+    return delay
+
+
+def is_transient_failure(exception: Exception) -> bool:
+    """Tell if a call failed because the SAIL API service is unreachable or overloaded"""
+    if isinstance(exception, errors.UnexpectedStatus):
+        return exception.status_code in TRANSIENT_STATUS_CODES
+    # An unsupported scheme or a request httpx refuses to send is a local error, the service was never reached
+    if isinstance(exception, (httpx.UnsupportedProtocol, httpx.LocalProtocolError)):
+        return False
+    return isinstance(exception, httpx.TransportError)
+
+
+def get_metrics() -> Dict[str, Any]:
+    """
+    Get the state of the circuit breaker and the retry counts of the SAIL API calls
+
+    :return: the SAIL API call metrics
+    :rtype: Dict[str, Any]
+    """
+    return {"circuit_breaker": circuit_breaker.get_metrics(), **retry_budget.get_metrics()}
+
+
+def get_endpoint_name(endpoint: Any) -> str:
+    return endpoint.__name__.rpartition(".")[2]
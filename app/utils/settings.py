@@ -0,0 +1,124 @@
+# -------------------------------------------------------------------------------
+# Engineering
+# settings.py
+# -------------------------------------------------------------------------------
+"""Tunable settings of the dataset upload service"""
+# -------------------------------------------------------------------------------
+# Copyright (C) 2022 Secure Ai Labs, Inc. All Rights Reserved.
+# Private and Confidential. Internal Use Only.
+#     This software contains proprietary information which shall not
+#     be reproduced or transferred to other documents and shall not
+#     be disclosed to others for any purpose without
+#     prior written permission of Secure Ai Labs, Inc.
+# -------------------------------------------------------------------------------
+
+from typing import Dict, Literal
+
+from pydantic import BaseSettings
+
+
+class Settings(BaseSettings):
+    """
+    Settings read from the environment, every field can be overridden with an
+    environment variable prefixed by SAIL_UPLOAD_, e.g. SAIL_UPLOAD_JOB_WORKERS=8
+    """
+
+    # Import the lazily loaded dependencies in the background once the server is up
+    warm_up_on_startup: bool = True
+
+    # Event loop lag monitor, debug makes asyncio log every callback slower than the threshold
+    event_loop_monitor_interval: float = 0.5
+    event_loop_lag_threshold: float = 0.1
+    event_loop_debug: bool = False
+
+    # Idempotent SAIL API calls failing with a timeout, a lost connection, a 429, 502, 503 or 504 are retried after an
+    # exponential backoff with jitter, from the base delay up to the max delay in seconds. Across the process, the
+    # retries are limited to a ratio of the calls plus a minimum per second.
+    sail_api_max_retries: int = 3
+    sail_api_retry_base_delay: float = 0.2
+    sail_api_retry_max_delay: float = 5
+    sail_api_retry_budget_ratio: float = 0.2
+    sail_api_retry_budget_min_per_second: float = 1
+
+    # After this many such failures in a row, the SAIL API calls fail fast and no upload job is started for the open
+    # time in seconds. Then a few trial calls close the breaker, or open it again if they fail.
+    sail_api_breaker_failure_threshold: int = 5
+    sail_api_breaker_open_seconds: float = 30
+    sail_api_breaker_half_open_calls: int = 1
+
+    # Upload job scheduler
+    job_workers: int = 4
+    job_short_lane_workers: int = 1
+    job_short_max_bytes: int = 16 * 1024 * 1024
+    job_max_queued: int = 256
+    job_max_queued_per_tenant: int = 32
+    job_max_running_per_tenant: int = 2
+    job_tenant_weights: Dict[str, float] = {}
+    # On shutdown, the queued and running jobs get this many seconds to finish. The dataset versions of the jobs
+    # left over, and of the ones waiting to be retried, are marked as ERROR.
+    job_shutdown_timeout: float = 25
+
+    # Parts uploaded with a gzip or zstd Content-Encoding are refused if they decode to more than this many
+    # bytes, or to more than this many times their encoded size once past 64 MiB
+    upload_max_decoded_bytes: int = 64 * 1024 * 1024 * 1024
+    upload_max_decoding_ratio: float = 250.0
+
+    # Budget of the memory all the upload jobs buffer data in, 0 disables it. A job waits for its buffers up to
+    # the timeout in seconds and fails after that. Released buffers up to the pool size are kept for reuse.
+    memory_budget_bytes: int = 1024 * 1024 * 1024
+    memory_budget_wait_timeout: float = 300
+    memory_pool_max_bytes: int = 64 * 1024 * 1024
+
+    # Uploads smaller than this many bytes are packaged in memory instead of in a working directory, 0 disables it
+    in_memory_max_bytes: int = 8 * 1024 * 1024
+
+    # Uploads packaged on disk are split in this many encrypted shards uploaded in parallel, 1 disables it.
+    # The shards are written next to the dataset package, which needs a sas token valid for the whole share.
+    shard_count: int = 1
+    shard_by: Literal["file", "rows"] = "file"
+    shard_workers: int = 4
+
+    # Deflate level of the data files in the package, 0 keeps them stored. Large packages are deflated
+    # in blocks on a pool of workers, 0 workers means one per core.
+    zip_compression_level: int = 0
+    zip_compression_workers: int = 0
+    zip_compression_block_size: int = 1024 * 1024
+
+    # AES-GCM library the packages are encrypted with: pycryptodome, cryptography or auto to measure the fastest
+    # one on the host once, at startup when warm_up_on_startup is set
+    crypto_backend: Literal["auto", "pycryptodome", "cryptography"] = "auto"
+
+    # Rows sampled from every CSV file into the encrypted preview of the package, 0 disables it
+    preview_rows: int = 0
+    preview_seed: int = 0
+
+    # Every this many rows of every CSV file, the byte offset of the row is kept in the row index of the package,
+    # 0 disables it
+    row_index_stride: int = 0
+
+    # The working directory of a failed upload packaged on disk is kept with a checkpoint of its completed stages
+    # for this many seconds after its last update, so that a retry resumes from the last completed stage. Only
+    # the directory of a job that failed once its content was encrypted is kept. Such a job is queued again on
+    # its own up to this many times, after a delay in seconds doubled on every retry.
+    checkpoint_retention: float = 3600
+    stage_retries: int = 2
+    stage_retry_delay: float = 5
+
+    # Upload progress streaming
+    progress_min_interval: float = 0.5
+    progress_retention: float = 600
+    progress_keepalive_interval: float = 15
+
+    # Tracing of the requests and upload jobs: none, console, file or the import path of an exporter factory
+    # like my_package.my_module:create_exporter. New traces are sampled at the given ratio, the spans are
+    # exported in batches every interval in seconds.
+    tracing_exporter: str = "none"
+    tracing_file: str = "traces.jsonl"
+    tracing_sample_ratio: float = 0.1
+    tracing_export_interval: float = 5
+
+    class Config:
+        env_prefix = "SAIL_UPLOAD_"
+
+
+settings = Settings()
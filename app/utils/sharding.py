@@ -0,0 +1,232 @@
+# -------------------------------------------------------------------------------
+# Engineering
+# sharding.py
+# -------------------------------------------------------------------------------
+"""Split the data files of a dataset version into independently packaged shards"""
+# -------------------------------------------------------------------------------
+# Copyright (C) 2022 Secure Ai Labs, Inc. All Rights Reserved.
+# Private and Confidential. Internal Use Only.
+#     This software contains proprietary information which shall not
+#     be reproduced or transferred to other documents and shall not
+#     be disclosed to others for any purpose without
+#     prior written permission of Secure Ai Labs, Inc.
+# -------------------------------------------------------------------------------
+
+import os
+import re
+from typing import Any, BinaryIO, Dict, Iterator, List, Optional, Tuple
+from urllib.parse import urlsplit, urlunsplit
+
+# How the data files are split between the shards
+SHARD_BY_FILE = "file"
+SHARD_BY_ROWS = "rows"
+
+COPY_CHUNK_SIZE = 1024 * 1024
+SCAN_CHUNK_SIZE = 1024 * 1024
+
+# A quoted CSV field, escaped quotes split it in several matches with the same new lines
+QUOTED_FIELD = re.compile(rb'"[^"]*"?')
+
+
+class ShardMember:
+    """
+    A byte range of a staged data file packaged in a shard. Row ranges of a CSV file start with a
+    copy of its header row, so that every shard can be parsed on its own.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        path: str,
+        start: int,
+        end: int,
+        header_end: int = 0,
+        first_row: Optional[int] = None,
+        row_count: Optional[int] = None,
+    ):
+        self.name = name
+        self.path = path
+        self.start = start
+        self.end = end
+        self.header_end = header_end
+        self.first_row = first_row
+        self.row_count = row_count
+
+    @property
+    def size(self) -> int:
+        return self.header_end + self.end - self.start
+
+    def iter_chunks(self) -> Iterator[bytes]:
+        """Read the content of the member, header row included"""
+        with open(self.path, "rb") as source:
+            yield source.read(self.header_end)
+            source.seek(self.start)
+            remaining = self.end - self.start
+            while remaining > 0:
+                chunk = source.read(min(COPY_CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                yield chunk
+                remaining -= len(chunk)
+
+    def copy_to(self, destination: BinaryIO):
+        """Write the content of the member, header row included, to a file object"""
+        for chunk in self.iter_chunks():
+            destination.write(chunk)
+
+    def to_manifest(self) -> Dict[str, Any]:
+        manifest: Dict[str, Any] = {"name": self.name}
+        if self.first_row is not None:
+            # The byte range of the uploaded file, to find the rows of the row index in the shard
+            manifest["first_row"] = self.first_row
+            manifest["row_count"] = self.row_count
+            manifest["start"] = self.start
+            manifest["end"] = self.end
+        return manifest
+
+
+def count_rows(data: bytes, in_quotes: bool) -> Tuple[int, bool]:
+    """
+    Count the new lines of CSV data that end a row, those inside quoted fields do not
+
+    :param data: the CSV data
+    :type data: bytes
+    :param in_quotes: True if the data starts inside a quoted field
+    :type in_quotes: bool
+    :return: the number of rows ended and True if the data ends inside a quoted field
+    :rtype: Tuple[int, bool]
+    """
+    text = b'"' + data if in_quotes else data
+    quoted_new_lines = sum(field.count(b"\n") for field in QUOTED_FIELD.findall(text))
+    return data.count(b"\n") - quoted_new_lines, text.count(b'"') % 2 == 1
+
+
+def find_row_end(data: bytes, base: int, start: int, in_quotes: bool) -> int:
+    """Find the end of the first row ending at or after start, or -1. The quote state is known at base."""
+    position = data.find(b"\n", start)
+    while position != -1:
+        if (in_quotes + data.count(b'"', base, position)) % 2 == 0:
+            return position + 1
+        position = data.find(b"\n", position + 1)
+    return -1
+
+
+def split_csv_rows(path: str, parts: int) -> List[ShardMember]:
+    """
+    Split a CSV file in row ranges of about the same size in a single pass. Quoted fields may contain
+    new lines, a new line only ends a row when the quotes seen so far are balanced. The file is scanned
+    in chunks so that the counting runs in native code rather than once per line.
+
+    :param path: the staged CSV file
+    :type path: str
+    :param parts: the number of row ranges
+    :type parts: int
+    :return: the row ranges, from the first to the last row of the file
+    :rtype: List[ShardMember]
+    """
+    name = os.path.basename(path)
+    size = os.path.getsize(path)
+    ranges: List[ShardMember] = []
+
+    with open(path, "rb") as csv_file:
+        # The header row is copied at the start of every range
+        header_end = 0
+        in_quotes = False
+        while True:
+            line = csv_file.readline()
+            header_end += len(line)
+            in_quotes ^= line.count(b'"') % 2 == 1
+            if not line or not in_quotes:
+                break
+
+        # Close a range at the first row end after each target offset
+        targets = [header_end + (size - header_end) * index / parts for index in range(1, parts)]
+        offset = range_start = header_end
+        row = range_first_row = 0
+        last_byte = b"\n"
+        while True:
+            chunk = csv_file.read(SCAN_CHUNK_SIZE)
+            if not chunk:
+                break
+
+            chunk_start = 0
+            while len(ranges) < len(targets) and targets[len(ranges)] <= offset + len(chunk):
+                range_end = find_row_end(
+                    chunk, chunk_start, max(chunk_start, int(targets[len(ranges)]) - 1 - offset), in_quotes
+                )
+                if range_end == -1:
+                    break
+                rows, in_quotes = count_rows(chunk[chunk_start:range_end], in_quotes)
+                row += rows
+                chunk_start = range_end
+                ranges.append(
+                    ShardMember(
+                        name, path, range_start, offset + range_end, header_end, range_first_row, row - range_first_row
+                    )
+                )
+                range_start, range_first_row = offset + range_end, row
+
+            rows, in_quotes = count_rows(chunk[chunk_start:], in_quotes)
+            row += rows
+            offset += len(chunk)
+            last_byte = chunk[-1:]
+
+    # The last row may not end with a new line
+    if last_byte != b"\n" and not in_quotes:
+        row += 1
+    ranges.append(ShardMember(name, path, range_start, offset, header_end, range_first_row, row - range_first_row))
+    return ranges
+
+
+def plan_shards(local_files: List[str], shard_count: int, shard_by: str) -> List[List[ShardMember]]:
+    """
+    Decide which part of every staged file goes to which shard.
+
+    By file, whole files are given to the least loaded shard, largest first. By rows, every CSV
+    file is split in one row range per shard, and other files are placed like by file.
+
+    :param local_files: the staged data files
+    :type local_files: List[str]
+    :param shard_count: the number of shards
+    :type shard_count: int
+    :param shard_by: SHARD_BY_FILE or SHARD_BY_ROWS
+    :type shard_by: str
+    :return: the members of every shard, empty shards are dropped
+    :rtype: List[List[ShardMember]]
+    """
+    if shard_by not in (SHARD_BY_FILE, SHARD_BY_ROWS):
+        raise Exception(f"Unknown shard mode {shard_by}")
+
+    shards: List[List[ShardMember]] = [[] for _ in range(shard_count)]
+    whole_files: List[str] = []
+    for local_file in local_files:
+        if shard_by == SHARD_BY_ROWS and local_file.lower().endswith(".csv"):
+            for shard, row_range in zip(shards, split_csv_rows(local_file, shard_count)):
+                shard.append(row_range)
+        else:
+            whole_files.append(local_file)
+
+    for local_file in sorted(whole_files, key=os.path.getsize, reverse=True):
+        shard = min(shards, key=lambda members: sum(member.size for member in members))
+        shard.append(ShardMember(os.path.basename(local_file), local_file, 0, os.path.getsize(local_file)))
+
+    return [shard for shard in shards if shard]
+
+
+def get_shard_file_url(file_url: str, shard_index: int) -> str:
+    """
+    Get the url of a shard next to the dataset package in the file share, keeping the sas token
+
+    :param file_url: the url of the dataset package
+    :type file_url: str
+    :param shard_index: the index of the shard
+    :type shard_index: int
+    :return: the url of the shard
+    :rtype: str
+    """
+    url = urlsplit(file_url)
+    return urlunsplit(url._replace(path=f"{url.path}{get_shard_file_suffix(shard_index)}"))
+
+
+def get_shard_file_suffix(shard_index: int) -> str:
+    return f".shard-{shard_index:04d}"
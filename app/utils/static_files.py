@@ -0,0 +1,195 @@
+# -------------------------------------------------------------------------------
+# Engineering
+# static_files.py
+# -------------------------------------------------------------------------------
+"""Serve precompressed and cacheable static files"""
+# -------------------------------------------------------------------------------
+# Copyright (C) 2022 Secure Ai Labs, Inc. All Rights Reserved.
+# Private and Confidential. Internal Use Only.
+#     This software contains proprietary information which shall not
+#     be reproduced or transferred to other documents and shall not
+#     be disclosed to others for any purpose without
+#     prior written permission of Secure Ai Labs, Inc.
+# -------------------------------------------------------------------------------
+
+import gzip
+import hashlib
+import mimetypes
+import os
+import sys
+from typing import Dict, List, Tuple
+
+from fastapi.staticfiles import StaticFiles
+from starlette.datastructures import Headers
+from starlette.responses import FileResponse, Response
+from starlette.types import Scope
+
+# Precompressed variants of a file are stored next to it with these extensions, in order of preference
+ENCODING_EXTENSIONS = [("br", ".br"), ("gzip", ".gz")]
+
+# The urls of the files carry a content hash, so they can be cached forever
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+
+def get_accepted_encodings(accept_encoding: str) -> List[str]:
+    """
+    Parse an Accept-Encoding header
+
+    :param accept_encoding: the value of the header
+    :type accept_encoding: str
+    :return: the encodings the client accepts
+    :rtype: List[str]
+    """
+    encodings: List[str] = []
+    for item in accept_encoding.split(","):
+        encoding, _, parameters = item.strip().partition(";")
+        quality = parameters.strip()
+        if quality.startswith("q="):
+            try:
+                if float(quality[2:]) == 0:
+                    continue
+            except ValueError:
+                continue
+        if encoding:
+            encodings.append(encoding.strip().lower())
+    return encodings
+
+
+class PrecompressedStaticFiles(StaticFiles):
+    """
+    StaticFiles that serves the build-time precompressed brotli or gzip variant of a file when the client
+    accepts it, with a strong content based ETag and immutable cache headers.
+    """
+
+    def __init__(self, directory: str):
+        super().__init__(directory=directory)
+        self._content_hashes: Dict[Tuple[str, int, int], str] = {}
+
+    def get_content_hash(self, full_path: str, stat_result: os.stat_result) -> str:
+        """
+        Get the sha256 of a file, computed once for every version of the file
+
+        :param full_path: path of the file
+        :type full_path: str
+        :param stat_result: the stat of the file
+        :type stat_result: os.stat_result
+        :return: the hex digest of the file content
+        :rtype: str
+        """
+        key = (full_path, stat_result.st_mtime_ns, stat_result.st_size)
+        content_hash = self._content_hashes.get(key)
+        if content_hash is None:
+            with open(full_path, "rb") as file:
+                content_hash = hashlib.sha256(file.read()).hexdigest()
+            self._content_hashes[key] = content_hash
+        return content_hash
+
+    def url_for(self, mount_path: str, path: str) -> str:
+        """
+        Get the cache busting url of a static file
+
+        :param mount_path: the path the static files are mounted on
+        :type mount_path: str
+        :param path: path of the file relative to the static directory
+        :type path: str
+        :return: the url of the file with a version derived from its content
+        :rtype: str
+        """
+        full_path, stat_result = self.lookup_path(path)
+        if stat_result is None:
+            return f"{mount_path}/{path}"
+        return f"{mount_path}/{path}?v={self.get_content_hash(full_path, stat_result)[:16]}"
+
+    def file_response(
+        self,
+        full_path: str,
+        stat_result: os.stat_result,
+        scope: Scope,
+        status_code: int = 200,
+    ) -> Response:
+        request_headers = Headers(scope=scope)
+        accepted_encodings = get_accepted_encodings(request_headers.get("accept-encoding", ""))
+
+        # Pick the best precompressed variant the client accepts
+        content_path, content_stat, content_encoding = full_path, stat_result, None
+        for encoding, extension in ENCODING_EXTENSIONS:
+            if encoding not in accepted_encodings:
+                continue
+            try:
+                content_stat = os.stat(full_path + extension)
+            except OSError:
+                continue
+            content_path, content_encoding = full_path + extension, encoding
+            break
+
+        headers = {
+            "cache-control": IMMUTABLE_CACHE_CONTROL,
+            "vary": "Accept-Encoding",
+            "etag": f'"{self.get_content_hash(content_path, content_stat)}"',
+        }
+        if content_encoding:
+            headers["content-encoding"] = content_encoding
+
+        response = FileResponse(
+            content_path,
+            status_code=status_code,
+            headers=headers,
+            media_type=mimetypes.guess_type(full_path)[0] or "text/plain",
+            stat_result=content_stat,
+            method=scope["method"],
+        )
+        if self.is_not_modified(response.headers, request_headers):
+            return Response(
+                status_code=304, headers={key: response.headers[key] for key in ("cache-control", "vary", "etag")}
+            )
+        return response
+
+    def is_not_modified(self, response_headers: Headers, request_headers: Headers) -> bool:
+        if_none_match = request_headers.get("if-none-match")
+        if if_none_match is None:
+            return super().is_not_modified(response_headers, request_headers)
+
+        # If-None-Match takes precedence over If-Modified-Since and uses the weak comparison
+        etag = response_headers["etag"]
+        for candidate in if_none_match.split(","):
+            candidate = candidate.strip()
+            if candidate.startswith("W/"):
+                candidate = candidate[2:]
+            if candidate == "*" or candidate == etag:
+                return True
+        return False
+
+
+def precompress_static_files(directory: str):
+    """
+    Write the gzip and, if the brotli package is installed, brotli variants of every file in a directory
+
+    :param directory: the static files directory
+    :type directory: str
+    """
+    try:
+        import brotli
+    except ImportError:
+        brotli = None
+        print("brotli is not installed, only the gzip variants are generated")
+
+    compressed_extensions = tuple(extension for _, extension in ENCODING_EXTENSIONS)
+    for root, _, files in os.walk(directory):
+        for file_name in files:
+            if file_name.endswith(compressed_extensions):
+                continue
+            path = os.path.join(root, file_name)
+            with open(path, "rb") as file:
+                content = file.read()
+
+            with open(path + ".gz", "wb") as file:
+                file.write(gzip.compress(content, compresslevel=9, mtime=0))
+            if brotli is not None:
+                with open(path + ".br", "wb") as file:
+                    file.write(brotli.compress(content, quality=11))
+
+
+if __name__ == "__main__":
+    precompress_static_files(
+        sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(__file__), "..", "static")
+    )
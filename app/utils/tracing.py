@@ -0,0 +1,328 @@
+# -------------------------------------------------------------------------------
+# Engineering
+# tracing.py
+# -------------------------------------------------------------------------------
+"""Trace the requests and upload jobs in spans, propagated with W3C trace context headers"""
+# -------------------------------------------------------------------------------
+# Copyright (C) 2022 Secure Ai Labs, Inc. All Rights Reserved.
+# Private and Confidential. Internal Use Only.
+#     This software contains proprietary information which shall not
+#     be reproduced or transferred to other documents and shall not
+#     be disclosed to others for any purpose without
+#     prior written permission of Secure Ai Labs, Inc.
+# -------------------------------------------------------------------------------
+
+import contextlib
+import contextvars
+import importlib
+import json
+import os
+import re
+import sys
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Deque, Dict, Iterator, List, Optional, TextIO
+
+from app.utils.settings import settings
+
+TRACEPARENT_HEADER = "traceparent"
+TRACEPARENT = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$")
+
+# Spans waiting to be exported are dropped past this many, tracing never holds up an upload
+MAX_QUEUED_SPANS = 8192
+EXPORT_BATCH_SIZE = 512
+
+
+class SpanContext:
+    """The identity of a span, as carried by a traceparent header"""
+
+    def __init__(self, trace_id: str, span_id: str, sampled: bool):
+        self.trace_id = trace_id
+        self.span_id = span_id
+        self.sampled = sampled
+
+    def to_traceparent(self) -> str:
+        return f"00-{self.trace_id}-{self.span_id}-{'01' if self.sampled else '00'}"
+
+    @classmethod
+    def from_traceparent(cls, traceparent: Optional[str]) -> Optional["SpanContext"]:
+        match = TRACEPARENT.match((traceparent or "").strip().lower())
+        if not match or match.group(1) == "0" * 32 or match.group(2) == "0" * 16:
+            return None
+        return cls(match.group(1), match.group(2), int(match.group(3), 16) & 1 == 1)
+
+
+class Span:
+    """
+    A timed operation of a trace. Spans of unsampled traces still carry the trace context, so that
+    the sampling decision is followed downstream, but they are never recorded nor exported.
+    """
+
+    def __init__(self, name: str, context: SpanContext, parent_id: Optional[str], attributes: Dict[str, Any]):
+        self.name = name
+        self.context = context
+        self.parent_id = parent_id
+        self.attributes = attributes
+        self.events: List[Dict[str, Any]] = []
+        self.status = "ok"
+        self.start_time = time.time()
+        self.end_time: Optional[float] = None
+
+    @property
+    def recording(self) -> bool:
+        return self.context.sampled
+
+    def set_attribute(self, key: str, value: Any):
+        if self.recording:
+            self.attributes[key] = value
+
+    def add_event(self, name: str, **attributes: Any):
+        if self.recording:
+            self.events.append({"name": name, "time": time.time(), "attributes": attributes})
+
+    def record_exception(self, exception: BaseException):
+        self.status = "error"
+        self.add_event("exception", type=type(exception).__name__, message=str(exception))
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "trace_id": self.context.trace_id,
+            "span_id": self.context.span_id,
+            "parent_id": self.parent_id,
+            "start_time": self.start_time,
+            "end_time": self.end_time,
+            "duration_ms": round(((self.end_time or self.start_time) - self.start_time) * 1000, 3),
+            "status": self.status,
+            "attributes": self.attributes,
+            "events": self.events,
+        }
+
+
+class SpanExporter:
+    """Base class of the exporters, export is called with batches of finished spans on the export thread"""
+
+    def export(self, spans: List[Dict[str, Any]]):
+        raise NotImplementedError
+
+    def shutdown(self):
+        pass
+
+
+class ConsoleSpanExporter(SpanExporter):
+    """Write every span as a line of JSON to a stream, stderr by default"""
+
+    def __init__(self, stream: Optional[TextIO] = None):
+        self.stream = stream or sys.stderr
+
+    def export(self, spans: List[Dict[str, Any]]):
+        for span in spans:
+            self.stream.write(json.dumps(span) + "\n")
+        self.stream.flush()
+
+
+class FileSpanExporter(SpanExporter):
+    """Append every span as a line of JSON to a file, to inspect the traces of offline tests"""
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def export(self, spans: List[Dict[str, Any]]):
+        with open(self.path, "a") as f:
+            for span in spans:
+                f.write(json.dumps(span) + "\n")
+
+
+def create_exporter(name: str) -> Optional[SpanExporter]:
+    """
+    Create the exporter named in the settings: none, console, file, or the import path of a
+    factory of a custom exporter like my_package.my_module:create_exporter
+
+    :param name: the exporter name or factory path
+    :type name: str
+    :return: the exporter, None if tracing is disabled
+    :rtype: Optional[SpanExporter]
+    """
+    if name == "none":
+        return None
+    if name == "console":
+        return ConsoleSpanExporter()
+    if name == "file":
+        return FileSpanExporter(settings.tracing_file)
+    module_name, _, factory_name = name.partition(":")
+    if not factory_name:
+        raise Exception(f"Unknown span exporter {name}")
+    return getattr(importlib.import_module(module_name), factory_name)()
+
+
+class Tracer:
+    """
+    Create the spans and hand the finished ones to the exporter. New traces are sampled at the given
+    ratio from their trace id, so every service sampling at the same ratio keeps the same traces, and
+    child spans follow the decision of their parent. Finished spans are exported in batches on a
+    background thread.
+    """
+
+    def __init__(self, exporter: Optional[SpanExporter], sample_ratio: float, export_interval: float):
+        self.exporter = exporter
+        self.sample_ratio = sample_ratio
+        self.export_interval = export_interval
+        self._current: contextvars.ContextVar[Optional[SpanContext]] = contextvars.ContextVar(
+            "current_span", default=None
+        )
+        self._queue: Deque[Dict[str, Any]] = deque()
+        self._condition = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self._exported = 0
+        self._dropped = 0
+
+    def set_exporter(self, exporter: Optional[SpanExporter], sample_ratio: Optional[float] = None):
+        """Replace the exporter, the queued spans go to the previous one first"""
+        self.flush()
+        if self.exporter is not None:
+            self.exporter.shutdown()
+        self.exporter = exporter
+        if sample_ratio is not None:
+            self.sample_ratio = sample_ratio
+
+    def get_current_context(self) -> Optional[SpanContext]:
+        return self._current.get()
+
+    @contextlib.contextmanager
+    def start_span(
+        self, name: str, parent: Optional[SpanContext] = None, **attributes: Any
+    ) -> Iterator[Optional[Span]]:
+        """
+        Run the body in a new span, the current span of the context is its parent unless one is given
+
+        :param name: the name of the operation
+        :type name: str
+        :param parent: the remote parent of the span, like the trace context of an incoming request
+        :type parent: Optional[SpanContext]
+        :return: the span, None if tracing is disabled
+        :rtype: Iterator[Optional[Span]]
+        """
+        if self.exporter is None:
+            yield None
+            return
+
+        parent = parent or self._current.get()
+        if parent is None:
+            trace_id = os.urandom(16).hex()
+            sampled = int(trace_id[16:], 16) < self.sample_ratio * (1 << 64)
+        else:
+            trace_id, sampled = parent.trace_id, parent.sampled
+        span = Span(name, SpanContext(trace_id, os.urandom(8).hex(), sampled), parent and parent.span_id, attributes)
+
+        token = self._current.set(span.context)
+        try:
+            yield span
+        except BaseException as exception:
+            span.record_exception(exception)
+            raise
+        finally:
+            self._current.reset(token)
+            if span.recording:
+                span.end_time = time.time()
+                self._enqueue(span.to_dict())
+
+    def get_trace_headers(self) -> Dict[str, str]:
+        """Get the headers propagating the current span to an outgoing request, empty outside of a span"""
+        context = self._current.get()
+        return {TRACEPARENT_HEADER: context.to_traceparent()} if context else {}
+
+    def flush(self):
+        """Export the queued spans now"""
+        with self._condition:
+            spans = list(self._queue)
+            self._queue.clear()
+        self._export(spans)
+
+    def get_metrics(self) -> Dict[str, Any]:
+        with self._condition:
+            return {"exported_spans": self._exported, "dropped_spans": self._dropped, "queued_spans": len(self._queue)}
+
+    def _enqueue(self, span: Dict[str, Any]):
+        with self._condition:
+            if len(self._queue) >= MAX_QUEUED_SPANS:
+                self._dropped += 1
+                return
+            self._queue.append(span)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._export_loop, name="span-exporter", daemon=True)
+                self._thread.start()
+            if len(self._queue) >= EXPORT_BATCH_SIZE:
+                self._condition.notify()
+
+    def _export_loop(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: len(self._queue) >= EXPORT_BATCH_SIZE, self.export_interval)
+                spans = [self._queue.popleft() for _ in range(min(len(self._queue), EXPORT_BATCH_SIZE))]
+            self._export(spans)
+
+    def _export(self, spans: List[Dict[str, Any]]):
+        exporter = self.exporter
+        if not spans or exporter is None:
+            return
+        try:
+            exporter.export(spans)
+            with self._condition:
+                self._exported += len(spans)
+        except Exception:
+            with self._condition:
+                self._dropped += len(spans)
+
+
+def bind_context(function: Callable[..., Any]) -> Callable[..., Any]:
+    """
+    Bind a function to the current context, so that the spans it starts on another thread, like on a
+    thread pool, have the current span as parent. Every call runs in its own copy of the context.
+    """
+    context = contextvars.copy_context()
+
+    def run_in_context(*args, **kwargs):
+        return context.copy().run(function, *args, **kwargs)
+
+    return run_in_context
+
+
+class TracingMiddleware:
+    """ASGI middleware running every http request in a span, continuing the trace of the caller if any"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or tracer.exporter is None:
+            await self.app(scope, receive, send)
+            return
+
+        traceparent = None
+        for key, value in scope["headers"]:
+            if key == b"traceparent":
+                traceparent = value.decode("latin-1")
+                break
+
+        with tracer.start_span(
+            f"{scope['method']} {scope['path']}",
+            SpanContext.from_traceparent(traceparent),
+            **{"http.method": scope["method"], "http.target": scope["path"]},
+        ) as span:
+
+            async def send_with_status(message):
+                if message["type"] == "http.response.start" and span is not None:
+                    span.set_attribute("http.status_code", message["status"])
+                    if message["status"] >= 500:
+                        span.status = "error"
+                await send(message)
+
+            await self.app(scope, receive, send_with_status)
+
+
+tracer = Tracer(
+    exporter=create_exporter(settings.tracing_exporter),
+    sample_ratio=settings.tracing_sample_ratio,
+    export_interval=settings.tracing_export_interval,
+)
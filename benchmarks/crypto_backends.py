@@ -0,0 +1,119 @@
+# -------------------------------------------------------------------------------
+# Engineering
+# crypto_backends.py
+# -------------------------------------------------------------------------------
+"""Check that the AES-GCM backends agree byte for byte and compare their throughput"""
+# -------------------------------------------------------------------------------
+# Copyright (C) 2022 Secure Ai Labs, Inc. All Rights Reserved.
+# Private and Confidential. Internal Use Only.
+#     This software contains proprietary information which shall not
+#     be reproduced or transferred to other documents and shall not
+#     be disclosed to others for any purpose without
+#     prior written permission of Secure Ai Labs, Inc.
+# -------------------------------------------------------------------------------
+#
+# Run from the repository root:
+#     python -m benchmarks.crypto_backends --sizes 1048576,67108864,268435456 --checks 200
+
+import argparse
+import os
+import random
+import tempfile
+import time
+from typing import Callable, List, Tuple
+
+from app.api.dataset_upload import encrypt_file_in_place
+from app.utils import crypto
+from app.utils.settings import settings
+
+
+def encrypt_incrementally(
+    backend: crypto.AesGcmBackend, key: bytes, nonce: bytes, data: bytes, pieces: List[int]
+) -> Tuple[bytes, bytes]:
+    """Encrypt the data in pieces of the given sizes, the last piece takes the rest"""
+    encryptor = backend.create_encryptor(key, nonce)
+    output = bytearray(len(data))
+    start = 0
+    for size in pieces + [len(data)]:
+        end = min(len(data), start + size)
+        encryptor.update_into(memoryview(data)[start:end], memoryview(output)[start:end])
+        start = end
+    return bytes(output), encryptor.finalize()
+
+
+def encrypt_file(backend: crypto.AesGcmBackend, key: bytes, nonce: bytes, data: bytes) -> Tuple[bytes, bytes]:
+    settings.crypto_backend = backend.name  # type: ignore
+    with tempfile.NamedTemporaryFile() as f:
+        f.write(data)
+        f.flush()
+        tag = encrypt_file_in_place(f.name, key, nonce)
+        f.seek(0)
+        return f.read(), tag
+
+
+def check_backends(backends: List[crypto.AesGcmBackend], checks: int):
+    """
+    Every backend and every way to encrypt must give the ciphertext and tag PyCryptodome's
+    encrypt_and_digest gives, and decrypt_and_verify must accept them
+    """
+    generator = random.Random(0)
+    sizes = crypto.EDGE_SIZES + [generator.randrange(3 * crypto.CHUNK_SIZE) for _ in range(checks)]
+    for size in sizes:
+        key, nonce, data = os.urandom(crypto.KEY_SIZE), os.urandom(crypto.NONCE_SIZE), os.urandom(size)
+        expected = crypto.AES.new(key, crypto.AES.MODE_GCM, nonce=nonce).encrypt_and_digest(data)
+        crypto.AES.new(key, crypto.AES.MODE_GCM, nonce=nonce).decrypt_and_verify(*expected)
+
+        for backend in backends:
+            buffer = bytearray(data)
+            pieces = [generator.randrange(1, 2 * crypto.CHUNK_SIZE) for _ in range(generator.randrange(4))]
+            results = {
+                "one-shot": backend.encrypt(key, nonce, data),
+                "in place": (buffer, backend.encrypt_in_place(memoryview(buffer), key, nonce)),
+                "incremental": encrypt_incrementally(backend, key, nonce, data, pieces),
+                "file": encrypt_file(backend, key, nonce, data),
+            }
+            for name, (ciphertext, tag) in results.items():
+                if bytes(ciphertext) != expected[0] or tag != expected[1]:
+                    raise Exception(f"{backend.name} {name} differs from the reference for {size} bytes")
+    print(f"{len(sizes)} sizes checked, all backends agree byte for byte")
+
+
+def time_encryption(encrypt: Callable[[], object], size: int, rounds: int) -> float:
+    best = float("inf")
+    for _ in range(rounds):
+        started_at = time.perf_counter()
+        encrypt()
+        best = min(best, time.perf_counter() - started_at)
+    return size / best / 1e9
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", default="1048576,16777216,134217728", help="comma separated buffer sizes")
+    parser.add_argument("--rounds", type=int, default=3, help="runs per measure, the fastest one counts")
+    parser.add_argument("--checks", type=int, default=50, help="random sizes checked on top of the edge cases")
+    args = parser.parse_args()
+
+    backends = crypto.get_available_backends()
+    check_backends(backends, args.checks)
+
+    settings.crypto_backend = "auto"
+    print(f"auto selects {crypto.get_crypto_backend().name} on this host")
+    print(f"{'backend':>14} {'size MB':>9} {'one-shot GB/s':>14} {'in place GB/s':>14} {'file GB/s':>10}")
+    for size in [int(size) for size in args.sizes.split(",")]:
+        data = os.urandom(size)
+        buffer = memoryview(bytearray(data))
+        key, nonce = os.urandom(crypto.KEY_SIZE), os.urandom(crypto.NONCE_SIZE)
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(data)
+            f.flush()
+            for backend in backends:
+                settings.crypto_backend = backend.name  # type: ignore
+                one_shot = time_encryption(lambda: backend.encrypt(key, nonce, data), size, args.rounds)
+                in_place = time_encryption(lambda: backend.encrypt_in_place(buffer, key, nonce), size, args.rounds)
+                file = time_encryption(lambda: encrypt_file_in_place(f.name, key, nonce), size, args.rounds)
+                print(f"{backend.name:>14} {size / 1e6:>9.1f} {one_shot:>14.2f} {in_place:>14.2f} {file:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,269 @@
+# -------------------------------------------------------------------------------
+# Engineering
+# load_upload.py
+# -------------------------------------------------------------------------------
+"""Load test of POST /upload-dataset against a stub SAIL API and stub storage"""
+# -------------------------------------------------------------------------------
+# Copyright (C) 2022 Secure Ai Labs, Inc. All Rights Reserved.
+# Private and Confidential. Internal Use Only.
+#     This software contains proprietary information which shall not
+#     be reproduced or transferred to other documents and shall not
+#     be disclosed to others for any purpose without
+#     prior written permission of Secure Ai Labs, Inc.
+# -------------------------------------------------------------------------------
+#
+# Run from the repository root:
+#     python -m benchmarks.load_upload --mode in-process --concurrency 32 --requests 500
+#     python -m benchmarks.load_upload --mode uvicorn --sizes 4096:0.8,4194304:0.2 --api-latency 0.2
+#     python -m benchmarks.load_upload --content-encoding gzip --sizes 4194304:1 --requests 50
+
+import argparse
+import asyncio
+import gzip
+import os
+import random
+import subprocess
+import sys
+import time
+import uuid
+from typing import Dict, List, Optional, Tuple
+
+import httpx
+
+from benchmarks.stubs import StubSailApi, get_free_port, install_stub_storage, start_stub_sail_api
+
+
+def parse_sizes(sizes: str) -> List[Tuple[int, float]]:
+    """Parse a size mix like 4096:0.7,1048576:0.3 into (size, weight) pairs"""
+    mix: List[Tuple[int, float]] = []
+    for item in sizes.split(","):
+        size, _, weight = item.partition(":")
+        mix.append((int(size), float(weight or 1)))
+    return mix
+
+
+def make_csv_payload(size: int) -> bytes:
+    """Make CSV looking content of the given size"""
+    row = b"1234,patient,2023-01-01,42.5,positive\n"
+    return (row * (size // len(row) + 1))[:size]
+
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    if not sorted_values:
+        return float("nan")
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+class LoadResult:
+    def __init__(self):
+        self.latencies: List[float] = []
+        self.status_codes: Dict[int, int] = {}
+        self.accepted_dataset_version_ids: List[str] = []
+        self.bytes_sent = 0
+        self.bytes_decoded = 0
+        self.probe_latencies: List[float] = []
+        self.started_at = 0.0
+        self.finished_at = 0.0
+
+
+async def run_uploads(
+    client: httpx.AsyncClient,
+    result: LoadResult,
+    payloads: List[Tuple[bytes, float]],
+    requests: int,
+    concurrency: int,
+    content_encoding: str,
+):
+    remaining = iter(range(requests))
+    sizes = [payload for payload, _ in payloads]
+    weights = [weight for _, weight in payloads]
+
+    # The payloads are compressed once up front, the benchmark measures the server
+    encoded_payloads = {payload: payload for payload in sizes}
+    if content_encoding == "gzip":
+        encoded_payloads = {payload: gzip.compress(payload, compresslevel=6) for payload in sizes}
+
+    async def worker():
+        for _ in remaining:
+            payload = random.choices(sizes, weights)[0]
+            dataset_version_id = str(uuid.uuid4())
+            part: Tuple = ("data.csv", encoded_payloads[payload], "text/csv")
+            if content_encoding != "identity":
+                part += ({"Content-Encoding": content_encoding},)
+            result.bytes_sent += len(encoded_payloads[payload])
+            result.bytes_decoded += len(payload)
+            started_at = time.perf_counter()
+            response = await client.post(
+                "/upload-dataset",
+                params={"dataset_version_id": dataset_version_id},
+                files=[("dataset_files", part)],
+                headers={"Authorization": "Bearer load-test"},
+            )
+            latency = time.perf_counter() - started_at
+            result.status_codes[response.status_code] = result.status_codes.get(response.status_code, 0) + 1
+            if response.status_code == 202:
+                result.latencies.append(latency)
+                result.accepted_dataset_version_ids.append(dataset_version_id)
+
+    result.started_at = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    result.finished_at = time.perf_counter()
+
+
+async def probe_event_loop(client: httpx.AsyncClient, result: LoadResult, interval: float, stop: asyncio.Event):
+    """
+    Time a trivial request to the server plus the oversleep of the local event loop. The request latency tracks
+    how long the server's event loop is blocked, and in-process the local event loop is the server's event loop.
+    """
+    while not stop.is_set():
+        started_at = time.perf_counter()
+        await client.get("/metrics")
+        request_latency = time.perf_counter() - started_at
+
+        sleep_started_at = time.perf_counter()
+        await asyncio.sleep(interval)
+        oversleep = max(0.0, time.perf_counter() - sleep_started_at - interval)
+        result.probe_latencies.append(request_latency + oversleep)
+
+
+async def run_load(args, base_url: Optional[str]) -> LoadResult:
+    payloads = [(make_csv_payload(size), weight) for size, weight in parse_sizes(args.sizes)]
+    if base_url is None:
+        from app.main import server
+
+        transport = httpx.ASGITransport(app=server)
+        client = httpx.AsyncClient(transport=transport, base_url="http://upload", timeout=args.timeout)
+        probe_client = httpx.AsyncClient(transport=transport, base_url="http://upload", timeout=args.timeout)
+    else:
+        limits = httpx.Limits(max_connections=args.concurrency)
+        client = httpx.AsyncClient(base_url=base_url, timeout=args.timeout, limits=limits)
+        probe_client = httpx.AsyncClient(base_url=base_url, timeout=args.timeout)
+
+    result = LoadResult()
+    async with client, probe_client:
+        stop = asyncio.Event()
+        probe = asyncio.create_task(probe_event_loop(probe_client, result, args.probe_interval, stop))
+        await run_uploads(client, result, payloads, args.requests, args.concurrency, args.content_encoding)
+        stop.set()
+        await probe
+    return result
+
+
+def wait_for_jobs(stub: StubSailApi, result: LoadResult, timeout: float) -> Dict[str, int]:
+    deadline = time.perf_counter() + timeout
+    while True:
+        states = stub.count_states(result.accepted_dataset_version_ids)
+        finished = states.get("ACTIVE", 0) + states.get("ERROR", 0)
+        if finished == len(result.accepted_dataset_version_ids) or time.perf_counter() > deadline:
+            return states
+        time.sleep(0.05)
+
+
+def start_server(api_url: str, bandwidth: Optional[float]) -> Tuple[subprocess.Popen, str]:
+    port = get_free_port()
+    env = dict(os.environ, SAIL_API_SERVICE_URL=api_url)
+    command = [sys.executable, "-m", "benchmarks.load_upload", "--serve", str(port)]
+    if bandwidth:
+        command += ["--storage-bandwidth", str(bandwidth)]
+    process = subprocess.Popen(command, env=env)
+    base_url = f"http://127.0.0.1:{port}"
+    deadline = time.perf_counter() + 30
+    while time.perf_counter() < deadline:
+        try:
+            if httpx.get(f"{base_url}/metrics").status_code == 200:
+                return process, base_url
+        except httpx.TransportError:
+            time.sleep(0.05)
+    process.terminate()
+    raise Exception("The upload server did not start")
+
+
+def serve(port: int, bandwidth: Optional[float]):
+    """Run the upload service under uvicorn with the stub storage installed"""
+    import uvicorn
+
+    from app.main import server
+
+    install_stub_storage(bandwidth)
+    uvicorn.run(server, host="127.0.0.1", port=port, log_level="warning")
+
+
+def report(result: LoadResult, states: Dict[str, int], jobs_finished_at: float):
+    latencies = sorted(result.latencies)
+    probes = sorted(result.probe_latencies)
+    elapsed = result.finished_at - result.started_at
+    total = sum(result.status_codes.values())
+    finished = states.get("ACTIVE", 0) + states.get("ERROR", 0)
+
+    print(f"Requests:               {total} in {elapsed:.2f} s ({total / elapsed:.1f} req/s)")
+    print(f"Status codes:           {dict(sorted(result.status_codes.items()))}")
+    print(
+        f"Request bodies:         {result.bytes_sent / 1e6:.1f} MB sent "
+        f"for {result.bytes_decoded / 1e6:.1f} MB of files"
+    )
+    print(
+        "202 latency:            "
+        f"p50 {percentile(latencies, 0.50) * 1000:.1f} ms, "
+        f"p90 {percentile(latencies, 0.90) * 1000:.1f} ms, "
+        f"p99 {percentile(latencies, 0.99) * 1000:.1f} ms, "
+        f"max {(latencies[-1] if latencies else float('nan')) * 1000:.1f} ms"
+    )
+    print(
+        "Event loop lag (probe): "
+        f"p50 {percentile(probes, 0.50) * 1000:.1f} ms, "
+        f"p99 {percentile(probes, 0.99) * 1000:.1f} ms, "
+        f"max {(probes[-1] if probes else float('nan')) * 1000:.1f} ms over {len(probes)} probes"
+    )
+    job_time = jobs_finished_at - result.started_at
+    print(
+        f"Background jobs:        {finished}/{len(result.accepted_dataset_version_ids)} finished "
+        f"({states.get('ERROR', 0)} errors) in {job_time:.2f} s ({finished / job_time:.1f} jobs/s)"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--mode", choices=["in-process", "uvicorn"], default="in-process")
+    parser.add_argument("--requests", type=int, default=200, help="number of uploads to send")
+    parser.add_argument("--concurrency", type=int, default=16, help="number of concurrent clients")
+    parser.add_argument("--sizes", default="4096:0.7,262144:0.25,4194304:0.05", help="size:weight mix of the files")
+    parser.add_argument(
+        "--content-encoding", choices=["identity", "gzip"], default="identity", help="encoding of the uploaded files"
+    )
+    parser.add_argument("--tenants", type=int, default=8, help="number of data owners the versions belong to")
+    parser.add_argument("--api-latency", type=float, default=0.02, help="latency of every stub SAIL API call")
+    parser.add_argument("--storage-bandwidth", type=float, default=None, help="stub storage bytes per second")
+    parser.add_argument("--probe-interval", type=float, default=0.05, help="seconds between event loop probes")
+    parser.add_argument("--timeout", type=float, default=120, help="timeout of every request")
+    parser.add_argument("--drain-timeout", type=float, default=120, help="seconds to wait for the background jobs")
+    parser.add_argument("--serve", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.serve, args.storage_bandwidth)
+        return
+
+    stub = StubSailApi(latency=args.api_latency, tenants=args.tenants)
+    api_url = start_stub_sail_api(stub)
+
+    server_process = None
+    if args.mode == "in-process":
+        os.environ["SAIL_API_SERVICE_URL"] = api_url
+        install_stub_storage(args.storage_bandwidth)
+        base_url = None
+    else:
+        server_process, base_url = start_server(api_url, args.storage_bandwidth)
+
+    try:
+        result = asyncio.run(run_load(args, base_url))
+        states = wait_for_jobs(stub, result, args.drain_timeout)
+        jobs_finished_at = max(stub.finished_at.values(), default=result.finished_at)
+        report(result, states, jobs_finished_at)
+    finally:
+        if server_process is not None:
+            server_process.terminate()
+            server_process.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+# -------------------------------------------------------------------------------
+# Engineering
+# parallel_zip.py
+# -------------------------------------------------------------------------------
+"""Compare the deflate throughput of zipfile and of the parallel zip writer"""
+# -------------------------------------------------------------------------------
+# Copyright (C) 2022 Secure Ai Labs, Inc. All Rights Reserved.
+# Private and Confidential. Internal Use Only.
+#     This software contains proprietary information which shall not
+#     be reproduced or transferred to other documents and shall not
+#     be disclosed to others for any purpose without
+#     prior written permission of Secure Ai Labs, Inc.
+# -------------------------------------------------------------------------------
+#
+# Run from the repository root:
+#     python -m benchmarks.parallel_zip --files 4 --size 67108864 --workers 1,2,4,8
+
+import argparse
+import os
+import random
+import shutil
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List
+
+from app.utils.parallel_zip import ParallelZipWriter
+
+
+def make_csv_file(path: str, size: int):
+    """Write CSV content with varied values, so that it deflates like real data"""
+    generator = random.Random(0)
+    with open(path, "wb") as f:
+        written = 0
+        while written < size:
+            rows = b"".join(
+                b"%d,patient-%d,%04d-%02d-%02d,%.3f,%s\n"
+                % (
+                    generator.randrange(10**9),
+                    generator.randrange(10**5),
+                    generator.randrange(1950, 2023),
+                    generator.randrange(1, 13),
+                    generator.randrange(1, 29),
+                    generator.random() * 100,
+                    generator.choice([b"positive", b"negative", b"unknown"]),
+                )
+                for _ in range(1000)
+            )
+            f.write(rows)
+            written += len(rows)
+
+
+def write_with_zipfile(zip_path: str, files: List[str], level: int, workers: int, block_size: int):
+    with zipfile.ZipFile(zip_path, "w", compression=zipfile.ZIP_DEFLATED, compresslevel=level) as zip_file:
+        for file in files:
+            zip_file.write(file, os.path.basename(file))
+
+
+def write_with_parallel_writer(zip_path: str, files: List[str], level: int, workers: int, block_size: int):
+    with ThreadPoolExecutor(max_workers=workers) as pool, open(zip_path, "wb") as f:
+        with ParallelZipWriter(f, level, block_size, pool=pool) as zip_file:
+            for file in files:
+                zip_file.write(file, os.path.basename(file))
+
+
+def check_zip(zip_path: str, files: List[str]):
+    """The archive must open with the standard zipfile module and hold the same content"""
+    with zipfile.ZipFile(zip_path) as zip_file:
+        if zip_file.testzip() is not None:
+            raise Exception(f"{zip_path} has a corrupted member")
+        for file in files:
+            with open(file, "rb") as f, zip_file.open(os.path.basename(file)) as member:
+                while True:
+                    expected = f.read(1024 * 1024)
+                    if member.read(len(expected) or 1) != expected:
+                        raise Exception(f"{file} does not match its member in {zip_path}")
+                    if not expected:
+                        break
+
+
+def time_writer(writer: Callable, zip_path: str, files: List[str], level: int, workers: int, block_size: int) -> float:
+    started_at = time.perf_counter()
+    writer(zip_path, files, level, workers, block_size)
+    return time.perf_counter() - started_at
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--files", type=int, default=4, help="number of CSV files in the archive")
+    parser.add_argument("--size", type=int, default=32 * 1024 * 1024, help="bytes per file")
+    parser.add_argument("--level", type=int, default=6, help="deflate level")
+    parser.add_argument("--block-size", type=int, default=1024 * 1024, help="bytes deflated by each task")
+    parser.add_argument("--workers", default=f"1,2,4,{os.cpu_count()}", help="comma separated worker counts")
+    parser.add_argument("--working-dir", default=os.path.join(os.getcwd(), "tmp", "benchmark"))
+    args = parser.parse_args()
+
+    os.makedirs(args.working_dir, exist_ok=True)
+    try:
+        files = [os.path.join(args.working_dir, f"data_{index}.csv") for index in range(args.files)]
+        for file in files:
+            make_csv_file(file, args.size)
+        total = sum(os.path.getsize(file) for file in files)
+        zip_path = os.path.join(args.working_dir, "data_content.zip")
+
+        print(f"{os.cpu_count()} cores, {total / 1e6:.0f} MB of CSV at level {args.level}")
+        print(f"{'writer':>10} {'workers':>8} {'seconds':>9} {'MB/s':>9} {'ratio':>7}")
+        runs = [("zipfile", write_with_zipfile, 1)] + [
+            ("parallel", write_with_parallel_writer, int(workers)) for workers in args.workers.split(",")
+        ]
+        for name, writer, workers in runs:
+            elapsed = time_writer(writer, zip_path, files, args.level, workers, args.block_size)
+            check_zip(zip_path, files)
+            ratio = total / os.path.getsize(zip_path)
+            print(f"{name:>10} {workers:>8} {elapsed:>9.2f} {total / elapsed / 1e6:>9.1f} {ratio:>7.2f}")
+    finally:
+        shutil.rmtree(args.working_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
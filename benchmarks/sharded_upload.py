@@ -0,0 +1,140 @@
+# -------------------------------------------------------------------------------
+# Engineering
+# sharded_upload.py
+# -------------------------------------------------------------------------------
+"""Time the upload of a dataset version split in a growing number of shards"""
+# -------------------------------------------------------------------------------
+# Copyright (C) 2022 Secure Ai Labs, Inc. All Rights Reserved.
+# Private and Confidential. Internal Use Only.
+#     This software contains proprietary information which shall not
+#     be reproduced or transferred to other documents and shall not
+#     be disclosed to others for any purpose without
+#     prior written permission of Secure Ai Labs, Inc.
+# -------------------------------------------------------------------------------
+#
+# Run from the repository root, the stub storage bandwidth is per file like an Azure file handle:
+#     python -m benchmarks.sharded_upload --files 4 --size 16777216 --shards 1,2,4,8 --storage-bandwidth 50000000
+
+import argparse
+import base64
+import io
+import json
+import os
+import shutil
+import time
+from typing import Dict, List
+from zipfile import ZipFile
+
+from fastapi import UploadFile
+
+from app.api import dataset_upload
+from app.api.dataset_upload import DatasetPackagingInfo
+from app.utils import crypto, sharding
+from app.utils.checkpoints import Checkpoint
+from app.utils.settings import settings
+from benchmarks.stubs import StubShareFileClient, install_stub_storage
+
+PACKAGE_URL = "https://stub.file.core.windows.net/share/dataset_benchmark.zip?sig=stub"
+
+
+def make_csv_file(size: int) -> bytes:
+    """Make CSV content with a header row and some quoted fields spanning several lines"""
+    rows = [b"id,name,note\n"]
+    length = len(rows[0])
+    row_number = 0
+    while length < size:
+        note = b'"multi\nline, quoted ""note"""' if row_number % 7 == 0 else b"plain"
+        rows.append(b"%d,patient-%d,%s\n" % (row_number, row_number, note))
+        length += len(rows[-1])
+        row_number += 1
+    return b"".join(rows)
+
+
+def read_sharded_package(packaging_info: DatasetPackagingInfo) -> Dict[str, bytes]:
+    """Download, decrypt and join the shards of the uploaded package back into the data files"""
+    with ZipFile(io.BytesIO(StubShareFileClient.files[PACKAGE_URL])) as package_zip:
+        dataset_header = json.loads(package_zip.read("dataset_header.json"))
+
+    data_files: Dict[str, bytes] = {}
+    for index, shard in enumerate(dataset_header["shards"]):
+        cipher = crypto.AES.new(
+            packaging_info.encryption_key, crypto.AES.MODE_GCM, nonce=base64.b64decode(shard["aes_nonce"])
+        )
+        shard_content = cipher.decrypt_and_verify(
+            StubShareFileClient.files[sharding.get_shard_file_url(PACKAGE_URL, index)],
+            base64.b64decode(shard["aes_tag"]),
+        )
+        with ZipFile(io.BytesIO(shard_content)) as shard_zip:
+            for member in shard["members"]:
+                content = shard_zip.read(member["name"])
+                if member["name"] in data_files and "first_row" in member:
+                    # Row ranges after the first one repeat the header row
+                    content = content.split(b"\n", 1)[1]
+                data_files[member["name"]] = data_files.get(member["name"], b"") + content
+    return data_files
+
+
+def upload(packaging_info: DatasetPackagingInfo, payloads: List[bytes], working_root: str, shards: int) -> float:
+    dataset_files = [
+        UploadFile(file=io.BytesIO(payload), filename=f"data_{index}.csv") for index, payload in enumerate(payloads)
+    ]
+    dataset_header = {"dataset_id": "benchmark", "dataset_packaging_format": "csvv1"}
+    working_dir = os.path.join(working_root, base64.urlsafe_b64encode(os.urandom(12)).decode("utf-8"))
+    os.makedirs(working_dir, exist_ok=True)
+    started_at = time.perf_counter()
+    checkpoint = Checkpoint("benchmark", working_dir)
+    try:
+        if shards == 1:
+            dataset_file = dataset_upload.package_dataset_on_disk(
+                "benchmark", dataset_files, packaging_info, dataset_header, checkpoint
+            )
+        else:
+            settings.shard_count = shards
+            dataset_file = dataset_upload.package_and_upload_dataset_shards(
+                "benchmark", PACKAGE_URL, dataset_files, packaging_info, dataset_header, checkpoint
+            )
+        with open(dataset_file, "rb") as f:
+            dataset_upload.upload_dataset_package("benchmark", PACKAGE_URL, f, os.path.getsize(dataset_file))
+        return time.perf_counter() - started_at
+    finally:
+        shutil.rmtree(working_dir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--files", type=int, default=4, help="number of CSV files in the upload")
+    parser.add_argument("--size", type=int, default=8 * 1024 * 1024, help="bytes per file")
+    parser.add_argument("--shards", default="1,2,4,8", help="comma separated shard counts, 1 is the unsharded package")
+    parser.add_argument("--shard-by", choices=[sharding.SHARD_BY_FILE, sharding.SHARD_BY_ROWS], default="rows")
+    parser.add_argument("--storage-bandwidth", type=float, default=50e6, help="stub storage bytes per second per file")
+    parser.add_argument("--working-dir", default=os.path.join(os.getcwd(), "tmp", "benchmark"))
+    args = parser.parse_args()
+
+    install_stub_storage(args.storage_bandwidth, keep_files=True)
+    packaging_info = DatasetPackagingInfo(
+        dataset_id="benchmark",
+        dataset_name="benchmark",
+        data_federation_id="benchmark",
+        data_federation_name="benchmark",
+        encryption_key=os.urandom(32),
+        data_model_txt=json.dumps({"dataframes": []}),
+    )
+    payloads = [make_csv_file(args.size) for _ in range(args.files)]
+    expected = {f"data_{index}.csv": payload for index, payload in enumerate(payloads)}
+    settings.shard_by = args.shard_by
+    settings.shard_workers = max(int(shards) for shards in args.shards.split(","))
+
+    print(f"{'shards':>7} {'seconds':>9} {'MB/s':>9}")
+    try:
+        for shards in [int(shards) for shards in args.shards.split(",")]:
+            StubShareFileClient.files.clear()
+            elapsed = upload(packaging_info, payloads, args.working_dir, shards)
+            if shards > 1 and read_sharded_package(packaging_info) != expected:
+                raise Exception(f"The package with {shards} shards does not join back into the uploaded files")
+            print(f"{shards:>7} {elapsed:>9.2f} {sum(map(len, payloads)) / elapsed / 1e6:>9.1f}")
+    finally:
+        shutil.rmtree(args.working_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
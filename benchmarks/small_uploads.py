@@ -0,0 +1,157 @@
+# -------------------------------------------------------------------------------
+# Engineering
+# small_uploads.py
+# -------------------------------------------------------------------------------
+"""Compare the in-memory and on-disk packaging of small uploads"""
+# -------------------------------------------------------------------------------
+# Copyright (C) 2022 Secure Ai Labs, Inc. All Rights Reserved.
+# Private and Confidential. Internal Use Only.
+#     This software contains proprietary information which shall not
+#     be reproduced or transferred to other documents and shall not
+#     be disclosed to others for any purpose without
+#     prior written permission of Secure Ai Labs, Inc.
+# -------------------------------------------------------------------------------
+#
+# Run from the repository root, point --working-dir at the volume the service uses:
+#     python -m benchmarks.small_uploads --sizes 4096,65536,1048576 --files 3 --jobs 200
+#     python -m benchmarks.small_uploads --working-dir /mnt/share/tmp
+
+import argparse
+import base64
+import io
+import json
+import os
+import shutil
+import time
+from typing import Callable, Dict, List
+from zipfile import ZipFile
+
+from fastapi import UploadFile
+
+from app.api import dataset_upload
+from app.api.dataset_upload import DatasetPackagingInfo
+from app.utils import crypto
+from app.utils.checkpoints import Checkpoint
+from benchmarks.load_upload import make_csv_payload, percentile
+from benchmarks.stubs import install_stub_storage
+
+
+def make_upload_files(payloads: List[bytes]) -> List[UploadFile]:
+    return [
+        UploadFile(file=io.BytesIO(payload), filename=f"data_{index}.csv") for index, payload in enumerate(payloads)
+    ]
+
+
+def make_dataset_header(packaging_info: DatasetPackagingInfo) -> Dict[str, str]:
+    return {
+        "dataset_id": packaging_info.dataset_id,
+        "dataset_name": packaging_info.dataset_name,
+        "data_federation_id": packaging_info.data_federation_id,
+        "data_federation_name": packaging_info.data_federation_name,
+        "dataset_packaging_format": "csvv1",
+    }
+
+
+def run_in_memory(packaging_info: DatasetPackagingInfo, payloads: List[bytes], working_root: str) -> bytes:
+    """Package and upload like encrypt_and_upload does below the in-memory threshold"""
+    dataset_files = make_upload_files(payloads)
+    dataset_header = make_dataset_header(packaging_info)
+    package = dataset_upload.package_dataset_in_memory("benchmark", dataset_files, packaging_info, dataset_header)
+    package_bytes = package.getvalue()
+    dataset_upload.upload_dataset_package("benchmark", "https://stub", package, len(package_bytes))
+    return package_bytes
+
+
+def run_on_disk(packaging_info: DatasetPackagingInfo, payloads: List[bytes], working_root: str) -> bytes:
+    """Package and upload like encrypt_and_upload does above the in-memory threshold"""
+    dataset_files = make_upload_files(payloads)
+    dataset_header = make_dataset_header(packaging_info)
+    working_dir = os.path.join(working_root, base64.urlsafe_b64encode(os.urandom(12)).decode("utf-8"))
+    os.makedirs(working_dir, exist_ok=True)
+    try:
+        dataset_file = dataset_upload.package_dataset_on_disk(
+            "benchmark", dataset_files, packaging_info, dataset_header, Checkpoint("benchmark", working_dir)
+        )
+        with open(dataset_file, "rb") as f:
+            dataset_upload.upload_dataset_package("benchmark", "https://stub", f, os.path.getsize(dataset_file))
+        with open(dataset_file, "rb") as f:
+            return f.read()
+    finally:
+        shutil.rmtree(working_dir, ignore_errors=True)
+
+
+def read_package(packaging_info: DatasetPackagingInfo, package: bytes) -> Dict[str, bytes]:
+    """Decrypt a dataset package and return its data files"""
+    with ZipFile(io.BytesIO(package)) as package_zip:
+        dataset_header = json.loads(package_zip.read("dataset_header.json"))
+        cipher = crypto.AES.new(
+            packaging_info.encryption_key,
+            crypto.AES.MODE_GCM,
+            nonce=base64.b64decode(dataset_header["aes_nonce"]),
+        )
+        data_content = cipher.decrypt_and_verify(
+            package_zip.read("data_content.zip"), base64.b64decode(dataset_header["aes_tag"])
+        )
+    with ZipFile(io.BytesIO(data_content)) as data_content_zip:
+        return {name: data_content_zip.read(name) for name in data_content_zip.namelist()}
+
+
+def time_jobs(
+    run: Callable[[DatasetPackagingInfo, List[bytes], str], bytes],
+    packaging_info: DatasetPackagingInfo,
+    payloads: List[bytes],
+    working_root: str,
+    jobs: int,
+) -> List[float]:
+    durations: List[float] = []
+    for _ in range(jobs):
+        started_at = time.perf_counter()
+        run(packaging_info, payloads, working_root)
+        durations.append(time.perf_counter() - started_at)
+    return sorted(durations)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", default="4096,65536,1048576,4194304", help="comma separated bytes per file")
+    parser.add_argument("--files", type=int, default=3, help="number of files in every upload")
+    parser.add_argument("--jobs", type=int, default=100, help="number of jobs timed for every size and mode")
+    parser.add_argument("--working-dir", default=os.path.join(os.getcwd(), "tmp", "benchmark"))
+    args = parser.parse_args()
+
+    install_stub_storage()
+    packaging_info = DatasetPackagingInfo(
+        dataset_id="benchmark",
+        dataset_name="benchmark",
+        data_federation_id="benchmark",
+        data_federation_name="benchmark",
+        encryption_key=os.urandom(32),
+        data_model_txt=json.dumps({"dataframes": []}),
+    )
+
+    print(f"{'upload size':>12} {'mode':>10} {'p50 ms':>9} {'p99 ms':>9} {'jobs/s':>9}")
+    try:
+        for size in [int(size) for size in args.sizes.split(",")]:
+            payloads = [make_csv_payload(size) for _ in range(args.files)]
+
+            # Both modes must produce packages with the same content
+            expected = {f"data_{index}.csv": payload for index, payload in enumerate(payloads)}
+            for run in (run_in_memory, run_on_disk):
+                if read_package(packaging_info, run(packaging_info, payloads, args.working_dir)) != expected:
+                    raise Exception(f"{run.__name__} produced a package with the wrong content")
+
+            p50s = {}
+            for mode, run in (("memory", run_in_memory), ("disk", run_on_disk)):
+                durations = time_jobs(run, packaging_info, payloads, args.working_dir, args.jobs)
+                p50s[mode] = percentile(durations, 0.50)
+                print(
+                    f"{size * args.files:>12} {mode:>10} {p50s[mode] * 1000:>9.2f} "
+                    f"{percentile(durations, 0.99) * 1000:>9.2f} {len(durations) / sum(durations):>9.1f}"
+                )
+            print(f"{'':>12} {'speedup':>10} {p50s['disk'] / p50s['memory']:>9.2f}x")
+    finally:
+        shutil.rmtree(args.working_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
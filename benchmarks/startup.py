@@ -0,0 +1,125 @@
+# -------------------------------------------------------------------------------
+# Engineering
+# startup.py
+# -------------------------------------------------------------------------------
+"""Measure the import time and the time to first response of the upload service"""
+# -------------------------------------------------------------------------------
+# Copyright (C) 2022 Secure Ai Labs, Inc. All Rights Reserved.
+# Private and Confidential. Internal Use Only.
+#     This software contains proprietary information which shall not
+#     be reproduced or transferred to other documents and shall not
+#     be disclosed to others for any purpose without
+#     prior written permission of Secure Ai Labs, Inc.
+# -------------------------------------------------------------------------------
+
+import argparse
+import socket
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+from typing import List, Tuple
+
+
+def measure_import_time(module: str) -> Tuple[float, List[Tuple[float, str]]]:
+    """
+    Import a module in a fresh interpreter with -X importtime
+
+    :param module: the module to import
+    :type module: str
+    :return: total import time in seconds and the cumulative time of every imported module
+    :rtype: Tuple[float, List[Tuple[float, str]]]
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+
+    # Lines look like: "import time:   self [us] | cumulative | imported package"
+    modules: List[Tuple[float, str]] = []
+    total = 0.0
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        seconds = int(cumulative) / 1_000_000
+        modules.append((seconds, name.rstrip()))
+        if name.strip() == module:
+            total = seconds
+
+    return total, modules
+
+
+def measure_time_to_first_response(app: str, path: str, timeout: float) -> float:
+    """
+    Start the server with uvicorn and wait for the first 200 response
+
+    :param app: the ASGI application to serve
+    :type app: str
+    :param path: the path to request
+    :type path: str
+    :param timeout: seconds to wait before giving up
+    :type timeout: float
+    :return: seconds from starting the process to the first 200 response
+    :rtype: float
+    """
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+
+    started_at = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", app, "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+    )
+    try:
+        while time.perf_counter() - started_at < timeout:
+            try:
+                with urllib.request.urlopen(f"http://127.0.0.1:{port}{path}", timeout=1) as response:
+                    if response.status == 200:
+                        return time.perf_counter() - started_at
+            except (urllib.error.URLError, ConnectionError):
+                time.sleep(0.01)
+        raise Exception(f"The server did not respond within {timeout} seconds")
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--module", default="app.main", help="module to measure the import time of")
+    parser.add_argument("--app", default="app.main:server", help="ASGI application to start")
+    parser.add_argument("--path", default="/metrics", help="path requested to detect the first response")
+    parser.add_argument("--top", type=int, default=15, help="number of slowest imports to show")
+    parser.add_argument("--import-budget", type=float, default=0.5, help="maximum import time in seconds")
+    parser.add_argument("--first-response-budget", type=float, default=3.0, help="maximum seconds to first 200")
+    args = parser.parse_args()
+
+    import_time, modules = measure_import_time(args.module)
+    print(f"Slowest imports (cumulative) for {args.module}:")
+    for seconds, name in sorted(modules, reverse=True)[: args.top]:
+        print(f"  {seconds * 1000:9.1f} ms  {name}")
+
+    first_response_time = measure_time_to_first_response(args.app, args.path, timeout=args.first_response_budget * 5)
+
+    print(f"Import time:            {import_time * 1000:9.1f} ms (budget {args.import_budget * 1000:.0f} ms)")
+    print(
+        f"Time to first 200:      {first_response_time * 1000:9.1f} ms "
+        f"(budget {args.first_response_budget * 1000:.0f} ms)"
+    )
+
+    failed = False
+    if import_time > args.import_budget:
+        print("FAILED: import time is over budget")
+        failed = True
+    if first_response_time > args.first_response_budget:
+        print("FAILED: time to first response is over budget")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
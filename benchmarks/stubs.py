@@ -0,0 +1,249 @@
+# -------------------------------------------------------------------------------
+# Engineering
+# stubs.py
+# -------------------------------------------------------------------------------
+"""Stub SAIL API service and file share storage for the benchmarks"""
+# -------------------------------------------------------------------------------
+# Copyright (C) 2022 Secure Ai Labs, Inc. All Rights Reserved.
+# Private and Confidential. Internal Use Only.
+#     This software contains proprietary information which shall not
+#     be reproduced or transferred to other documents and shall not
+#     be disclosed to others for any purpose without
+#     prior written permission of Secure Ai Labs, Inc.
+# -------------------------------------------------------------------------------
+
+import asyncio
+import base64
+import os
+import random
+import socket
+import threading
+import time
+import types
+from typing import Any, Dict, List, Optional
+
+import uvicorn
+from fastapi import Body, FastAPI, Response, status
+
+STUB_DATASET_ID = "00000000-0000-4000-8000-000000000001"
+STUB_DATA_FEDERATION_ID = "00000000-0000-4000-8000-000000000002"
+STUB_DATA_MODEL_ID = "00000000-0000-4000-8000-000000000003"
+STUB_DATA_MODEL_VERSION_ID = "00000000-0000-4000-8000-000000000004"
+STUB_DATASET_KEY = base64.b64encode(os.urandom(32)).decode("utf-8")
+
+
+class StubSailApi:
+    """
+    In-memory SAIL API service with a fixed latency on every call. Unknown dataset versions are
+    created on first use in the NOT_UPLOADED state and owned by one of `tenants` organizations.
+    """
+
+    def __init__(self, latency: float = 0.0, tenants: int = 1):
+        self.latency = latency
+        self.organizations = [
+            {"id": f"00000000-0000-4000-9000-{index:012d}", "name": f"org-{index}"} for index in range(tenants)
+        ]
+        self.dataset_version_states: Dict[str, str] = {}
+        self.dataset_version_organizations: Dict[str, Dict[str, str]] = {}
+        self.finished_at: Dict[str, float] = {}
+        self.lock = threading.Lock()
+        self.app = self._create_app()
+
+    def get_dataset_version(self, dataset_version_id: str) -> Dict[str, Any]:
+        with self.lock:
+            state = self.dataset_version_states.setdefault(dataset_version_id, "NOT_UPLOADED")
+            organization = self.dataset_version_organizations.setdefault(
+                dataset_version_id, random.choice(self.organizations)
+            )
+        return {
+            "dataset_id": STUB_DATASET_ID,
+            "description": "stub dataset version",
+            "name": dataset_version_id,
+            "id": dataset_version_id,
+            "dataset_version_created_time": "2023-01-01T00:00:00",
+            "organization": organization,
+            "state": state,
+            "note": "",
+        }
+
+    def update_dataset_version(self, dataset_version_id: str, state: Optional[str]):
+        if state is None:
+            return
+        with self.lock:
+            self.dataset_version_states[dataset_version_id] = state
+            if state in ("ACTIVE", "ERROR"):
+                self.finished_at[dataset_version_id] = time.perf_counter()
+
+    def count_states(self, dataset_version_ids: List[str]) -> Dict[str, int]:
+        with self.lock:
+            counts: Dict[str, int] = {}
+            for dataset_version_id in dataset_version_ids:
+                state = self.dataset_version_states.get(dataset_version_id, "UNKNOWN")
+                counts[state] = counts.get(state, 0) + 1
+            return counts
+
+    def _create_app(self) -> FastAPI:
+        app = FastAPI()
+        organization = {"id": "00000000-0000-4000-9000-ffffffffffff", "name": "stub"}
+
+        @app.get("/dataset-versions/{dataset_version_id}")
+        async def get_dataset_version(dataset_version_id: str):
+            await asyncio.sleep(self.latency)
+            return self.get_dataset_version(dataset_version_id)
+
+        @app.put("/dataset-versions/{dataset_version_id}")
+        async def update_dataset_version(dataset_version_id: str, body: Dict[str, Any] = Body(...)):
+            await asyncio.sleep(self.latency)
+            self.update_dataset_version(dataset_version_id, body.get("state"))
+            return Response(status_code=status.HTTP_204_NO_CONTENT)
+
+        @app.get("/dataset-versions/{dataset_version_id}/connection-string")
+        async def get_dataset_version_connection_string(dataset_version_id: str):
+            await asyncio.sleep(self.latency)
+            return {
+                "id": dataset_version_id,
+                "connection_string": f"https://stub.file.core.windows.net/share/{dataset_version_id}?sig=stub",
+            }
+
+        @app.get("/datasets/{dataset_id}")
+        async def get_dataset(dataset_id: str):
+            await asyncio.sleep(self.latency)
+            return {
+                "name": "stub dataset",
+                "description": "",
+                "tags": "",
+                "format": "CSV",
+                "id": dataset_id,
+                "organization": organization,
+                "state": "ACTIVE",
+            }
+
+        @app.get("/data-federations")
+        async def get_all_data_federations():
+            await asyncio.sleep(self.latency)
+            return {
+                "data_federations": [
+                    {
+                        "name": "stub federation",
+                        "description": "",
+                        "data_format": "CSV",
+                        "id": STUB_DATA_FEDERATION_ID,
+                        "organization": organization,
+                        "state": "ACTIVE",
+                        "data_submitter_organizations": [],
+                        "research_organizations": [],
+                        "datasets": [],
+                        "data_model_id": STUB_DATA_MODEL_ID,
+                    }
+                ]
+            }
+
+        @app.post("/data-federations/{data_federation_id}/dataset_key/{dataset_id}", status_code=201)
+        async def get_dataset_key(data_federation_id: str, dataset_id: str):
+            await asyncio.sleep(self.latency)
+            return {"dataset_key": STUB_DATASET_KEY}
+
+        @app.get("/data-models/{data_model_id}")
+        async def get_data_model_info(data_model_id: str):
+            await asyncio.sleep(self.latency)
+            return {
+                "name": "stub data model",
+                "description": "",
+                "id": data_model_id,
+                "maintainer_organization": organization,
+                "state": "PUBLISHED",
+                "current_version_id": STUB_DATA_MODEL_VERSION_ID,
+            }
+
+        @app.get("/data-model-versions/{data_model_version_id}")
+        async def get_data_model_version(data_model_version_id: str):
+            await asyncio.sleep(self.latency)
+            return {
+                "name": "stub data model version",
+                "description": "",
+                "data_model_id": STUB_DATA_MODEL_ID,
+                "id": data_model_version_id,
+                "organization_id": organization["id"],
+                "user_id": organization["id"],
+                "dataframes": [],
+                "state": "PUBLISHED",
+            }
+
+        return app
+
+
+def get_free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_stub_sail_api(stub: StubSailApi) -> str:
+    """
+    Serve the stub SAIL API on a background thread
+
+    :param stub: the stub to serve
+    :type stub: StubSailApi
+    :return: the base url of the stub
+    :rtype: str
+    """
+    port = get_free_port()
+    server = uvicorn.Server(uvicorn.Config(stub.app, host="127.0.0.1", port=port, log_level="warning"))
+    threading.Thread(target=server.run, name="stub-sail-api", daemon=True).start()
+    while not server.started:
+        time.sleep(0.01)
+    return f"http://127.0.0.1:{port}"
+
+
+class StubShareFileClient:
+    """
+    Drop-in for ShareFileClient, optionally at a limited bandwidth per file. The data is discarded
+    unless keep_files is set, then it is kept in files by url.
+    """
+
+    bandwidth: Optional[float] = None
+    keep_files = False
+    files: Dict[str, bytes] = {}
+
+    def __init__(self, file_url: str = ""):
+        self.file_url = file_url
+
+    @classmethod
+    def from_file_url(cls, file_url: str, **kwargs):
+        return cls(file_url)
+
+    def create_file(self, size: int, **kwargs):
+        pass
+
+    def upload_file(self, data, progress_hook=None, **kwargs):
+        uploaded = 0
+        chunks: List[bytes] = []
+        while True:
+            chunk = data.read(4 * 1024 * 1024)
+            if not chunk:
+                break
+            uploaded += len(chunk)
+            if self.keep_files:
+                chunks.append(chunk)
+            if self.bandwidth:
+                time.sleep(len(chunk) / self.bandwidth)
+            if progress_hook:
+                progress_hook(uploaded, None)
+        if self.keep_files:
+            self.files[self.file_url] = b"".join(chunks)
+
+
+def install_stub_storage(bandwidth: Optional[float] = None, keep_files: bool = False):
+    """
+    Make the upload jobs of this process write to the stub storage instead of Azure
+
+    :param bandwidth: upload bandwidth of every file in bytes per second, unlimited if None
+    :type bandwidth: Optional[float]
+    :param keep_files: keep the uploaded files in StubShareFileClient.files
+    :type keep_files: bool
+    """
+    from app.api import dataset_upload
+
+    StubShareFileClient.bandwidth = bandwidth
+    StubShareFileClient.keep_files = keep_files
+    dataset_upload.fileshare = types.SimpleNamespace(ShareFileClient=StubShareFileClient)
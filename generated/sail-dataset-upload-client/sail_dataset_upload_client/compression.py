@@ -0,0 +1,90 @@
+""" Compress uploaded files on the fly, without writing a compressed copy
+
+Not generated: `make generate_client` copies this module in the client package after generating it.
+"""
+import zlib
+from typing import Any, BinaryIO, Dict, List, Optional, Tuple, Union
+
+import attr
+
+from .models.body_upload_dataset import BodyUploadDataset
+from .types import File
+
+GZIP = "gzip"
+ZSTD = "zstd"
+
+CHUNK_SIZE = 64 * 1024
+
+EncodedFileJsonType = Union[
+    Tuple[Optional[str], BinaryIO, Optional[str]], Tuple[Optional[str], BinaryIO, Optional[str], Dict[str, str]]
+]
+
+
+class CompressingReader:
+    """
+    Read-only file object compressing a payload as it is read. It has no length, no fileno and no seek,
+    so httpx streams the part with a chunked request body instead of loading it in memory.
+    """
+
+    def __init__(self, payload: BinaryIO, content_encoding: str, level: int = 6):
+        self.payload = payload
+        self.content_encoding = content_encoding
+        self._buffer = bytearray()
+        self._done = False
+        if content_encoding == GZIP:
+            self._compressor = zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+        elif content_encoding == ZSTD:
+            try:
+                import zstandard
+            except ImportError:
+                raise ValueError("zstandard must be installed to upload files compressed with zstd")
+            self._compressor = zstandard.ZstdCompressor(level=3).compressobj()
+        else:
+            raise ValueError(f"Unsupported content encoding {content_encoding}, use {GZIP} or {ZSTD}")
+
+    def read(self, size: int = -1) -> bytes:
+        while not self._done and (size < 0 or len(self._buffer) < size):
+            chunk = self.payload.read(CHUNK_SIZE)
+            if chunk:
+                self._buffer += self._compressor.compress(chunk)
+            else:
+                self._buffer += self._compressor.flush()
+                self._done = True
+
+        if size < 0:
+            size = len(self._buffer)
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+
+@attr.s(auto_attribs=True)
+class EncodedFile(File):
+    """File compressed with its content_encoding, gzip or zstd, while it is uploaded"""
+
+    content_encoding: Optional[str] = None
+
+    def to_tuple(self) -> EncodedFileJsonType:
+        """Return a tuple representation that httpx will accept for multipart/form-data"""
+        if self.content_encoding:
+            return (
+                self.file_name,
+                CompressingReader(self.payload, self.content_encoding),
+                self.mime_type,
+                {"Content-Encoding": self.content_encoding},
+            )
+        return self.file_name, self.payload, self.mime_type
+
+
+class BodyUploadEncodedDataset(BodyUploadDataset):
+    """Body of upload_dataset sending every file as a part of its own, the only way to give it a Content-Encoding"""
+
+    def to_multipart(self) -> List[Tuple[str, Any]]:  # type: ignore[override]
+        # Every file is a part of its own with the same field name, the way the server reads a list of files
+        field_list: List[Tuple[str, Any]] = [
+            (key, (None, str(value).encode(), "text/plain")) for key, value in self.additional_properties.items()
+        ]
+        for dataset_files_item_data in self.dataset_files:
+            field_list.append(("dataset_files", dataset_files_item_data.to_tuple()))
+
+        return field_list
@@ -76,6 +76,9 @@ generate_client() {
     rm -rf sail-dataset-upload-client
     openapi-python-client generate --path docs/openapi.json
 
+    # Add the hand written extensions of the client
+    cp ../client_extensions/*.py sail-dataset-upload-client/sail_dataset_upload_client/
+
     popd
 }
 